@@ -32,44 +32,30 @@ echo 'filepath_failed_image_paths: ' ${filepath_failed_image_paths}
 echo 'sentinel2_dir:               ' ${sentinel2_dir}
 
 # read image paths to process for this tile
-readarray -t tile_image_filenames < ${image_paths_file}
-num_tile_image_filenames=${#tile_image_filenames[@]}
+num_tile_image_filenames=$(grep -c . ${image_paths_file})
 echo "Number of tile_image_filenames: " ${num_tile_image_filenames}
-tile_image_filenames=${tile_image_filenames[@]}
-
-# Loop through all images paths and deploy model
-count=$((count + 1))
-for tile_image_filename in ${tile_image_filenames}; do
-    echo "*************************************"
-    if [ ${GCHM_DOWNLOAD_FROM_AWS} == "True" ] ; then
-    	deploy_image_path=${tile_image_filename}
-    else
-	# set path to image on disk
-	deploy_image_path=${sentinel2_dir}/${tile_image_filename}
-    fi
-    echo 'deploy_image_path:' ${deploy_image_path}
-    echo "tile image: ${count} / ${num_tile_image_filenames}"
-    count=$((count + 1))
-    
-    python3 gchm/deploy.py --model_dir=${GCHM_MODEL_DIR} \
-                      	   --deploy_image_path=${deploy_image_path} \
-                      	   --deploy_dir=${GCHM_DEPLOY_DIR} \
-                      	   --deploy_patch_size=512 \
-                      	   --num_workers_deploy=4 \
-                      	   --num_models=${GCHM_NUM_MODELS} \
-                      	   --finetune_strategy="FT_Lm_SRCB" \
-                      	   --filepath_failed_image_paths=${filepath_failed_image_paths} \
-                      	   --download_from_aws=${GCHM_DOWNLOAD_FROM_AWS} \
-                      	   --sentinel2_dir=${sentinel2_dir} \
-                      	   --remove_image_after_pred="False"
-
-    # check if proxy error
-    exit_status=$?  # store the exit status for later use
-    if [ $exit_status -eq 222 ]; then
-        echo "Proxy error, abort!"
-        exit $exit_status  # exit the bash script with the same status
-    fi
-done
+
+# Deploy model on all image paths (worker mode: the models are loaded once for all images,
+# image filenames are joined with sentinel2_dir, failed images are logged and skipped)
+echo "*************************************"
+python3 gchm/deploy.py --model_dir=${GCHM_MODEL_DIR} \
+                       --deploy_image_paths=${image_paths_file} \
+                       --deploy_dir=${GCHM_DEPLOY_DIR} \
+                       --deploy_patch_size=512 \
+                       --num_workers_deploy=4 \
+                       --num_models=${GCHM_NUM_MODELS} \
+                       --finetune_strategy="FT_Lm_SRCB" \
+                       --filepath_failed_image_paths=${filepath_failed_image_paths} \
+                       --download_from_aws=${GCHM_DOWNLOAD_FROM_AWS} \
+                       --sentinel2_dir=${sentinel2_dir} \
+                       --remove_image_after_pred="False"
+
+# check if proxy error
+exit_status=$?  # store the exit status for later use
+if [ $exit_status -eq 222 ]; then
+    echo "Proxy error, abort!"
+    exit $exit_status  # exit the bash script with the same status
+fi
 
 
 #############################
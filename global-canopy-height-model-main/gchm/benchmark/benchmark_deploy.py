@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import itertools
+import resource
+import multiprocessing
+import numpy as np
+import torch
+
+from gchm.models.architectures import Architectures
+from gchm.utils.parser import setup_parser as setup_train_parser
+from gchm.utils.parser import load_args_from_json, str2bool, str_or_none
+from gchm.utils.inference import setup_cpu_threads, prepare_model_for_inference, to_device, autocast_context
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", default=None, type=str_or_none,
+                        help="optional ensemble directory. The architecture is read from model_0/finetune_strategy/args.json.")
+    parser.add_argument("--finetune_strategy", default='FT_Lm_SRCB', help="subdirectory in the model_0 directory.")
+    parser.add_argument("--architecture", default='xceptionS2_08blocks_256', help="model architecture (if no model_dir is set)")
+    parser.add_argument("--channels", default=15, type=int,
+                        help="number of input channels (12 bands + lat, sin(lon), cos(lon)) if no model_dir is set. "
+                             "With model_dir the channels follow from args.json (as in deploy.py).")
+    parser.add_argument("--return_variance", type=str2bool, nargs='?', const=True, default=True)
+    parser.add_argument("--patch_sizes", default=[256, 384, 512, 768], type=int, nargs='+')
+    parser.add_argument("--batch_sizes", default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument("--num_threads", default=[0], type=int, nargs='+',
+                        help="torch threads for CPU inference (0: torch default)")
+    parser.add_argument("--borders", default=[16], type=int, nargs='+',
+                        help="patch borders (overlap). Smaller borders reduce the overlap but use less context at the patch edges.")
+    parser.add_argument("--tile_size", default=10980, type=int, help="height and width of the tile (10m) to estimate the time per tile")
+    parser.add_argument("--num_warmup", default=2, type=int, help="number of batches before timing")
+    parser.add_argument("--num_iters", default=5, type=int, help="number of timed batches")
+    parser.add_argument("--memory_budget_gb", default=None, type=float,
+                        help="only configurations with a smaller peak memory (RSS incl. the estimated tile and recomposer "
+                             "memory, or GPU memory on cuda) are recommended")
+    parser.add_argument("--device", default='cpu', help="torch device (e.g. 'cpu', 'cuda:0')")
+    parser.add_argument("--channels_last", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("--bf16", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("--out_json", default=None, type=str_or_none,
+                        help="path to save all results and the recommended configuration (use with deploy.py --deploy_config_json)")
+    return parser
+
+
+def get_model_args(args):
+    """ Default train args updated with the args of the trained model (if model_dir is set). """
+    model_args, _ = setup_train_parser().parse_known_args([])
+    if args.model_dir is not None:
+        args_path = os.path.join(args.model_dir, 'model_0', args.finetune_strategy, 'args.json')
+        vars(model_args).update(load_args_from_json(args_path))
+        if model_args.input_lat_lon:
+            model_args.channels = 15  # 12 sentinel2 bands + 3 channels (lat, sin(lon), cos(lon)), see deploy.py
+    else:
+        model_args.architecture = args.architecture
+        model_args.return_variance = args.return_variance
+        model_args.channels = args.channels
+    for key in ['manual_init', 'freeze_features', 'freeze_last_mean', 'freeze_last_var', 'geo_shift', 'geo_scale',
+                'separate_lat_lon']:
+        if not hasattr(model_args, key):
+            setattr(model_args, key, False)
+    return model_args
+
+
+def get_num_patches(tile_size, patch_size, border):
+    """ Number of patches per tile (see Sentinel2Deploy._get_patch_coords). """
+    return int(math.ceil((tile_size + 2 * border) / (patch_size - 2 * border))) ** 2
+
+
+def get_tile_memory_gb(tile_size, num_recomposers, num_bands=12):
+    """
+    Estimated memory of a tile during deploy.py (not measured by run_config, which times the model only):
+    uint16 bands, uint8 scl and cloud masks, and one float32 recomposer per output (predictions, std).
+    The memory with --streaming or memory-mapped recomposers (--memmap_dir) is smaller.
+    """
+    bytes_per_pixel = num_bands * 2 + 2 + num_recomposers * 4
+    return tile_size ** 2 * bytes_per_pixel / 1024 ** 3
+
+
+def get_overlap_ratio(patch_size, border):
+    """ Ratio of the predicted pixels that are cropped (border) to the pixels used in the recomposed tile. """
+    return patch_size ** 2 / (patch_size - 2 * border) ** 2 - 1
+
+
+def run_config(model_args, config, bench_args):
+    """
+    Time the forward pass for one configuration. Runs in a new process to measure its peak memory
+    (of the model forward pass only, see get_tile_memory_gb).
+    """
+    result = dict(config)
+    try:
+        device = torch.device(bench_args['device'])
+        if device.type == 'cpu':
+            setup_cpu_threads(num_threads=config['num_threads'] or None)
+        net = Architectures(args=model_args)(model_args.architecture)(num_outputs=1)
+        net = prepare_model_for_inference(net, device=device, channels_last=bench_args['channels_last'])
+        inputs = torch.randn(config['batch_size'], model_args.channels, config['patch_size'], config['patch_size'])
+
+        times = []
+        with torch.inference_mode():
+            for i in range(bench_args['num_warmup'] + bench_args['num_iters']):
+                start = time.time()
+                with autocast_context(device=device, bf16=bench_args['bf16']):
+                    outputs = net(to_device(inputs, device=device, channels_last=bench_args['channels_last']))
+                outputs = outputs[0] if isinstance(outputs, (tuple, list)) else outputs
+                outputs.float().cpu()
+                if i >= bench_args['num_warmup']:
+                    times.append(time.time() - start)
+
+        result['patches_per_sec'] = config['batch_size'] / float(np.median(times))
+        # ru_maxrss is in kilobytes on linux
+        result['peak_rss_gb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+        if device.type == 'cuda':
+            result['peak_cuda_gb'] = torch.cuda.max_memory_allocated(device) / 1024 ** 3
+    except RuntimeError as e:
+        # e.g. out of memory
+        result['error'] = str(e).split('\n')[0]
+    return result
+
+
+def run_config_in_process(model_args, config, bench_args):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(run_config, (model_args, config, bench_args))
+
+
+def recommend(results, memory_budget_gb=None):
+    """ Returns the configuration with the smallest estimated time per tile within the memory budget. """
+    candidates = [r for r in results if 'error' not in r]
+    if memory_budget_gb is not None:
+        candidates = [r for r in candidates if r.get('peak_cuda_gb', r['peak_total_gb']) <= memory_budget_gb]
+    if not candidates:
+        return None
+    best = min(candidates, key=lambda r: r['tile_sec'])
+    recommended = {'deploy_patch_size': best['patch_size'],
+                   'deploy_batch_size': best['batch_size'],
+                   'deploy_border': best['border']}
+    if best['num_threads']:
+        recommended['num_threads'] = best['num_threads']
+    return recommended
+
+
+if __name__ == "__main__":
+
+    parser = setup_parser()
+    args, unknown = parser.parse_known_args()
+
+    model_args = get_model_args(args)
+    bench_args = {'device': args.device, 'channels_last': args.channels_last, 'bf16': args.bf16,
+                  'num_warmup': args.num_warmup, 'num_iters': args.num_iters}
+    print('architecture: {}, channels: {}, device: {}'.format(model_args.architecture, model_args.channels, args.device))
+    num_recomposers = 2 if model_args.return_variance else 1
+    tile_memory_gb = get_tile_memory_gb(args.tile_size, num_recomposers=num_recomposers)
+    print('estimated tile and recomposer memory (added to the peak rss of the model): {:5.2f} GB'.format(tile_memory_gb))
+
+    results = []
+    for patch_size, batch_size, num_threads, border in itertools.product(args.patch_sizes, args.batch_sizes,
+                                                                         args.num_threads, args.borders):
+        if patch_size <= 2 * border:
+            continue
+        config = {'patch_size': patch_size, 'batch_size': batch_size, 'num_threads': num_threads, 'border': border}
+        result = run_config_in_process(model_args, config, bench_args)
+        result['overlap_ratio'] = get_overlap_ratio(patch_size, border)
+        result['num_patches_tile'] = get_num_patches(args.tile_size, patch_size, border)
+        if 'error' in result:
+            print('{}: FAILED: {}'.format(config, result['error']))
+        else:
+            result['tile_sec'] = result['num_patches_tile'] / result['patches_per_sec']
+            result['tile_memory_gb'] = tile_memory_gb
+            result['peak_total_gb'] = result['peak_rss_gb'] + tile_memory_gb
+            print('patch_size: {:4d}, batch_size: {:3d}, threads: {:3d}, border: {:3d} | {:7.2f} patches/s, '
+                  'overlap: {:5.1f}%, time per tile: {:7.1f}s, peak rss (model): {:5.2f} GB, '
+                  'peak total (model + tile): {:5.2f} GB{}'.format(
+                   patch_size, batch_size, num_threads, border, result['patches_per_sec'],
+                   result['overlap_ratio'] * 100, result['tile_sec'], result['peak_rss_gb'], result['peak_total_gb'],
+                   ', peak cuda: {:5.2f} GB'.format(result['peak_cuda_gb']) if 'peak_cuda_gb' in result else ''))
+        results.append(result)
+        sys.stdout.flush()
+
+    recommended = recommend(results, memory_budget_gb=args.memory_budget_gb)
+    print('RECOMMENDED (memory budget: {} GB): {}'.format(args.memory_budget_gb, recommended))
+
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump({'results': results, 'recommended': recommended, 'benchmark_args': vars(args)}, f, indent=2)
+        print('saved results to: ', args.out_json)
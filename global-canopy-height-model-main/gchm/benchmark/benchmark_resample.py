@@ -0,0 +1,83 @@
+import argparse
+import time
+import numpy as np
+from skimage.transform import resize
+
+from gchm.utils.resample import upsample_band, resample_bands_to_target_shape
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", default=10980, help="height and width of the 10m target (full Sentinel-2 tile: 10980)", type=int)
+    parser.add_argument("--num_workers", default=8, help="number of threads to resample the bands concurrently", type=int)
+    parser.add_argument("--band_path", default=None, help="optional path to a 20m band (e.g. /vsizip/...B05_20m.jp2) to check the numerical difference on real data")
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+def skimage_resample(band_array, target_shape, order):
+    """ Resampling used in read_sentinel2_bands before the integer factor upsampler. """
+    return resize(band_array, target_shape, mode='reflect', order=order, preserve_range=True).astype(np.uint16)
+
+
+def compare(reference, out):
+    diff = np.abs(reference.astype(np.int32) - out.astype(np.int32))
+    return {'max_abs_diff': int(diff.max()), 'num_different_pixels': int(np.count_nonzero(diff))}
+
+
+def synthetic_bands(height, rng):
+    """ Random reflectances with an empty (zero) corner for the 20m and 60m bands and a random SCL band. """
+    band_arrays = {}
+    for band_name, scale in [('B05', 2), ('B06', 2), ('B07', 2), ('B8A', 2), ('B11', 2), ('B12', 2), ('CLD', 2),
+                             ('B01', 6), ('B09', 6)]:
+        band_array = rng.integers(0, 12000, size=(height // scale, height // scale)).astype(np.uint16)
+        band_array[:height // scale // 10, :height // scale // 10] = 0
+        band_arrays[band_name] = band_array
+    band_arrays['SCL'] = rng.integers(0, 12, size=(height // 2, height // 2)).astype(np.uint16)
+    return band_arrays
+
+
+if __name__ == "__main__":
+
+    parser = setup_parser()
+    args, unknown = parser.parse_known_args()
+
+    target_shape = (args.height, args.height)
+    band_arrays = synthetic_bands(args.height, rng=np.random.default_rng(args.seed))
+    print('target_shape: ', target_shape)
+
+    # per band comparison (numerical check and single thread timing)
+    time_skimage_total = 0
+    for band_name in band_arrays:
+        band_array = band_arrays[band_name]
+        order = 0 if band_name == 'SCL' else 3
+        scale = args.height // band_array.shape[0]
+
+        start = time.time()
+        reference = skimage_resample(band_array, target_shape, order=order)
+        time_skimage = time.time() - start
+        time_skimage_total += time_skimage
+
+        start = time.time()
+        out = upsample_band(band_array, scale=scale, order=order)
+        time_upsample = time.time() - start
+
+        print('{} (scale {}, order {}): skimage: {:.2f}s, upsample_band: {:.2f}s, speedup: {:.1f}x, {}'.format(
+            band_name, scale, order, time_skimage, time_upsample, time_skimage / time_upsample,
+            compare(reference, out)))
+
+    # all bands with multiple threads
+    start = time.time()
+    resample_bands_to_target_shape(band_arrays, target_shape=target_shape, nearest_bands=('SCL',),
+                                   num_workers=args.num_workers)
+    time_threads = time.time() - start
+    print('ALL BANDS: skimage (sequential): {:.2f}s, resample_bands_to_target_shape ({} threads): {:.2f}s, '
+          'speedup: {:.1f}x'.format(time_skimage_total, args.num_workers, time_threads,
+                                    time_skimage_total / time_threads))
+
+    if args.band_path is not None:
+        from gchm.utils.gdal_process import read_band
+        band_array = read_band(args.band_path)
+        shape = (band_array.shape[0] * 2, band_array.shape[1] * 2)
+        print('{}: {}'.format(args.band_path, compare(skimage_resample(band_array, shape, order=3),
+                                                      upsample_band(band_array, scale=2, order=3))))
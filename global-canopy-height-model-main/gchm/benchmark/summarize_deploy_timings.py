@@ -0,0 +1,88 @@
+import sys
+import json
+import argparse
+import numpy as np
+
+from gchm.utils.parser import str_or_none
+
+
+# order of the deploy stages in the summary (other stages are appended)
+STAGE_ORDER = ['download', 'cache_load', 'index', 'decode', 'resample', 'cache_save', 'latlon', 'mask',
+               'dataloader_wait', 'forward', 'recompose', 'write']
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("timing_jsonl", nargs='+', help="jsonl files written by deploy.py --timing_jsonl")
+    parser.add_argument("--percentiles", default=[50, 95], type=float, nargs='+')
+    parser.add_argument("--out_json", default=None, type=str_or_none, help="optional path to save the summary")
+    return parser
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def summarize(records, percentiles=(50, 95)):
+    """
+    Percentiles of the wall time, CPU time, peak RSS (since the start of the image) and RSS at the end of the stage
+    per stage across all images (tiles).
+    A stage that is missing for an image (e.g. download) is not counted for that image.
+
+    Returns:
+        dict: {stage: {'num_tiles', 'share_wall', 'wall_sec_p50', 'cpu_sec_p50', 'peak_rss_gb_p50', ...}}
+    """
+    stage_names = {name for record in records for name in record['stages']}
+    stage_names = [s for s in STAGE_ORDER if s in stage_names] + sorted(stage_names - set(STAGE_ORDER))
+    total_wall = sum(record['total_sec'] for record in records)
+
+    summary = {}
+    for name in stage_names + ['total']:
+        if name == 'total':
+            values = {'wall_sec': [r['total_sec'] for r in records], 'peak_rss_gb': [r['peak_rss_gb'] for r in records]}
+        else:
+            stages = [r['stages'][name] for r in records if name in r['stages']]
+            # rss_gb is missing in records of older versions
+            values = {key: [s[key] for s in stages if key in s] for key in ['wall_sec', 'cpu_sec', 'peak_rss_gb', 'rss_gb']}
+        summary[name] = {'num_tiles': len(values['wall_sec']),
+                         'share_wall': sum(values['wall_sec']) / max(total_wall, 1e-9)}
+        for key in values:
+            if not values[key]:
+                continue
+            for q in percentiles:
+                summary[name]['{}_p{:g}'.format(key, q)] = float(np.percentile(values[key], q))
+    return summary
+
+
+def print_summary(summary, percentiles=(50, 95)):
+    columns = ['{}_p{:g}'.format(key, q) for key in ['wall_sec', 'cpu_sec', 'peak_rss_gb', 'rss_gb'] for q in percentiles]
+    print('{:<16s} {:>6s} {:>7s} '.format('stage', 'tiles', 'share') + ' '.join('{:>16s}'.format(c) for c in columns))
+    for name, stats in summary.items():
+        print('{:<16s} {:>6d} {:>6.1f}% '.format(name, stats['num_tiles'], stats['share_wall'] * 100) +
+              ' '.join('{:>16.2f}'.format(stats[c]) if c in stats else '{:>16s}'.format('-') for c in columns))
+
+
+if __name__ == "__main__":
+
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    records = load_records(args.timing_jsonl)
+    if not records:
+        print('no records in: ', args.timing_jsonl)
+        sys.exit(1)
+    print('number of images: ', len(records))
+
+    summary = summarize(records, percentiles=args.percentiles)
+    print_summary(summary, percentiles=args.percentiles)
+
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('saved summary to: ', args.out_json)
@@ -6,13 +6,10 @@ import numpy as np
 import glob
 
 from gchm.utils.loss import get_inverse_bin_frequency_weights
-
-
-def compute_cloud_free(clouds, cloud_thresh_perc=10):
-    num_pixels_patch = clouds.shape[1] * clouds.shape[2]
-    perc_cloudy_pixels = np.sum(clouds > cloud_thresh_perc, axis=(1, 2, 3))/num_pixels_patch *100
-    cloud_free = perc_cloudy_pixels < cloud_thresh_perc
-    return cloud_free
+# compute_cloud_free is re-exported for callers that import it from this module (it moved to gchm.utils.h5_index)
+from gchm.utils.h5_index import compute_cloud_free, load_h5_index  # noqa: F401
+from gchm.utils.h5_chunk_cache import H5ChunkCache
+from gchm.utils.memmap_store import MemmapStore, load_memmap_meta
 
 
 class Sentinel2PatchesH5(Dataset):
@@ -28,10 +25,17 @@ class Sentinel2PatchesH5(Dataset):
         use_cloud_free (bool): Option to get cloud free pixels (not needed if patches are previously filtered in h5 file).
         path_bin_weights (str):
         weight_key (str): Key in the dict returned from this dataset class that is used to weight the loss
+        raw_inputs (bool): Option to return the uint16 bands as int16 view with channels last and 'lat', 'lon' in
+                           degrees (without input_transforms). The inputs are then decoded and normalized on the
+                           device with DeviceInputTransform.
+        index_dir (str): Optional directory of the sidecar index (see load_h5_index). Default: next to the h5 file.
+        chunk_cache_mb (float): Memory budget in MB of the cache of decompressed h5 chunks per worker
+                                (see H5ChunkCache). 0: no cache.
     """
     def __init__(self, path_h5, input_transforms=None, target_transforms=None, target_var_transforms=None,
                  input_lat_lon=False, mask_with_scl=True, use_cloud_free=False,
-                 path_bin_weights=None, weight_key=None):
+                 path_bin_weights=None, weight_key=None, raw_inputs=False, index_dir=None,
+                 chunk_cache_mb=0):
 
         self.path_h5 = path_h5
         self.input_transforms = input_transforms
@@ -41,15 +45,44 @@ class Sentinel2PatchesH5(Dataset):
         self.mask_with_scl = mask_with_scl
         self.scl_zero_canopy_height = np.array([5, 6])  # "not vegetated", "water"
         self.use_cloud_free = use_cloud_free
-        if self.use_cloud_free:
-            self.cloud_free_indices = self.get_cloud_free_indices()
+        # number of samples, cloud free indices and number of valid labels per patch (memory-mapped sidecar index)
+        self._load_index(index_dir=index_dir)
         self.path_bin_weights = path_bin_weights
         self.weight_key = weight_key
+        self.raw_inputs = raw_inputs
+        self.chunk_cache_mb = chunk_cache_mb
         if self.path_bin_weights is not None:
             self.label_distribution = np.load(self.path_bin_weights, allow_pickle=True).item()  # load dict with bin_edges and bin_weights
 
+    def _load_index(self, index_dir=None):
+        h5_index = load_h5_index(self.path_h5, index_dir=index_dir)
+        self.num_samples = h5_index['num_samples']
+        self.num_valid_labels = h5_index['num_valid_labels']
+        if self.use_cloud_free:
+            self.cloud_free_indices = h5_index['cloud_free_indices']
+
+    def _get_chunk_size(self):
+        """ Returns the number of samples per chunk of the images in the h5 file. """
+        with tables.open_file(self.path_h5, mode='r') as f:
+            chunkshape = f.root.images.chunkshape
+        return chunkshape[0] if chunkshape is not None else 64
+
     def _open_hdf5(self):
         self.h5_file = tables.open_file(self.path_h5, mode='r')
+        if self.chunk_cache_mb > 0:
+            self.chunk_cache = H5ChunkCache(self.h5_file, max_size_mb=self.chunk_cache_mb)
+
+    def _read(self, name, index):
+        """ Returns the samples at index of the array name (from the chunk cache if enabled). """
+        if hasattr(self, 'chunk_cache'):
+            return self.chunk_cache.read(name, index)
+        return self.h5_file.root[name][index, ...]
+
+    def get_chunk_cache_stats(self):
+        """ Returns the hit and miss counters of the chunk cache of this process (worker) or None. """
+        if hasattr(self, 'chunk_cache'):
+            return self.chunk_cache.get_stats()
+        return None
 
     def _set_datasets(self):
         """ Could be used to set attributes in __getitem__"""
@@ -72,22 +105,29 @@ class Sentinel2PatchesH5(Dataset):
         if self.use_cloud_free:
             index = self.cloud_free_indices[index]
 
-        images = np.array(self.h5_file.root.images[index, ...], dtype=np.float32)
-        if self.input_lat_lon:
-            lat = np.array(self.h5_file.root.lat[index, ...], dtype=np.float32)  # degrees
-            lon = np.array(self.h5_file.root.lon[index, ...], dtype=np.float32)  # degrees
+        if self.raw_inputs:
+            # uint16 bands as int16 view (same bytes, torch has no uint16 tensors)
+            raw_dict = {'inputs': np.asarray(self._read('images', index), dtype=np.uint16).view(np.int16)}
+            if self.input_lat_lon:
+                raw_dict['lat'] = np.array(self._read('lat', index)[..., 0], dtype=np.float32)  # degrees
+                raw_dict['lon'] = np.array(self._read('lon', index)[..., 0], dtype=np.float32)  # degrees
+            inputs = None
+        elif self.input_lat_lon:
+            images = np.array(self._read('images', index), dtype=np.float32)
+            lat = np.array(self._read('lat', index), dtype=np.float32)  # degrees
+            lon = np.array(self._read('lon', index), dtype=np.float32)  # degrees
             lon_sin = np.sin(2 * np.pi * lon / 360)
             lon_cos = np.cos(2 * np.pi * lon / 360)
             inputs = np.concatenate((images, lat, lon_sin, lon_cos), axis=-1)  # channels last
         else:
-            inputs = images
+            inputs = np.array(self._read('images', index), dtype=np.float32)
 
-        labels_mean = np.array(self.h5_file.root['canopy_height'][index, ...], dtype=np.float32)
+        labels_mean = np.array(self._read('canopy_height', index), dtype=np.float32)
         # square the predictive std to get the predictive variance
-        labels_var = np.square(np.array(self.h5_file.root['predictive_std'][index, ...], dtype=np.float32))
+        labels_var = np.square(np.array(self._read('predictive_std', index), dtype=np.float32))
 
         if self.mask_with_scl:
-            scl = np.array(self.h5_file.root['scl'][index, ...], dtype=np.uint8)
+            scl = np.array(self._read('scl', index), dtype=np.uint8)
             # set not_vegetated and water class to zero canopy height
             mask_zero_height = np.logical_and(np.isin(scl, self.scl_zero_canopy_height), ~np.isnan(labels_mean))
             labels_mean[mask_zero_height] = 0  # Note: currently we use the original variance for 0 heights
@@ -99,18 +139,19 @@ class Sentinel2PatchesH5(Dataset):
                                                                bin_edges=self.label_distribution['bin_edges'],
                                                                bin_weights=self.label_distribution[self.weight_key])
 
-        if self.input_transforms:
+        if self.input_transforms and not self.raw_inputs:
             inputs = self.input_transforms(inputs)
 
         if self.target_transforms:
             labels_mean = self.target_transforms(labels_mean)
             labels_var = self.target_var_transforms(labels_var)
 
-        data_dict = {'inputs': inputs,
-                     'labels_mean': labels_mean,
+        data_dict = {'labels_mean': labels_mean,
                      'labels_var': labels_var,
                      'labels_inv_var': 1/labels_var}
 
+        if not self.raw_inputs:
+            data_dict['inputs'] = inputs
         if self.path_bin_weights is not None:
             data_dict[self.weight_key] = sample_weights
 
@@ -120,35 +161,104 @@ class Sentinel2PatchesH5(Dataset):
             # convert all numpy arrays to tensor
             data_dict[k] = torch.from_numpy(data_dict[k])
 
+        if self.raw_inputs:
+            # channels last, the layout is changed on the device
+            data_dict.update({k: torch.from_numpy(v) for k, v in raw_dict.items()})
+
         return data_dict
 
     def __len__(self):
         if self.use_cloud_free:
             return len(self.cloud_free_indices)
         else:
-            with tables.open_file(self.path_h5, mode='r') as f:
-                return len(f.root.images)
+            return self.num_samples
 
     def __del__(self):
         if hasattr(self, 'h5_file'):
             self.h5_file.close()
 
-    def get_cloud_free_indices(self):
-        with tables.open_file(self.path_h5, mode='r') as f:
-            clouds = f.root.cloud[:]
-            cloud_free = compute_cloud_free(clouds)
-            cloud_free_indices = np.argwhere(cloud_free)
-            # convert to one-dimensional array
-            if len(cloud_free_indices.shape) == 2:
-                cloud_free_indices = cloud_free_indices.squeeze()
-            # convert zero-dimensional array (scalar) to one-dimensional array
-            if np.ndim(cloud_free_indices) == 0:
-                cloud_free_indices = cloud_free_indices[None]
-            return cloud_free_indices
+    def get_chunk_ranges(self, chunk_size=None):
+        """
+        Returns a list of (start, stop) dataset indices of the samples in each chunk of the h5 file, e.g. to read every
+        chunk once with a slice (see ChunkDataset). With use_cloud_free, the ranges contain the cloud free samples of
+        each chunk (empty chunks are skipped).
+
+        Args:
+            chunk_size (int): Number of samples per chunk. Default: chunk shape of the images in the h5 file.
+        """
+        if chunk_size is None:
+            chunk_size = self._get_chunk_size()
+        chunk_starts = np.append(np.arange(0, self.num_samples, chunk_size), self.num_samples)
+        if self.use_cloud_free:
+            chunk_starts = np.searchsorted(self.cloud_free_indices, chunk_starts)
+        return [(int(start), int(stop)) for start, stop in zip(chunk_starts[:-1], chunk_starts[1:]) if stop > start]
+
+
+class Sentinel2PatchesMemmap(Sentinel2PatchesH5):
+    """ Custom Dataset class for loading image patches from an uncompressed memmap store (see export_h5_to_memmap).
+
+    Returns the same samples as Sentinel2PatchesH5 for the h5 file of the store, but reads them without decompression.
+    Slices (e.g. SliceBatchSampler, ChunkDataset) are zero-copy views of the memory-mapped arrays
+    (with raw_inputs, the inputs are not copied before the transfer to the device).
+
+    Args:
+        path_memmap (str): Path to the directory of the memmap store.
+        See Sentinel2PatchesH5 for the other arguments.
+    """
+    def __init__(self, path_memmap, input_transforms=None, target_transforms=None, target_var_transforms=None,
+                 input_lat_lon=False, mask_with_scl=True, use_cloud_free=False,
+                 path_bin_weights=None, weight_key=None, raw_inputs=False):
+        self.path_memmap = path_memmap
+        super().__init__(path_h5=path_memmap, input_transforms=input_transforms, target_transforms=target_transforms,
+                         target_var_transforms=target_var_transforms, input_lat_lon=input_lat_lon,
+                         mask_with_scl=mask_with_scl, use_cloud_free=use_cloud_free,
+                         path_bin_weights=path_bin_weights, weight_key=weight_key, raw_inputs=raw_inputs)
+
+    def _load_index(self, index_dir=None):
+        # the index is part of the store
+        self.meta = load_memmap_meta(self.path_memmap)
+        self.num_samples = self.meta['num_samples']
+        self.num_valid_labels = np.load(os.path.join(self.path_memmap, 'num_valid_labels.npy'), mmap_mode='r')
+        if self.use_cloud_free:
+            self.cloud_free_indices = np.load(os.path.join(self.path_memmap, 'cloud_free_indices.npy'), mmap_mode='r')
+
+    def _get_chunk_size(self):
+        return self.meta['chunk_size']
+
+    def _open_hdf5(self):
+        # map the arrays in the first iteration --> each worker has its own maps
+        self.h5_file = MemmapStore(self.path_memmap)
+
+    def _read(self, name, index):
+        return self.h5_file.arrays[name][index]
+
+
+class ChunkDataset(Dataset):
+    """
+    Dataset of the h5 chunks of Sentinel2PatchesH5 datasets. Every item is the batch of samples of one chunk
+    (read with a slice, i.e. the chunk is decompressed once). Used with ChunkShuffleLoader to shuffle at chunk level.
+
+    Args:
+        dataset: Sentinel2PatchesH5 or ConcatDataset of Sentinel2PatchesH5 (see make_concat_dataset).
+        chunk_size (int): Number of samples per chunk. Default: chunk shape of the images in each h5 file.
+    """
+    def __init__(self, dataset, chunk_size=None):
+        self.datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+        self.chunks = [(i, start, stop) for i, ds in enumerate(self.datasets)
+                       for start, stop in ds.get_chunk_ranges(chunk_size=chunk_size)]
+        self.num_samples = sum(stop - start for _, start, stop in self.chunks)
+
+    def __getitem__(self, index):
+        dataset_index, start, stop = self.chunks[index]
+        return self.datasets[dataset_index][slice(start, stop)]
+
+    def __len__(self):
+        return len(self.chunks)
 
 
 def make_concat_dataset(paths_h5, input_transforms=None, target_transforms=None, target_var_transforms=None,
-                        input_lat_lon=False, use_cloud_free=False, path_bin_weights=None, weight_key=None):
+                        input_lat_lon=False, use_cloud_free=False, path_bin_weights=None, weight_key=None,
+                        raw_inputs=False, index_dir=None, chunk_cache_mb=0, data_format='h5'):
     """
     Returns a concatenated dataset of the custom pytorch :class:`Sentine2PatchesH5` for multiple h5 files.
 
@@ -157,6 +267,10 @@ def make_concat_dataset(paths_h5, input_transforms=None, target_transforms=None,
         input_transforms: transforms to process input images (normalization, augmentation, etc.)
         target_transforms: transforms to process targets
         target_var_transforms: transforms to process the variance of targets
+        raw_inputs: return the uint16 bands (int16 view) and lat lon in degrees to be processed on the device
+        index_dir: optional directory of the sidecar indices of the h5 files (default: next to the h5 files)
+        chunk_cache_mb: memory budget of the cache of decompressed h5 chunks per dataset and worker (0: no cache)
+        data_format: 'h5' or 'memmap' (paths_h5 are directories of memmap stores, see Sentinel2PatchesMemmap)
 
     Returns:
         concatenated :class:`Sentine2PatchesH5`
@@ -165,14 +279,28 @@ def make_concat_dataset(paths_h5, input_transforms=None, target_transforms=None,
     datasets = []
 
     for path_h5 in paths_h5:
-        datasets.append(Sentinel2PatchesH5(path_h5=path_h5,
-                                           input_transforms=input_transforms,
-                                           target_transforms=target_transforms,
-                                           target_var_transforms=target_var_transforms,
-                                           input_lat_lon=input_lat_lon,
-                                           use_cloud_free=use_cloud_free,
-                                           path_bin_weights=path_bin_weights,
-                                           weight_key=weight_key))
+        if data_format == 'memmap':
+            datasets.append(Sentinel2PatchesMemmap(path_memmap=path_h5,
+                                                   input_transforms=input_transforms,
+                                                   target_transforms=target_transforms,
+                                                   target_var_transforms=target_var_transforms,
+                                                   input_lat_lon=input_lat_lon,
+                                                   use_cloud_free=use_cloud_free,
+                                                   path_bin_weights=path_bin_weights,
+                                                   weight_key=weight_key,
+                                                   raw_inputs=raw_inputs))
+        else:
+            datasets.append(Sentinel2PatchesH5(path_h5=path_h5,
+                                               input_transforms=input_transforms,
+                                               target_transforms=target_transforms,
+                                               target_var_transforms=target_var_transforms,
+                                               input_lat_lon=input_lat_lon,
+                                               use_cloud_free=use_cloud_free,
+                                               path_bin_weights=path_bin_weights,
+                                               weight_key=weight_key,
+                                               raw_inputs=raw_inputs,
+                                               index_dir=index_dir,
+                                               chunk_cache_mb=chunk_cache_mb))
 
     if len(datasets) == 1:
         # return the custom dataset to work with a list of batched indices in "sampler"
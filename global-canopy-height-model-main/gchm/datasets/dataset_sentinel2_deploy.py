@@ -2,8 +2,21 @@ import torch
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
 import numpy as np
 import math
+import os
 
-from gchm.utils.gdal_process import read_sentinel2_bands, create_latlon_mask, get_reference_band_ds_gdal
+from gchm.utils.gdal_process import read_sentinel2_bands, get_latlon_vectors, get_reference_band_ds_gdal, \
+    get_tile_info, get_sentinel2_band_paths, open_sentinel2_band_datasets, read_sentinel2_window, \
+    read_band_resampled, read_band_window, rasterize_aoi
+from gchm.utils.tile_cache import TileCache
+from gchm.utils.profiling import timed
+
+
+def symmetric_indices(start, stop, size):
+    """ Indices of the range [start, stop) mirrored at the boundaries of [0, size) (as np.pad with mode='symmetric'). """
+    indices = np.arange(start, stop)
+    indices = np.where(indices < 0, -indices - 1, indices)
+    indices = np.where(indices >= size, 2 * size - indices - 1, indices)
+    return indices
 
 
 class Sentinel2Deploy(Dataset):
@@ -11,6 +24,8 @@ class Sentinel2Deploy(Dataset):
     A custom Dataset to predict for a full Sentinel-2 image tile in the SAFE format.
     The Sentinel-2 tile is copped into slightly overlapping patches to apply the model.
     The resulting patches can then be recomposed to the original tile using recompose_patches().
+    Optionally, patches with too few valid pixels are skipped (see min_valid_fraction). The dataset then only contains
+    the remaining patches (see self.patch_indices).
 
     Args:
         path (str): Path of .zip file in SAFE format (or aws path to image data)
@@ -19,45 +34,181 @@ class Sentinel2Deploy(Dataset):
         patch_size (int): Size of square patch of size
         border (int): Cropped patches will overlap by the amount of pixel set as border.
         from_aws (bool): Option to download the Sentinel-2 images from AWS S3.
+        streaming (bool): Option to read the patches on demand with windowed reads instead of loading the full tile
+                          to memory. Only SCL, CLD and the empty pixel mask are kept in memory (uint8, 10m).
+        halo (int): Number of native pixels added around a window before resampling the 20m and 60m bands (streaming).
+        num_workers_decode (int): Number of threads to decode the JP2 bands concurrently when loading the full tile.
+        min_valid_fraction (float): Patches with a smaller fraction of valid pixels (not empty, not excluded by SCL,
+                                    not cloudy and inside the aoi) are skipped and remain nan in the recomposed tile.
+                                    If 0 and no aoi is set: all patches are predicted.
+        cloud_thresh_perc (int): Pixels with a cloud probability above this threshold are invalid (min_valid_fraction).
+        aoi_path (str): Optional path to a vector file with the area of interest (polygons).
+                        Pixels outside the area of interest are invalid and masked in mask_tile().
+        cache_dir (str): Optional directory of a TileCache. The decoded tile is saved to the cache after reading and
+                         opened memory-mapped from the cache if it exists (also in streaming mode).
+        cache_max_size_gb (float): Maximum size of the cache (least recently used tiles are removed).
+        safe_index_dir (str): Optional directory to save the SafeIndex of the zip file (reused across runs).
+        raw_inputs (bool): Option to return the uint16 patch as int16 view with channels last and the 'lat' (column)
+                           and 'lon' (row) vectors in degrees (without input_transforms). The inputs are then decoded
+                           and normalized on the device with DeviceInputTransform.
+        timer (StageTimer): Optional timer for the loading stages (e.g. 'index', 'decode', 'resample', 'latlon').
+        band_source (BandCache): Optional source of the band files (see gchm/utils/band_source.py). The path is then
+                                 the product prefix in the bucket (e.g. 'tiles/32/T/MT/2020/6/23/0').
     """
-    def __init__(self, path, input_transforms=None, input_lat_lon=False, patch_size=128, border=8, from_aws=False):
+    def __init__(self, path, input_transforms=None, input_lat_lon=False, patch_size=128, border=8, from_aws=False,
+                 streaming=False, halo=16, num_workers_decode=1, min_valid_fraction=0, cloud_thresh_perc=5,
+                 aoi_path=None, cache_dir=None, cache_max_size_gb=None, safe_index_dir=None, raw_inputs=False,
+                 timer=None, band_source=None):
 
         self.path = path
         self.from_aws = from_aws
         self.input_transforms = input_transforms
         self.input_lat_lon = input_lat_lon
+        self.raw_inputs = raw_inputs
         self.patch_size = patch_size
         self.border = border
         self.patch_size_no_border = self.patch_size - 2 * self.border
-        self.image, self.tile_info, self.scl, self.cloud = read_sentinel2_bands(data_path=self.path, from_aws=self.from_aws, channels_last=True)
-        self.image_shape_original = self.image.shape
-        # pad the image with channels in last dimension
-        self.image = np.pad(self.image, ((self.border, self.border), (self.border, self.border), (0, 0)), mode='symmetric')
+        self.streaming = streaming
+        self.halo = halo
+        self.safe_index_dir = safe_index_dir
+        cached = None
+        if cache_dir is not None:
+            tile_cache = TileCache(cache_dir=cache_dir, max_size_gb=cache_max_size_gb)
+            cache_key = tile_cache.get_key(self.path, from_aws=self.from_aws, resampling='upsample_band',
+                                           channels_last=True)
+            with timed(timer, 'cache_load'):
+                cached = tile_cache.load(cache_key)
+            if cached is not None:
+                # the memory-mapped tile is read on demand, streaming is not needed
+                self.streaming = False
+        if cached is not None:
+            self.image, self.tile_info, self.scl, self.cloud = cached
+            self.image_shape_original = self.image.shape
+        elif self.streaming:
+            self._init_streaming(timer=timer, band_source=band_source)
+        else:
+            self.image, self.tile_info, self.scl, self.cloud = read_sentinel2_bands(data_path=self.path, from_aws=self.from_aws, channels_last=True,
+                                                                                    num_workers=num_workers_decode,
+                                                                                    index_dir=self.safe_index_dir,
+                                                                                    timer=timer,
+                                                                                    band_source=band_source)
+            self.image_shape_original = self.image.shape
+            if cache_dir is not None:
+                with timed(timer, 'cache_save'):
+                    tile_cache.save(cache_key, image=self.image, tile_info=self.tile_info,
+                                    scl=np.asarray(self.scl, dtype=np.uint8), cloud=self.cloud)
+        # the image is padded virtually with symmetric padding (patches at the tile boundary mirror the image, see
+        # get_patch). The patch coordinates refer to the padded image.
+        self.image_shape_padded = (self.image_shape_original[0] + 2 * self.border,
+                                   self.image_shape_original[1] + 2 * self.border,
+                                   self.image_shape_original[2])
         self.patch_coords_dict = self._get_patch_coords()
         self.scl_zero_canopy_height = np.array([5, 6])  # "not vegetated", "water"
         self.scl_exclude_labels = np.array([8, 9, 11, 6])  # CLOUD_MEDIUM_PROBABILITY, CLOUD_HIGH_PROBABILITY, SNOW, water
-        self.scl = np.array(self.scl, dtype=np.uint8)
-        # open a 10m reference band as gdal dataset
-        self.ref_ds = get_reference_band_ds_gdal(path_file=self.path)
-        # creat lat lon masks for entire images (10m resolution)
-        self.lat_mask, self.lon_mask = create_latlon_mask(height=self.ref_ds.RasterYSize, width=self.ref_ds.RasterXSize,
-                                                          refDataset=self.ref_ds)
-        # pad lat lon mask to match the padded image
-        self.lat_mask = np.pad(self.lat_mask, ((self.border, self.border), (self.border, self.border)), mode='symmetric')
-        self.lon_mask = np.pad(self.lon_mask, ((self.border, self.border), (self.border, self.border)), mode='symmetric')
+        self.scl = np.asarray(self.scl, dtype=np.uint8)
+        self.aoi_path = aoi_path
+        self.aoi_mask = None
+        self.min_valid_fraction = min_valid_fraction
+        self.cloud_thresh_perc = cloud_thresh_perc
+        with timed(timer, 'mask'):
+            if self.aoi_path is not None:
+                self.aoi_mask = rasterize_aoi(aoi_path=self.aoi_path, tile_info=self.tile_info)
+                print('number of pixels in aoi: ', np.sum(self.aoi_mask))
+            # indices of the patches that are predicted
+            self.patch_indices = self._get_valid_patch_indices()
+        with timed(timer, 'latlon'):
+            # open a 10m reference band as gdal dataset
+            self.ref_ds = get_reference_band_ds_gdal(path_file=self.path, index_dir=self.safe_index_dir,
+                                                     band_source=band_source)
+            # latitude per row and longitude per column (10m resolution). The lat lon masks are linear in the rows and
+            # columns, such that the lat lon channels of a patch are broadcast from these vectors.
+            self.lat_col, self.lon_row = get_latlon_vectors(height=self.ref_ds.RasterYSize,
+                                                            width=self.ref_ds.RasterXSize, refDataset=self.ref_ds)
+            # cyclic encoding of the longitude (computed once per column)
+            self.lon_sin_row = np.sin(2 * np.pi * self.lon_row / 360)
+            self.lon_cos_row = np.cos(2 * np.pi * self.lon_row / 360)
 
         print('self.image_shape_original: ', self.image_shape_original)
-        print('after padding: self.image.shape: ', self.image.shape)
-        print('after padding: self.lat_mask.shape: ', self.lat_mask.shape)
-        print('after padding: self.lon_mask.shape: ', self.lon_mask.shape)
+        print('padded image shape: ', self.image_shape_padded)
+
+    def _init_streaming(self, timer=None, band_source=None):
+        """ Get the tile info, SCL, CLD and the empty pixel mask without loading the image bands to memory. """
+        with timed(timer, 'index'):
+            self.band_paths = get_sentinel2_band_paths(data_path=self.path, from_aws=self.from_aws,
+                                                       index_dir=self.safe_index_dir, band_source=band_source)
+            band_datasets = open_sentinel2_band_datasets(self.band_paths)
+            ref_ds = band_datasets['B02']['ds']
+            self.tile_info = get_tile_info(ref_ds)
+        height, width = ref_ds.RasterYSize, ref_ds.RasterXSize
+        self.image_shape_original = (height, width, 12)
+
+        with timed(timer, 'resample'):
+            print('reading SCL and CLD band resampled to 10m resolution...')
+            self.scl = read_band_resampled(ds=band_datasets['SCL']['ds'], scale=band_datasets['SCL']['scale'],
+                                           order=0, halo=self.halo, dtype=np.uint8)
+            # cloud probability in percent (0-100)
+            self.cloud = read_band_resampled(ds=band_datasets['CLD']['ds'], scale=band_datasets['CLD']['scale'],
+                                             order=3, halo=self.halo, dtype=np.uint8)
+
+        with timed(timer, 'decode'):
+            print('computing empty pixel mask...')
+            # pixels where all RGB values equal zero are empty (bands B02, B03, B04)
+            self.empty_mask = np.ones((height, width), dtype=bool)
+            for band_name in ['B02', 'B03', 'B04']:
+                ds = band_datasets[band_name]['ds']
+                for y_start in range(0, height, 1098):
+                    y_stop = min(y_start + 1098, height)
+                    band_array = read_band_window(ds, xoff=0, yoff=y_start, xsize=width, ysize=y_stop - y_start)
+                    self.empty_mask[y_start:y_stop] &= band_array == 0
+
+    def _get_empty_mask(self):
+        """ Pixels where all RGB values equal zero are empty (bands B02, B03, B04). Shape of the original tile. """
+        if self.streaming:
+            return self.empty_mask
+        else:
+            # note self.image has shape: (height, width, channels)
+            rgb = self.image
+            return (rgb[..., 1] == 0) & (rgb[..., 2] == 0) & (rgb[..., 3] == 0)
 
-    def _get_patch_coords(self):
-        img_rows, img_cols = self.image.shape[0:2]  # last dimension corresponds to channels
+    def _get_valid_patch_indices(self):
+        """ Returns the indices of all patches with at least min_valid_fraction valid pixels in the patch center. """
+        if not self.min_valid_fraction and self.aoi_mask is None:
+            return list(self.patch_coords_dict.keys())
 
-        print('img_rows, img_cols:', img_rows, img_cols)
+        valid_mask = ~self.get_invalid_mask(cloud_thresh_perc=self.cloud_thresh_perc)
 
+        patch_indices = []
+        for index in self.patch_coords_dict:
+            # the top-left corner in the padded image corresponds to the top-left corner of the center in the tile
+            y_topleft = self.patch_coords_dict[index]['y_topleft']
+            x_topleft = self.patch_coords_dict[index]['x_topleft']
+            center = valid_mask[y_topleft:y_topleft + self.patch_size_no_border,
+                                x_topleft:x_topleft + self.patch_size_no_border]
+            valid_fraction = np.count_nonzero(center) / center.size
+            # patches without any valid pixel are always skipped
+            if valid_fraction > 0 and valid_fraction >= self.min_valid_fraction:
+                patch_indices.append(index)
+
+        print('number of valid patches: {} / {} (min_valid_fraction={})'.format(
+            len(patch_indices), len(self.patch_coords_dict), self.min_valid_fraction))
+        return patch_indices
+
+    def _open_band_datasets(self):
+        self.band_datasets = open_sentinel2_band_datasets(self.band_paths)
+
+    def _get_patch_grid_shape(self):
+        """ Number of patch rows and columns. The patch index is row * number of columns + column. """
+        img_rows, img_cols = self.image_shape_padded[0:2]  # last dimension corresponds to channels
         rows_tiles = int(math.ceil(img_rows / self.patch_size_no_border))
         cols_tiles = int(math.ceil(img_cols / self.patch_size_no_border))
+        return rows_tiles, cols_tiles
+
+    def _get_patch_coords(self):
+        img_rows, img_cols = self.image_shape_padded[0:2]  # last dimension corresponds to channels
+
+        print('img_rows, img_cols:', img_rows, img_cols)
+
+        rows_tiles, cols_tiles = self._get_patch_grid_shape()
 
         patch_coords_dict = {}
         patch_idx = 0
@@ -80,21 +231,53 @@ class Sentinel2Deploy(Dataset):
 
     def __getitem__(self, index):
 
+        # map the dataset index to the patch index (skipped patches are not predicted)
+        index = self.patch_indices[index]
+
         y_topleft = self.patch_coords_dict[index]['y_topleft']
         x_topleft = self.patch_coords_dict[index]['x_topleft']
 
-        patch = self.image[y_topleft:y_topleft + self.patch_size, x_topleft:x_topleft + self.patch_size, :]
-        # cast to float32
-        patch = patch.astype(np.float32)
+        # patch coordinates refer to the padded image
+        y_start = y_topleft - self.border
+        x_start = x_topleft - self.border
+        height, width = self.image_shape_original[:2]
+
+        if self.streaming:
+            # open the band datasets in the first iteration --> each worker has its own gdal datasets
+            if not hasattr(self, 'band_datasets'):
+                self._open_band_datasets()
+            patch = read_sentinel2_window(band_datasets=self.band_datasets,
+                                          y_start=y_start,
+                                          y_stop=y_start + self.patch_size,
+                                          x_start=x_start,
+                                          x_stop=x_start + self.patch_size,
+                                          height=height, width=width,
+                                          halo=self.halo, channels_last=True)
+        else:
+            patch = self.get_patch(y_start, x_start)
+        if self.input_lat_lon:
+            rows = symmetric_indices(y_start, y_start + self.patch_size, size=height)
+            cols = symmetric_indices(x_start, x_start + self.patch_size, size=width)
+
+        if self.raw_inputs:
+            # uint16 bands as int16 view (same bytes, torch has no uint16 tensors), lat lon are broadcast on the device
+            data_dict = {'inputs': torch.from_numpy(np.ascontiguousarray(patch, dtype=np.uint16).view(np.int16))}
+            if self.input_lat_lon:
+                data_dict['lat'] = torch.from_numpy(self.lat_col[rows, None].astype(np.float32))
+                data_dict['lon'] = torch.from_numpy(self.lon_row[None, cols].astype(np.float32))
+            data_dict['patch_idx'] = index
+            return data_dict
 
         if self.input_lat_lon:
-            lat = self.lat_mask[y_topleft:y_topleft + self.patch_size, x_topleft:x_topleft + self.patch_size][..., None]
-            lon = self.lon_mask[y_topleft:y_topleft + self.patch_size, x_topleft:x_topleft + self.patch_size][..., None]
-            lon_sin = np.sin(2 * np.pi * lon / 360)
-            lon_cos = np.cos(2 * np.pi * lon / 360)
-            inputs = np.concatenate((patch, lat, lon_sin, lon_cos), axis=-1)  # channels last
+            # channels last: 12 bands, lat, sin(lon), cos(lon) (lat is constant per row, lon per column)
+            inputs = np.empty((self.patch_size, self.patch_size, patch.shape[-1] + 3), dtype=np.float32)
+            inputs[..., :-3] = patch
+            inputs[..., -3] = self.lat_col[rows, None]
+            inputs[..., -2] = self.lon_sin_row[None, cols]
+            inputs[..., -1] = self.lon_cos_row[None, cols]
         else:
-            inputs = patch
+            # cast to float32
+            inputs = patch.astype(np.float32)
 
         if self.input_transforms:
             inputs = self.input_transforms(inputs)
@@ -107,10 +290,45 @@ class Sentinel2Deploy(Dataset):
             # convert all numpy arrays to tensor
             data_dict[k] = torch.from_numpy(data_dict[k])
 
+        # patch index to recompose the predictions (see TileRecomposer)
+        data_dict['patch_idx'] = index
+
         return data_dict
 
     def __len__(self):
-        return len(self.patch_coords_dict)
+        return len(self.patch_indices)
+
+    def get_patch(self, y_start, x_start):
+        """
+        Returns the patch with the top-left corner (y_start, x_start) in the original image (may be negative).
+        Out of bounds pixels are mirrored (as np.pad(image, mode='symmetric')) without padding the full image.
+        """
+        height, width = self.image_shape_original[:2]
+        y_stop = y_start + self.patch_size
+        x_stop = x_start + self.patch_size
+        if y_start >= 0 and x_start >= 0 and y_stop <= height and x_stop <= width:
+            return self.image[y_start:y_stop, x_start:x_stop, :]
+        # patches at the tile boundary: mirrored index mapping
+        rows = symmetric_indices(y_start, y_stop, size=height)
+        cols = symmetric_indices(x_start, x_stop, size=width)
+        return self.image[rows[:, None], cols[None, :], :]
+
+    def get_latlon_masks(self):
+        """
+        Returns the lat and lon masks with the shape of the original tile (e.g. to save them as geotif).
+        The masks are contiguous copies (gdal WriteArray does not support the zero strides of broadcast views).
+        """
+        height, width = self.image_shape_original[:2]
+        lat_mask = np.ascontiguousarray(np.broadcast_to(self.lat_col[:, None], (height, width)))
+        lon_mask = np.ascontiguousarray(np.broadcast_to(self.lon_row[None, :], (height, width)))
+        return lat_mask, lon_mask
+
+    def init_recomposer(self, channels=1, out_type=np.float32, memmap_path=None, resume=False):
+        """ Returns a TileRecomposer to write patch predictions incrementally to the original tile shape. """
+        return TileRecomposer(patch_coords_dict=self.patch_coords_dict, patch_size=self.patch_size, border=self.border,
+                              height=self.image_shape_original[0], width=self.image_shape_original[1],
+                              channels=channels, out_type=out_type, memmap_path=memmap_path,
+                              grid_shape=self._get_patch_grid_shape(), resume=resume)
 
     def recompose_patches(self, patches, out_type=np.float32,
                           mask_empty=True, mask_negative=True,
@@ -118,54 +336,71 @@ class Sentinel2Deploy(Dataset):
                           mask_tile_boundary=False):
         """ Recompose image patches or corresponding predictions to the full Sentinel-2 tile shape."""
 
-        # init tile with channels first
-        channels = patches.shape[1]
-        height, width = self.image.shape[0:2]
-        tile = np.full(shape=(channels, height, width), fill_value=np.nan, dtype=out_type)
-
-        for index in range(len(patches)):
-            y_topleft = self.patch_coords_dict[index]['y_topleft']
-            x_topleft = self.patch_coords_dict[index]['x_topleft']
-
-            tile[:, y_topleft+self.border:y_topleft + self.patch_size - self.border,
-                 x_topleft+self.border:x_topleft + self.patch_size - self.border] \
-                = patches[index, :,
-                          self.border:self.patch_size - self.border,
-                          self.border:self.patch_size - self.border]
-
-        # remove padding to return original tile size
-        tile = tile[:, self.border:-self.border, self.border:-self.border]
-
-        # reduce first dimension if single band (e.g. predictions)
-        tile = tile.squeeze()
-
-        # masking
-        tile_masked = tile
+        recomposer = self.init_recomposer(channels=patches.shape[1], out_type=out_type)
+        recomposer.add_patch_grid(patch_indices=self.patch_indices, patches=patches)
+        tile = recomposer.get_tile()
+
+        return self.mask_tile(tile, mask_empty=mask_empty, mask_negative=mask_negative,
+                              mask_clouds=mask_clouds, mask_with_scl=mask_with_scl,
+                              cloud_thresh_perc=cloud_thresh_perc, mask_tile_boundary=mask_tile_boundary)
+
+    def get_invalid_mask(self, mask_empty=True, mask_with_scl=True, mask_clouds=True, cloud_thresh_perc=5,
+                         mask_aoi=True):
+        """
+        Combined mask of the invalid pixels (empty, excluded SCL classes, cloudy, outside the aoi) with the shape of
+        the original tile. The mask is computed once and cached, such that it is shared by all masked outputs
+        (e.g. predictions and std) and the selection of the valid patches.
+        """
+        key = (mask_empty, mask_with_scl, mask_clouds, cloud_thresh_perc, mask_aoi and self.aoi_mask is not None)
+        if not hasattr(self, 'invalid_masks'):
+            self.invalid_masks = {}
+        if key in self.invalid_masks:
+            return self.invalid_masks[key]
+
+        invalid_mask = np.zeros(self.image_shape_original[:2], dtype=bool)
         if mask_empty:
             # pixels where all RGB values equal zero are empty (bands B02, B03, B04)
-            # note self.image has shape: (height, width, channels)
-            invalid_mask = np.sum(self.image[self.border:-self.border, self.border:-self.border, 1:4], axis=-1) == 0
-            print('self.image.shape', self.image.shape)
-            print('invalid_mask.shape', invalid_mask.shape)
-            print('number of empty pixels:', np.sum(invalid_mask))
-            # mask empty image pixels
-            tile_masked[invalid_mask] = np.nan
-
-        if mask_negative:
-            # mask negative values in the recomposed tile (e.g. predictions)
-            tile_masked[tile_masked < 0] = np.nan
-
+            invalid_mask |= self._get_empty_mask()
         if mask_with_scl:
-            # mask snow and cloud (medium and high density). In some cases the probability cloud mask might miss some clouds
-            invalid_mask = np.logical_and(np.isin(self.scl, self.scl_exclude_labels), ~np.isnan(tile_masked))
-            tile_masked[invalid_mask] = np.nan
-
-            ## set not_vegetated and water class to zero canopy height
-            #mask_zero_height = np.logical_and(np.isin(self.scl, self.scl_zero_canopy_height), ~np.isnan(tile_masked))
-            #tile_masked[mask_zero_height] = 0
-
+            # snow and cloud (medium and high density). In some cases the probability cloud mask might miss some clouds
+            # lookup table instead of np.isin (SCL is uint8)
+            scl_lookup = np.zeros(256, dtype=bool)
+            scl_lookup[self.scl_exclude_labels] = True
+            invalid_mask |= scl_lookup[self.scl]
         if mask_clouds:
-            tile_masked[self.cloud > cloud_thresh_perc] = np.nan
+            invalid_mask |= self.cloud > cloud_thresh_perc
+        if mask_aoi and self.aoi_mask is not None:
+            invalid_mask |= ~self.aoi_mask
+
+        print('number of invalid pixels:', np.count_nonzero(invalid_mask))
+        self.invalid_masks[key] = invalid_mask
+        return invalid_mask
+
+    def mask_tile(self, tile, mask_empty=True, mask_negative=True,
+                  mask_clouds=True, mask_with_scl=True, cloud_thresh_perc=5,
+                  mask_tile_boundary=False, mask_aoi=True, block_rows=1098):
+        """
+        Mask a recomposed tile (in place) with the empty pixels, SCL classes, the cloud probability and the aoi.
+        The cached combined invalid mask (see get_invalid_mask) and the negative values are applied in one pass over
+        blocks of rows (no full tile temporaries, e.g. for memory-mapped tiles).
+        """
+
+        invalid_mask = self.get_invalid_mask(mask_empty=mask_empty, mask_with_scl=mask_with_scl,
+                                             mask_clouds=mask_clouds, cloud_thresh_perc=cloud_thresh_perc,
+                                             mask_aoi=mask_aoi)
+        # masking
+        tile_masked = tile
+        for row_start in range(0, tile_masked.shape[0], block_rows):
+            tile_block = tile_masked[row_start:row_start + block_rows]
+            invalid_block = invalid_mask[row_start:row_start + block_rows]
+            if mask_negative:
+                # mask negative values in the recomposed tile (e.g. predictions)
+                invalid_block = invalid_block | (tile_block < 0)
+            tile_block[invalid_block] = np.nan
+
+        ## set not_vegetated and water class to zero canopy height
+        #mask_zero_height = np.logical_and(np.isin(self.scl, self.scl_zero_canopy_height), ~np.isnan(tile_masked))
+        #tile_masked[mask_zero_height] = 0
 
         if mask_tile_boundary:
             # top and bottom rows
@@ -177,3 +412,129 @@ class Sentinel2Deploy(Dataset):
 
         return tile_masked
 
+
+class TileRecomposer:
+    """
+    Recompose patch predictions incrementally to the original Sentinel-2 tile shape (without padding).
+    The center of each patch (without the overlapping border) is written to a preallocated tile as soon as a batch
+    of predictions arrives, such that the patch predictions never need to be held in memory at once.
+    Overlapping centers (last row and column of patches) are overwritten in the order of the patch indices.
+
+    Args:
+        patch_coords_dict (dict): Top-left patch coordinates in the padded image (see Sentinel2Deploy).
+        patch_size (int): Size of square patch.
+        border (int): Border of the patch that is cropped (corresponds to the padding of the image).
+        height (int): Height of the original tile.
+        width (int): Width of the original tile.
+        channels (int): Number of channels per patch (e.g. 1 for predictions).
+        out_type: Data type of the tile.
+        memmap_path (str): Optional path to a .npy file. If set, the tile is a memory-mapped array on disk.
+        grid_shape (tuple): Number of patch rows and columns (needed for add_patch_grid).
+        resume (bool): Option to reopen an existing memory-mapped tile at memmap_path (e.g. see DeployCheckpoint).
+    """
+    def __init__(self, patch_coords_dict, patch_size, border, height, width, channels=1, out_type=np.float32,
+                 memmap_path=None, grid_shape=None, resume=False):
+        self.patch_coords_dict = patch_coords_dict
+        self.grid_shape = grid_shape
+        self.patch_size = patch_size
+        self.border = border
+        self.patch_size_no_border = patch_size - 2 * border
+        self.memmap_path = memmap_path
+
+        # init tile with channels first
+        if self.memmap_path is None:
+            self.tile = np.full(shape=(channels, height, width), fill_value=np.nan, dtype=out_type)
+        elif resume:
+            self.tile = np.load(self.memmap_path, mmap_mode='r+')
+            if self.tile.shape != (channels, height, width) or self.tile.dtype != out_type:
+                raise ValueError("Memory-mapped tile {} has shape {} (expected: {})".format(
+                    self.memmap_path, self.tile.shape, (channels, height, width)))
+        else:
+            self.tile = np.lib.format.open_memmap(self.memmap_path, mode='w+', dtype=out_type,
+                                                  shape=(channels, height, width))
+            self.tile[:] = np.nan
+
+    def add_patches(self, patch_indices, patches):
+        """
+        Args:
+            patch_indices: Iterable of patch indices (keys in patch_coords_dict)
+            patches: Array with shape (batch_size, channels, patch_size, patch_size)
+        """
+        for index, patch in zip(patch_indices, patches):
+            # the top-left corner in the padded image corresponds to the top-left corner of the center in the tile
+            y_topleft = self.patch_coords_dict[int(index)]['y_topleft']
+            x_topleft = self.patch_coords_dict[int(index)]['x_topleft']
+
+            self.tile[:, y_topleft:y_topleft + self.patch_size_no_border,
+                      x_topleft:x_topleft + self.patch_size_no_border] \
+                = patch[:, self.border:self.patch_size - self.border, self.border:self.patch_size - self.border]
+
+    def add_patch_grid(self, patch_indices, patches):
+        """
+        Vectorized version of add_patches for many patches (e.g. all patches of a tile).
+        The patches on the regular grid (not shifted at the bottom and right image border) do not overlap and are
+        written at once by reshaping the patch centers to the tile. Only the shifted last row(s) and column(s) are
+        written per patch (in the order of the patch indices, as in add_patches).
+
+        Args:
+            patch_indices: Iterable of patch indices (keys in patch_coords_dict)
+            patches: Array with shape (num_patches, channels, patch_size, patch_size)
+        """
+        rows, cols = self.grid_shape
+        channels = self.tile.shape[0]
+        s = self.patch_size_no_border
+        patch_indices = np.asarray(patch_indices, dtype=np.int64)
+
+        # patch centers on the grid (rows, cols, channels, s, s)
+        patch_centers = patches[:, :, self.border:self.border + s, self.border:self.border + s]
+        present = np.zeros(rows * cols, dtype=bool)
+        present[patch_indices] = True
+        present = present.reshape(rows, cols)
+        if len(patch_indices) == rows * cols and np.all(patch_indices == np.arange(rows * cols)):
+            # all patches in grid order: view without copy
+            centers = patch_centers.reshape(rows, cols, channels, s, s)
+        else:
+            centers = np.empty((rows * cols, channels, s, s), dtype=self.tile.dtype)
+            centers[patch_indices] = patch_centers
+            centers = centers.reshape(rows, cols, channels, s, s)
+
+        # number of rows and columns on the regular grid (the shifted patches are at the end)
+        y_coords = [self.patch_coords_dict[r * cols]['y_topleft'] for r in range(rows)]
+        x_coords = [self.patch_coords_dict[c]['x_topleft'] for c in range(cols)]
+        num_regular_rows = sum(y == r * s for r, y in enumerate(y_coords))
+        num_regular_cols = sum(x == c * s for c, x in enumerate(x_coords))
+
+        # regular grid: tile[:, r * s + i, c * s + j] = centers[r, c, :, i, j] (only the present patches are written)
+        nr, nc = num_regular_rows, num_regular_cols
+        tile_view = self.tile[:, :nr * s, :nc * s].reshape(channels, nr, s, nc, s)
+        if present[:nr, :nc].all():
+            tile_view[...] = centers[:nr, :nc].transpose(2, 0, 3, 1, 4)
+        else:
+            np.copyto(tile_view, centers[:nr, :nc].transpose(2, 0, 3, 1, 4),
+                      where=present[None, :nr, None, :nc, None])
+
+        # shifted last column(s) of the regular rows, then the shifted last row(s)
+        shifted = [(r, c) for r in range(nr) for c in range(nc, cols)] + \
+                  [(r, c) for r in range(nr, rows) for c in range(cols)]
+        for r, c in shifted:
+            if present[r, c]:
+                self.tile[:, y_coords[r]:y_coords[r] + s, x_coords[c]:x_coords[c] + s] = centers[r, c]
+
+    def get_tile(self):
+        """ Returns the tile. The first dimension is reduced if single band (e.g. predictions). """
+        return self.tile.squeeze(axis=0) if self.tile.shape[0] == 1 else self.tile
+
+    def flush(self):
+        """ Write the changes of a memory-mapped tile to disk. """
+        if self.memmap_path is not None:
+            self.tile.flush()
+
+    def close(self, remove=True):
+        """ Release the tile and remove the memory-mapped file (if any and remove is True). """
+        if self.memmap_path is not None:
+            self.tile.flush()
+            del self.tile
+            if remove and os.path.exists(self.memmap_path):
+                os.remove(self.memmap_path)
+        else:
+            del self.tile
@@ -9,19 +9,25 @@ import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import time
+import threading
+from queue import Queue
 import botocore
 import urllib3
 
 from gchm.models.architectures import Architectures
-from gchm.utils.transforms import Normalize, NormalizeVariance, denormalize
+from gchm.utils.transforms import Normalize, NormalizeVariance, DeviceInputTransform, denormalize
 from gchm.datasets.dataset_sentinel2_deploy import Sentinel2Deploy
-from gchm.utils.gdal_process import save_array_as_geotif
+from gchm.utils.gdal_process import save_array_as_geotif, save_array_as_cog, check_cog_overview_levels, check_scaled_encoding
 from gchm.utils.parser import load_args_from_json, str2bool, str_or_none
 from gchm.utils.aws import download_and_zip_safe_from_aws
+from gchm.utils.file_queue import FileQueue
+from gchm.utils.deploy_checkpoint import DeployCheckpoint, load_checkpoint_config
+from gchm.utils.profiling import StageTimer, timed
+from gchm.utils.band_source import get_band_source
+from gchm.utils.inference import get_device, setup_cpu_threads, prepare_model_for_inference, to_device, \
+    autocast_context
 
 
-DEVICE = torch.device("cuda:0")
-print('DEVICE: ', DEVICE, torch.cuda.get_device_name(0))
 gdal.UseExceptions()
 
 
@@ -33,18 +39,100 @@ def setup_parser():
     parser.add_argument("--deploy_image_path", help="path to Sentinel-2 image .zip file with SAFE format")
     parser.add_argument("--deploy_dir", help="output directory to save predictions")
     parser.add_argument("--filepath_failed_image_paths", help="path to .txt file to write failed deploy_image_path")
+    parser.add_argument("--deploy_image_paths", default=None, type=str_or_none,
+                        help="worker mode: txt file with one image path (or file name in sentinel2_dir) per line or a directory with .zip files. "
+                             "All images are predicted with the models loaded once.")
+    parser.add_argument("--deploy_queue_dir", default=None, type=str_or_none,
+                        help="worker mode: directory of a file queue (pending/running/done/failed) with one image path per job file.")
+    parser.add_argument("--queue_poll_sec", default=30, type=float, help="seconds to wait for new jobs if the queue is empty.")
+    parser.add_argument("--queue_exit_when_empty", type=str2bool, nargs='?', const=True, default=True,
+                        help="if True: the worker stops when no jobs are pending. if False: the worker waits for new jobs.")
+    parser.add_argument("--prefetch_tiles", default=0, type=int,
+                        help="worker mode: number of images that are downloaded and loaded (decoded, resampled) in a background thread "
+                             "while the current image is predicted. The previous image is masked and saved in a writer thread. "
+                             "Memory: up to prefetch_tiles + 2 images (the prepared images, the predicted image and the saved image). "
+                             "The patches are then loaded in the main process (num_workers_deploy=0), because dataloader workers "
+                             "forked while the other threads hold gdal or thread pool locks can deadlock. "
+                             "0: images are processed sequentially.")
     parser.add_argument("--deploy_patch_size", default=512, help="Size of square patch (height=width)", type=int)
+    parser.add_argument("--deploy_border", default=16, type=int,
+                        help="border of the patches in pixels that is cropped before recomposing (overlap between patches is 2 * border)")
+    parser.add_argument("--deploy_config_json", default=None, type=str_or_none,
+                        help="optional json file with a recommended configuration (see gchm/benchmark/benchmark_deploy.py). "
+                             "Its values replace the defaults, arguments set on the command line take precedence.")
     parser.add_argument("--deploy_batch_size", default=2, help="Batch size: Number of patches per batch during prediction (deploy).", type=int)
     parser.add_argument("--num_workers_deploy", default=0, help="number of workers in dataloader", type=int)
+    parser.add_argument("--num_workers_decode", default=1, help="number of threads to decode the Sentinel-2 bands concurrently", type=int)
     parser.add_argument("--num_models", default=1, help="number of models in ensemble (model_dir/model_0)", type=int)
+    parser.add_argument("--ensemble", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: predict with all num_models models in one pass and save the ensemble mean, std and spread. "
+                             "if False: predict with one randomly sampled model.")
     parser.add_argument("--save_latlon_masks", type=str2bool, nargs='?', const=True, default=False,
                         help="if True: save the latlon masks used for prediction as geotif.")
+    parser.add_argument("--device", default=None, type=str_or_none,
+                        help="torch device used for prediction (e.g. 'cuda:0', 'cpu'). If None: uses the GPU if available, else the CPU.")
+    parser.add_argument("--num_threads", default=None, help="number of torch threads for CPU inference (default: torch default)", type=int)
+    parser.add_argument("--num_interop_threads", default=None, help="number of torch inter-op threads for CPU inference", type=int)
+    parser.add_argument("--channels_last", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: model and inputs use the channels_last memory format (faster convolutions on CPU).")
+    parser.add_argument("--bf16", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: forward pass with bfloat16 autocast (e.g. CPUs with AVX512-BF16/AMX).")
+    parser.add_argument("--normalize_on_device", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: patches are loaded as uint16. Normalization, lat lon encoding and the channels first "
+                             "layout are computed per batch on the device (half of the data transfer of float32).")
+    parser.add_argument("--recompose_memmap_dir", default=None, type=str_or_none,
+                        help="optional scratch directory. If set, predictions are recomposed to memory-mapped files instead of RAM.")
+    parser.add_argument("--resume_dir", default=None, type=str_or_none,
+                        help="optional scratch directory for resumable predictions. The recomposed predictions and the predicted "
+                             "patches are checkpointed (memory-mapped), such that a killed run continues with the remaining patches.")
+    parser.add_argument("--checkpoint_sec", default=60, type=float,
+                        help="minimum number of seconds between two checkpoints of the predictions (with --resume_dir).")
+    parser.add_argument("--timing_jsonl", default=None, type=str_or_none,
+                        help="optional jsonl file. Wall time, CPU time and peak RSS per stage are appended as one json line per image "
+                             "(summarize with gchm/benchmark/summarize_deploy_timings.py).")
+    parser.add_argument("--min_valid_fraction", default=0, type=float,
+                        help="patches with a smaller fraction of valid pixels (not empty, cloudy, snow, water or outside the aoi) are not predicted (nan).")
+    parser.add_argument("--aoi_path", default=None, type=str_or_none,
+                        help="optional vector file (e.g. geojson) with the area of interest. Pixels outside are set to nan.")
+    parser.add_argument("--tile_cache_dir", default=None, type=str_or_none,
+                        help="optional cache directory for decoded tiles (memory-mapped 10m band stack, SCL and CLD). "
+                             "Cached tiles are not decoded again (e.g. other finetune_strategy or after a crash).")
+    parser.add_argument("--tile_cache_max_size_gb", default=None, type=float,
+                        help="maximum size of the tile cache. The least recently used tiles are removed.")
+    parser.add_argument("--safe_index_dir", default=None, type=str_or_none,
+                        help="optional directory to save the index of the band members of the SAFE zip files (reused across runs).")
+    parser.add_argument("--out_format", default='gtiff', choices=['gtiff', 'cog'],
+                        help="gtiff: striped geotif. cog: cloud optimized geotif (tiled, with overviews, written block-wise).")
+    parser.add_argument("--out_scaled_type", default=None, type=str_or_none, choices=[None, 'uint8', 'uint16'],
+                        help="cog only: optional scaled integer encoding of the predictions (value = stored * out_scale, nodata = max value).")
+    parser.add_argument("--out_scale", default=0.01, type=float,
+                        help="scale of the integer encoding (e.g. 0.01 for uint16 with cm resolution, 0.25 for uint8).")
+    parser.add_argument("--out_max_value", default=60, type=float,
+                        help="expected maximum canopy height in m. The scaled encoding must represent it without clipping "
+                             "(out_scale * (max value of out_scaled_type - 1) >= out_max_value).")
+    parser.add_argument("--cog_blocksize", default=512, type=int, help="internal tile size of the cloud optimized geotif (multiple of 32, the largest overview level).")
+    parser.add_argument("--streaming", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: patches are read on demand with windowed reads instead of loading the full tile to memory.")
 
     parser.add_argument("--from_aws", type=str2bool, nargs='?', const=True, default=False,
                         help="if True: image is loaded from aws s3 (not for free, needs aws credentials)")
 
     parser.add_argument("--download_from_aws", type=str2bool, nargs='?', const=True, default=False,
                         help="if True: downloads the image first from aws in SAFE format.")
+    parser.add_argument("--download_jitter_sec", default=20, type=float,
+                        help="random delay (up to this number of seconds) before downloading from aws to spread the requests of many workers.")
+    parser.add_argument("--band_source", default=None, type=str_or_none, choices=[None, 's3', 'local'],
+                        help="optional band source: the band files of the image are fetched with concurrent range requests to a local "
+                             "block cache (--band_cache_dir). The image path is then the product prefix (e.g. 'tiles/32/T/MT/2020/6/23/0'). "
+                             "s3: bucket --band_source_root (default: sentinel-s2-l2a) or any S3-compatible store (--s3_endpoint_url). "
+                             "local: directory --band_source_root with the layout of the bucket.")
+    parser.add_argument("--band_source_root", default=None, type=str_or_none, help="bucket name (s3) or directory (local).")
+    parser.add_argument("--s3_endpoint_url", default=None, type=str_or_none, help="optional endpoint of an S3-compatible store.")
+    parser.add_argument("--band_cache_dir", default=None, type=str_or_none, help="directory of the block cache of the band source.")
+    parser.add_argument("--band_cache_max_size_gb", default=None, type=float,
+                        help="maximum size of the band cache. The least recently used band files are removed.")
+    parser.add_argument("--fetch_threads", default=8, type=int, help="number of concurrent range requests of the band source.")
+    parser.add_argument("--fetch_block_mb", default=8, type=float, help="size of the range requests of the band source in MB.")
     parser.add_argument("--remove_image_after_pred", type=str2bool, nargs='?', const=True, default=False,
                         help="if True: deletes the image after saving the prediction.")
     parser.add_argument("--sentinel2_dir", help="directory to save sentinel2 data (temporarily)")
@@ -61,97 +149,322 @@ def setup_parser():
     return parser
 
 
-def predict(model, args, model_weights=None,
-            ds_pred=None, batch_size=1, num_workers=8,
-            train_target_mean=0, train_target_std=1):
+def load_model_args(args, model_id):
+    """
+    Load the args of the trained model model_dir/model_{model_id}/finetune_strategy.
+    The saved args are updated with the deploy args (the deploy args take precedence).
 
-    # convert train statistics to tensor on cpu
-    train_target_mean = torch.tensor(train_target_mean)
-    train_target_std = torch.tensor(train_target_std)
+    Returns:
+        model_args: argparse.Namespace with the merged args and model_dir set to the model directory.
+    """
+    args_dict_deploy = copy.deepcopy(vars(args))
+    model_dir = os.path.join(args.model_dir, "model_{}".format(model_id), args.finetune_strategy)
+    print("Loading args from trained models directory: ", model_dir)
+    args_dict = load_args_from_json(os.path.join(model_dir, 'args.json'))
+    # update args with deploy args
+    args_dict.update(args_dict_deploy)
+    model_args = argparse.Namespace(**args_dict)
+    model_args.model_id = model_id
+    model_args.model_dir = model_dir
 
-    dl_pred = DataLoader(ds_pred, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    # set missing args:
+    for key in ['manual_init', 'freeze_last_mean', 'freeze_last_var', 'geo_shift', 'geo_scale', 'separate_lat_lon']:
+        if not hasattr(model_args, key):
+            setattr(model_args, key, False)
 
-    # load best model weights
-    model.load_state_dict(model_weights)
-    model.eval()
+    if model_args.input_lat_lon:
+        model_args.channels = 15  # 12 sentinel2 bands + 3 channels (lat, sin(lon), cos(lon))
+    return model_args
 
-    # init predictions and estimated standard deviations
-    pred_dict = {'predictions': []}
-    if args.return_variance:
-        pred_dict['std'] = []
 
-    with torch.no_grad():
-        # Note: file=sys.stdout is needed to avoid error logging. per default tqdm writes to sys.stderr
-        for step, data_dict in enumerate(tqdm(dl_pred, ncols=100, desc='pred', file=sys.stdout)):  # for each training step
+def load_train_statistics(model_dir):
+    """ Load the input and target statistics used for normalization during training (default: mean=0, std=1). """
+    if os.path.exists(os.path.join(model_dir, 'train_input_mean.npy')):
+        train_input_mean = np.load(os.path.join(model_dir, 'train_input_mean.npy'))
+        train_input_std = np.load(os.path.join(model_dir, 'train_input_std.npy'))
+    else:
+        train_input_mean, train_input_std = 0, 1
 
-            inputs = data_dict[args.input_key]
-            inputs = inputs.to(DEVICE, non_blocking=True)
+    if os.path.exists(os.path.join(model_dir, 'train_target_mean.npy')):
+        train_target_mean = np.load(os.path.join(model_dir, 'train_target_mean.npy'))
+        train_target_std = np.load(os.path.join(model_dir, 'train_target_std.npy'))
+    else:
+        train_target_mean, train_target_std = 0, 1
 
-            if args.return_variance:
-                predictions, variances = model.forward(inputs)
-                std = torch.sqrt(variances)
-                pred_dict['std'].extend(list(std.cpu()))
-            else:
-                predictions = model.forward(inputs)
-            pred_dict['predictions'].extend(list(predictions.cpu()))
+    print('train_input_mean', train_input_mean)
+    print('train_input_std', train_input_std)
 
-        for key in pred_dict.keys():
-            if pred_dict[key]:
-                pred_dict[key] = torch.stack(pred_dict[key], dim=0)
-                print("val_dict['{}'].shape: ".format(key), pred_dict[key].shape)
+    print('train_target_mean', train_target_mean)
+    print('train_target_std', train_target_std)
+    return train_input_mean, train_input_std, train_target_mean, train_target_std
 
-    # denormalize predictions and targets
-    if args.normalize_targets:
-        pred_dict['predictions'] = denormalize(pred_dict['predictions'], train_target_mean, train_target_std)
-        if args.return_variance:
-            # denormalize the variances by multiplying with the target variance
-            pred_dict['std'] *= train_target_std
 
-    # convert torch tensor to numpy
-    for key in pred_dict.keys():
-        pred_dict[key] = pred_dict[key].data.cpu().numpy()
+def load_model(args, device):
+    """ Build the model architecture and load the weights from the latest checkpoint in args.model_dir. """
+    architecture_collection = Architectures(args=args)
+    net = architecture_collection(args.architecture)(num_outputs=1)
+    net.to(device)  # move model to device
 
-    return pred_dict
+    # Load latest weights from checkpoint file (alternative load best val epoch from best_weights.pt)
+    print('Loading model weights from latest checkpoint ...')
+    checkpoint_path = Path(args.model_dir) / 'checkpoint.pt'
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    net.load_state_dict(checkpoint['model_state_dict'])
+    return net
+
+
+def init_recomposers(ds_pred, keys, memmap_dir=None, checkpoint=None):
+    """
+    Returns a dict with a TileRecomposer (float32) for every key. Optionally memory-mapped in memmap_dir.
+    With a DeployCheckpoint, the recomposers are memory-mapped in the checkpoint directory and the patches that are
+    already done are removed from ds_pred.patch_indices.
+    """
+    if checkpoint is not None:
+        recomposer_dict = checkpoint.init_recomposers(ds_pred, keys=keys)
+        ds_pred.patch_indices = checkpoint.get_remaining(ds_pred.patch_indices)
+        print('number of remaining patches: ', len(ds_pred.patch_indices))
+        return recomposer_dict
+    recomposer_dict = {}
+    for key in keys:
+        memmap_path = None
+        if memmap_dir is not None:
+            if not os.path.exists(memmap_dir):
+                os.makedirs(memmap_dir)
+            memmap_path = os.path.join(memmap_dir, '{}_{}_{}.npy'.format(os.getpid(), id(ds_pred), key))
+        recomposer_dict[key] = ds_pred.init_recomposer(channels=1, out_type=np.float32, memmap_path=memmap_path)
+    return recomposer_dict
 
 
-if __name__ == "__main__":
+def predict(model, args, model_weights=None,
+            ds_pred=None, batch_size=1, num_workers=8,
+            train_target_mean=0, train_target_std=1, device=None, memmap_dir=None, input_device_transform=None,
+            checkpoint=None, timer=None):
+    """
+    Predict all patches of ds_pred and recompose the predictions (and std) incrementally to the full tile.
+    The border-cropped center of every patch is written to a preallocated tile as soon as its batch is predicted.
+
+    Args:
+        memmap_dir (str): Optional directory. If set, the recomposed tiles are memory-mapped .npy files in this directory.
+        input_device_transform (DeviceInputTransform): Optional transform for raw inputs (ds_pred with raw_inputs=True).
+        checkpoint (DeployCheckpoint): Optional checkpoint. The recomposed tiles are memory-mapped in its directory and
+                                       patches predicted by a previous run are skipped.
+        timer (StageTimer): Optional timer for the stages 'dataloader_wait', 'forward' (incl. the transfer to the
+                            device) and 'recompose'.
+
+    Returns:
+        recomposer_dict: dict with TileRecomposer for 'predictions' (and 'std'). Call recomposer.close() when done.
+    """
+
+    if device is None:
+        device = get_device(getattr(args, 'device', None))
+    channels_last = getattr(args, 'channels_last', False)
+    bf16 = getattr(args, 'bf16', False)
 
-    # parse deploy arguments
-    parser = setup_parser()
-    args, unknown = parser.parse_known_args()
+    # convert train statistics to tensor on cpu
+    train_target_mean = torch.tensor(train_target_mean)
+    train_target_std = torch.tensor(train_target_std)
 
-    # sample model id from ensemble
-    args.model_id = np.random.choice(args.num_models)
-    args.model_dir = os.path.join(args.model_dir, "model_{}".format(args.model_id), args.finetune_strategy)
-    print("Sampled model_id: {} out of {} models in ensemble.".format(args.model_id, args.num_models))
-    print("Using args.model_dir: ", args.model_dir)
+    # init recomposed predictions and estimated standard deviations
+    keys = ['predictions', 'std'] if args.return_variance else ['predictions']
+    recomposer_dict = init_recomposers(ds_pred, keys=keys, memmap_dir=memmap_dir, checkpoint=checkpoint)
 
-    args_dict = vars(args)
-    args_dict_deploy = copy.deepcopy(args_dict)
-    # load args from experiment dir with full train set
-    print("Loading args from trained models directory...")
-    args_saved = load_args_from_json(os.path.join(args.model_dir, 'args.json'))
-    # update args with model_dir args
-    args_dict.update(args_saved)
-    # updage args with deploy args
-    args_dict.update(args_dict_deploy)
+    dl_pred = DataLoader(ds_pred, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                         pin_memory=device.type == 'cuda')
 
-    # set missing args:
-    if not hasattr(args, 'manual_init'):
-        args.manual_init = False
-    if not hasattr(args, 'freeze_last_mean'):
-        args.freeze_last_mean = False
-    if not hasattr(args, 'freeze_last_var'):
-        args.freeze_last_var = False
-    if not hasattr(args, 'geo_shift'):
-        args.geo_shift = False
-    if not hasattr(args, 'geo_scale'):
-        args.geo_scale = False
-    if not hasattr(args, 'separate_lat_lon'):
-        args.separate_lat_lon = False
-    print(args_dict)
-
-    # get the file_name used for saving the prediction file
+    # load best model weights
+    if model_weights is not None:
+        model.load_state_dict(model_weights)
+    model = prepare_model_for_inference(model, device=device, channels_last=channels_last)
+
+    num_patches = 0
+    time_forward = 0
+    start = time.time()
+    wait_start = time.perf_counter()
+    with torch.inference_mode():
+        # Note: file=sys.stdout is needed to avoid error logging. per default tqdm writes to sys.stderr
+        for step, data_dict in enumerate(tqdm(dl_pred, ncols=100, desc='pred', file=sys.stdout)):  # for each training step
+
+            if timer is not None:
+                timer.add('dataloader_wait', wall_sec=time.perf_counter() - wait_start)
+
+            with timed(timer, 'forward'):
+                if input_device_transform is not None:
+                    inputs = input_device_transform(data_dict, key=args.input_key)
+                else:
+                    inputs = to_device(data_dict[args.input_key], device=device, channels_last=channels_last)
+
+                start_forward = time.time()
+                with autocast_context(device=device, bf16=bf16):
+                    if args.return_variance:
+                        predictions, variances = model.forward(inputs)
+                    else:
+                        predictions = model.forward(inputs)
+
+                batch_dict = {'predictions': predictions.float().cpu()}
+                if args.return_variance:
+                    batch_dict['std'] = torch.sqrt(variances.float()).cpu()
+                time_forward += time.time() - start_forward
+            num_patches += inputs.shape[0]
+
+            # denormalize predictions and std
+            if args.normalize_targets:
+                batch_dict['predictions'] = denormalize(batch_dict['predictions'], train_target_mean, train_target_std)
+                if args.return_variance:
+                    # denormalize the std by multiplying with the target std
+                    batch_dict['std'] *= train_target_std
+
+            with timed(timer, 'recompose'):
+                # write the patch centers to the recomposed tiles
+                for key in keys:
+                    recomposer_dict[key].add_patches(patch_indices=data_dict['patch_idx'].numpy(),
+                                                     patches=batch_dict[key].numpy())
+                if checkpoint is not None:
+                    checkpoint.update(data_dict['patch_idx'].numpy())
+            wait_start = time.perf_counter()
+
+    if checkpoint is not None:
+        checkpoint.update([], force=True)
+    time_total = time.time() - start
+    print('THROUGHPUT: {} patches in {:.1f}s: {:.2f} patches/s (forward pass only: {:.2f} patches/s)'.format(
+        num_patches, time_total, num_patches / time_total, num_patches / max(time_forward, 1e-9)))
+
+    return recomposer_dict
+
+
+def predict_ensemble(members, args, ds_pred=None, batch_size=1, num_workers=8, device=None, memmap_dir=None,
+                     input_device_transform=None, checkpoint=None, timer=None):
+    """
+    Predict all patches of ds_pred with every model of the ensemble in a single pass over the tile.
+    The dataset must return unnormalized inputs (input_transforms=None), since every member is normalized with its
+    own train statistics on the device. Raw inputs (raw_inputs=True) are decoded with input_device_transform
+    (without normalization).
+
+    The members are combined per pixel with:
+        predictions: mean of the member predictions
+        ensemble_spread: standard deviation of the member predictions
+        std: total standard deviation sqrt(mean(member variances) + ensemble_spread ** 2) (if args.return_variance)
+
+    Args:
+        members (list): list of dicts with 'model', 'args' and the train statistics ('train_input_mean',
+                        'train_input_std', 'train_target_mean', 'train_target_std') of every model.
+        memmap_dir (str): Optional directory. If set, the recomposed tiles are memory-mapped .npy files in this directory.
+        checkpoint (DeployCheckpoint): Optional checkpoint to skip the patches predicted by a previous run (see predict).
+        timer (StageTimer): Optional timer (see predict).
+
+    Returns:
+        recomposer_dict: dict with TileRecomposer for 'predictions', 'std' and 'ensemble_spread'.
+    """
+
+    if device is None:
+        device = get_device(getattr(args, 'device', None))
+    channels_last = getattr(args, 'channels_last', False)
+    bf16 = getattr(args, 'bf16', False)
+
+    for member in members:
+        if member['args'].return_variance != args.return_variance or member['args'].input_lat_lon != args.input_lat_lon:
+            raise ValueError("All models in the ensemble must have the same return_variance and input_lat_lon args.")
+
+    def to_tensor(x, shape):
+        return torch.as_tensor(np.asarray(x), dtype=torch.float32, device=device).reshape(shape)
+
+    # train statistics as tensors on device (broadcast over batch, channels, height, width)
+    stats = []
+    for member in members:
+        member['model'] = prepare_model_for_inference(member['model'], device=device, channels_last=channels_last)
+        stats.append({'input_mean': to_tensor(member['train_input_mean'], (1, -1, 1, 1)),
+                      'input_std': to_tensor(member['train_input_std'], (1, -1, 1, 1)),
+                      'target_mean': to_tensor(member['train_target_mean'], (1, -1, 1, 1)),
+                      'target_std': to_tensor(member['train_target_std'], (1, -1, 1, 1))})
+
+    keys = ['predictions', 'std', 'ensemble_spread'] if args.return_variance else ['predictions', 'ensemble_spread']
+    recomposer_dict = init_recomposers(ds_pred, keys=keys, memmap_dir=memmap_dir, checkpoint=checkpoint)
+
+    dl_pred = DataLoader(ds_pred, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                         pin_memory=device.type == 'cuda')
+
+    num_patches = 0
+    start = time.time()
+    wait_start = time.perf_counter()
+    with torch.inference_mode():
+        # Note: file=sys.stdout is needed to avoid error logging. per default tqdm writes to sys.stderr
+        for step, data_dict in enumerate(tqdm(dl_pred, ncols=100, desc='pred ensemble', file=sys.stdout)):
+
+            if timer is not None:
+                timer.add('dataloader_wait', wall_sec=time.perf_counter() - wait_start)
+
+            with timed(timer, 'forward'):
+                if input_device_transform is not None:
+                    inputs = input_device_transform(data_dict, key=args.input_key)
+                else:
+                    inputs = data_dict[args.input_key].to(device, non_blocking=True)
+
+                member_predictions, member_variances = [], []
+                for member, member_stats in zip(members, stats):
+                    inputs_member = (inputs - member_stats['input_mean']) / member_stats['input_std']
+                    inputs_member = to_device(inputs_member, device=device, channels_last=channels_last)
+
+                    with autocast_context(device=device, bf16=bf16):
+                        if args.return_variance:
+                            predictions, variances = member['model'].forward(inputs_member)
+                        else:
+                            predictions = member['model'].forward(inputs_member)
+
+                    predictions = predictions.float()
+                    if member['args'].normalize_targets:
+                        predictions = denormalize(predictions, member_stats['target_mean'], member_stats['target_std'])
+                    member_predictions.append(predictions)
+
+                    if args.return_variance:
+                        variances = variances.float()
+                        if member['args'].normalize_targets:
+                            variances = variances * member_stats['target_std'] ** 2
+                        member_variances.append(variances)
+
+            member_predictions = torch.stack(member_predictions, dim=0)
+            batch_dict = {'predictions': member_predictions.mean(dim=0),
+                          'ensemble_spread': member_predictions.std(dim=0, unbiased=False)}
+            if args.return_variance:
+                mean_variance = torch.stack(member_variances, dim=0).mean(dim=0)
+                batch_dict['std'] = torch.sqrt(mean_variance + batch_dict['ensemble_spread'] ** 2)
+            num_patches += inputs.shape[0]
+
+            with timed(timer, 'recompose'):
+                # write the patch centers to the recomposed tiles
+                for key in keys:
+                    recomposer_dict[key].add_patches(patch_indices=data_dict['patch_idx'].numpy(),
+                                                     patches=batch_dict[key].cpu().numpy())
+                if checkpoint is not None:
+                    checkpoint.update(data_dict['patch_idx'].numpy())
+            wait_start = time.perf_counter()
+
+    if checkpoint is not None:
+        checkpoint.update([], force=True)
+    time_total = time.time() - start
+    print('THROUGHPUT: {} patches x {} models in {:.1f}s: {:.2f} patches/s'.format(
+        num_patches, len(members), time_total, num_patches / time_total))
+
+    return recomposer_dict
+
+
+def load_deploy_config(config_path):
+    """ Load the recommended deploy args (e.g. deploy_patch_size, deploy_batch_size) from a json file. """
+    config = load_args_from_json(config_path)
+    config = config.get('recommended', config)
+    if config is None:
+        raise ValueError("No recommended configuration in: {}".format(config_path))
+    print('deploy config loaded from {}: {}'.format(config_path, config))
+    return config
+
+
+def log_failed_image_path(args, deploy_image_path):
+    """ Append a failed deploy_image_path to the txt file args.filepath_failed_image_paths. """
+    print("logging failed path to: ", args.filepath_failed_image_paths)
+    with open(args.filepath_failed_image_paths, 'a') as f:
+        f.write('{}\n'.format(deploy_image_path))
+
+
+def get_file_name(args):
+    """ Get the file_name used for saving the prediction file. Sets args.from_aws for aws tile paths. """
     if '.zip' in args.deploy_image_path:
         file_name = os.path.basename(args.deploy_image_path).strip(".zip")
     elif 'tiles/' in args.deploy_image_path:
@@ -161,17 +474,59 @@ if __name__ == "__main__":
     else:
         # the deploy_image_path was set to the filename (e.g. "S2B_MSIL2A_20200807T102559_N0214_R108_T32TMT_20200807T132026")
         file_name = args.deploy_image_path
-
+    return file_name
+
+
+def load_members(args, model_ids, device):
+    """
+    Load the args, train statistics, architecture and weights of the models with model_ids.
+
+    Returns:
+        members: list of dicts with 'model', 'args' and the train statistics of every model.
+    """
+    members = []
+    for model_id in model_ids:
+        model_args = load_model_args(args, model_id)
+        train_input_mean, train_input_std, train_target_mean, train_target_std = load_train_statistics(model_args.model_dir)
+        members.append({'args': model_args,
+                        'model': load_model(model_args, device=device),
+                        'train_input_mean': train_input_mean, 'train_input_std': train_input_std,
+                        'train_target_mean': train_target_mean, 'train_target_std': train_target_std})
+    return members
+
+
+def prepare_image(deploy_image_path, args, members, device, log_failed=True):
+    """
+    Download (optional) and load one Sentinel-2 image for prediction (decoded and resampled bands, valid patches,
+    lat lon). With args.ensemble all members are used, otherwise one randomly sampled member.
+
+    Args:
+        log_failed (bool): if True: images that cannot be downloaded or loaded are logged to
+                           args.filepath_failed_image_paths (a RuntimeError is raised in any case).
+
+    Returns:
+        image_job: dict with the args of the image, 'file_name', the used 'members', the dataset 'ds_pred', the
+                   optional 'checkpoint', 'timer' and 'input_device_transform', the 'start' time and the number of
+                   valid patches of the tile 'num_patches_total'.
+    """
+    start_image = time.time()
+    args = copy.copy(args)
+    args.deploy_image_path = deploy_image_path
+    print('deploy_image_path:', args.deploy_image_path)
+
+    file_name = get_file_name(args)
     print('file_name:', file_name)
+    timer = StageTimer() if args.timing_jsonl is not None else None
 
     # download the sentinel2 images from aws
     if args.download_from_aws:
         print('downloading image from aws... ', file_name)
         try:
-            time.sleep(float(np.random.rand(1)*20))
+            time.sleep(float(np.random.rand(1) * args.download_jitter_sec))
             start = time.time()
-            path_zip_file = download_and_zip_safe_from_aws(image_name=file_name,
-                                                           path_sentinel_2A=args.sentinel2_dir)
+            with timed(timer, 'download'):
+                path_zip_file = download_and_zip_safe_from_aws(image_name=file_name,
+                                                               path_sentinel_2A=args.sentinel2_dir)
             args.deploy_image_path = path_zip_file
             end = time.time()
             print("TIME DOWNLOAD FROM AWS:", time.strftime('%H:%M:%S', time.gmtime(end - start)))
@@ -179,9 +534,8 @@ if __name__ == "__main__":
 
         except RuntimeError:
             # write failed path to txt file
-            print("logging failed path to: ", args.filepath_failed_image_paths)
-            with open(args.filepath_failed_image_paths, 'a') as f:
-                f.write('{}\n'.format(args.deploy_image_path))
+            if log_failed:
+                log_failed_image_path(args, args.deploy_image_path)
             raise RuntimeError("Sentinel-2 image could not be downloaded for: {}".format(args.deploy_image_path))
         except botocore.exceptions.ProxyConnectionError:
             print('Error with proxy connection: botocore.exceptions.ProxyConnectionError')
@@ -190,34 +544,35 @@ if __name__ == "__main__":
             print('Error with proxy connection: urllib3.exceptions.ProxyError')
             sys.exit(222)
 
-    if args.input_lat_lon:
-        args.channels = 15  # 12 sentinel2 bands + 3 channels (lat, sin(lon), cos(lon))
-
-    # ----------------------------------------
-    if not os.path.exists(args.deploy_dir):
-        os.makedirs(args.deploy_dir)
-
-    # Load  train statistics
-    if os.path.exists(os.path.join(args.model_dir, 'train_input_mean.npy')):
-        train_input_mean = np.load(os.path.join(args.model_dir, 'train_input_mean.npy'))
-        train_input_std = np.load(os.path.join(args.model_dir, 'train_input_std.npy'))
-    else:
-        train_input_mean, train_input_std = 0, 1
-
-    if os.path.exists(os.path.join(args.model_dir, 'train_target_mean.npy')):
-        train_target_mean = np.load(os.path.join(args.model_dir, 'train_target_mean.npy'))
-        train_target_std = np.load(os.path.join(args.model_dir, 'train_target_std.npy'))
-    else:
-        train_target_mean, train_target_std = 0, 1
-
-    print('train_input_mean', train_input_mean)
-    print('train_input_std', train_input_std)
-
-    print('train_target_mean', train_target_mean)
-    print('train_target_std', train_target_std)
-
-    # setup input transforms
-    input_transforms = Normalize(mean=train_input_mean, std=train_input_std)
+    checkpoint_dir = os.path.join(args.resume_dir, file_name) if args.resume_dir is not None else None
+    if not args.ensemble:
+        # sample model from ensemble (continue with the model of an interrupted run)
+        checkpoint_config = load_checkpoint_config(checkpoint_dir) if checkpoint_dir is not None else None
+        member_ids = [member['args'].model_id for member in members]
+        if checkpoint_config is not None and checkpoint_config['model_ids'][0] in member_ids:
+            members = [members[member_ids.index(checkpoint_config['model_ids'][0])]]
+        else:
+            members = [members[np.random.choice(len(members))]]
+        print("Sampled model_id: {} out of {} models in ensemble.".format(members[0]['args'].model_id, args.num_models))
+        # continue with the args of the sampled model (e.g. normalize_targets, return_variance, input_lat_lon).
+        # The image path (set by the download) and from_aws (set by get_file_name) belong to this image.
+        image_args = {'deploy_image_path': args.deploy_image_path, 'from_aws': args.from_aws}
+        args = copy.copy(members[0]['args'])
+        vars(args).update(image_args)
+
+    # setup input transforms (the ensemble normalizes the inputs per model on the device)
+    input_transforms, input_device_transform = None, None
+    if args.normalize_on_device:
+        mean, std = (None, None) if args.ensemble else (members[0]['train_input_mean'], members[0]['train_input_std'])
+        input_device_transform = DeviceInputTransform(mean=mean, std=std, device=device,
+                                                      input_lat_lon=args.input_lat_lon,
+                                                      channels_last=args.channels_last)
+    elif not args.ensemble:
+        input_transforms = Normalize(mean=members[0]['train_input_mean'], std=members[0]['train_input_std'])
+
+    band_source = get_band_source(args.band_source, root=args.band_source_root, endpoint_url=args.s3_endpoint_url,
+                                  cache_dir=args.band_cache_dir, block_size_mb=args.fetch_block_mb,
+                                  num_threads=args.fetch_threads, max_size_gb=args.band_cache_max_size_gb)
 
     # create dataset
     try:
@@ -226,38 +581,84 @@ if __name__ == "__main__":
                                   input_transforms=input_transforms,
                                   input_lat_lon=args.input_lat_lon,
                                   patch_size=args.deploy_patch_size,
-                                  border=16,
-                                  from_aws=args.from_aws)
+                                  border=args.deploy_border,
+                                  from_aws=args.from_aws,
+                                  streaming=args.streaming,
+                                  num_workers_decode=args.num_workers_decode,
+                                  min_valid_fraction=args.min_valid_fraction,
+                                  aoi_path=args.aoi_path,
+                                  cache_dir=args.tile_cache_dir,
+                                  cache_max_size_gb=args.tile_cache_max_size_gb,
+                                  safe_index_dir=args.safe_index_dir,
+                                  raw_inputs=args.normalize_on_device,
+                                  timer=timer,
+                                  band_source=band_source)
         end = time.time()
         print("TIME LOADING BANDS:", time.strftime('%H:%M:%S', time.gmtime(end - start)))
     except RuntimeError:
         # write failed path to txt file
-        print("logging failed path to: ", args.filepath_failed_image_paths)
-        with open(args.filepath_failed_image_paths, 'a') as f:
-            f.write('{}\n'.format(args.deploy_image_path))
+        if log_failed:
+            log_failed_image_path(args, args.deploy_image_path)
         raise RuntimeError("Sentinel-2 image could not be loaded from: {}".format(args.deploy_image_path))
 
-    # load model architecture
-    architecture_collection = Architectures(args=args)
-    net = architecture_collection(args.architecture)(num_outputs=1)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        keys = ['predictions', 'std'] if args.return_variance else ['predictions']
+        if args.ensemble:
+            keys.append('ensemble_spread')
+        checkpoint_config = {'model_ids': [member['args'].model_id for member in members],
+                             'finetune_strategy': args.finetune_strategy,
+                             'keys': keys,
+                             'patch_size': args.deploy_patch_size,
+                             'border': args.deploy_border,
+                             'tile_shape': ds_pred.image_shape_original[:2],
+                             'num_patches': len(ds_pred.patch_coords_dict)}
+        checkpoint = DeployCheckpoint(checkpoint_dir=checkpoint_dir, config=checkpoint_config,
+                                      checkpoint_sec=args.checkpoint_sec)
+
+    # number of valid patches of the tile (a resumed checkpoint removes the patches already done from ds_pred)
+    num_patches_total = len(ds_pred)
+
+    return {'args': args, 'file_name': file_name, 'members': members, 'ds_pred': ds_pred, 'checkpoint': checkpoint,
+            'timer': timer, 'input_device_transform': input_device_transform, 'start': start_image,
+            'num_patches_total': num_patches_total}
+
+
+def predict_image(image_job, device):
+    """ Predict all patches of a prepared image (see prepare_image). Returns the recomposer_dict. """
+    args, members, ds_pred = image_job['args'], image_job['members'], image_job['ds_pred']
+    checkpoint, timer = image_job['checkpoint'], image_job['timer']
+    input_device_transform = image_job['input_device_transform']
+
+    if args.ensemble:
+        recomposer_dict = predict_ensemble(members=members, args=args, ds_pred=ds_pred,
+                                           batch_size=args.deploy_batch_size, num_workers=args.num_workers_deploy,
+                                           device=device, memmap_dir=args.recompose_memmap_dir,
+                                           input_device_transform=input_device_transform,
+                                           checkpoint=checkpoint, timer=timer)
+    else:
+        recomposer_dict = predict(model=members[0]['model'], args=args,
+                                  ds_pred=ds_pred, batch_size=args.deploy_batch_size, num_workers=args.num_workers_deploy,
+                                  train_target_mean=members[0]['train_target_mean'],
+                                  train_target_std=members[0]['train_target_std'],
+                                  device=device, memmap_dir=args.recompose_memmap_dir,
+                                  input_device_transform=input_device_transform,
+                                  checkpoint=checkpoint, timer=timer)
 
-    net.cuda()  # move model to GPU
+    return recomposer_dict
 
-    # Load latest weights from checkpoint file (alternative load best val epoch from best_weights.pt)
-    print('Loading model weights from latest checkpoint ...')
-    checkpoint_path = Path(args.model_dir) / 'checkpoint.pt'
-    checkpoint = torch.load(checkpoint_path)
-    model_weights = checkpoint['model_state_dict']
 
-    pred_dict = predict(model=net, args=args, model_weights=model_weights,
-                        ds_pred=ds_pred, batch_size=args.deploy_batch_size, num_workers=args.num_workers_deploy,
-                        train_target_mean=train_target_mean, train_target_std=train_target_std)
+def save_predictions(image_job, recomposer_dict):
+    """ Mask the recomposed tiles and save them as geotif in args.deploy_dir (releases the recomposers). """
+    args, ds_pred, file_name = image_job['args'], image_job['ds_pred'], image_job['file_name']
+    checkpoint, timer = image_job['checkpoint'], image_job['timer']
 
-    # recompose predictions and variances
+    # mask recomposed predictions and variances
     recomposed_tiles = {}
-    for k in pred_dict:
-        print('recomposing {} ...'.format(k))
-        recomposed_tiles[k] = ds_pred.recompose_patches(pred_dict[k], out_type=np.float32)
+    for k in recomposer_dict:
+        print('masking {} ...'.format(k))
+        with timed(timer, 'mask'):
+            recomposed_tiles[k] = ds_pred.mask_tile(recomposer_dict[k].get_tile())
         print(recomposed_tiles[k].shape)
 
         if '.zip' in args.deploy_image_path:
@@ -265,23 +666,283 @@ if __name__ == "__main__":
         else:
             tif_path = os.path.join(args.deploy_dir, file_name + '{}.tif'.format(k))
 
-        save_array_as_geotif(out_path=tif_path,
-                             array=recomposed_tiles[k],
-                             tile_info=ds_pred.tile_info)
+        with timed(timer, 'write'):
+            if args.out_format == 'cog':
+                save_array_as_cog(out_path=tif_path,
+                                  array=recomposed_tiles[k],
+                                  tile_info=ds_pred.tile_info,
+                                  out_type=args.out_scaled_type,
+                                  scale=args.out_scale if args.out_scaled_type is not None else None,
+                                  blocksize=args.cog_blocksize)
+            else:
+                save_array_as_geotif(out_path=tif_path,
+                                     array=recomposed_tiles[k],
+                                     tile_info=ds_pred.tile_info)
+        del recomposed_tiles[k]
+        # the checkpoint is kept until all outputs are saved
+        recomposer_dict[k].close(remove=checkpoint is None)
 
     if args.save_latlon_masks:
+        lat_mask, lon_mask = ds_pred.get_latlon_masks()
         # save lat mask
         tif_path = os.path.join(args.deploy_dir, file_name + '{}.tif'.format('lat'))
         save_array_as_geotif(out_path=tif_path,
-                            array=ds_pred.lat_mask[ds_pred.border:-ds_pred.border, ds_pred.border:-ds_pred.border],
+                            array=lat_mask,
                             tile_info=ds_pred.tile_info)
         # save lon mask
         tif_path = os.path.join(args.deploy_dir, file_name + '{}.tif'.format('lon'))
         save_array_as_geotif(out_path=tif_path,
-                            array=ds_pred.lon_mask[ds_pred.border:-ds_pred.border, ds_pred.border:-ds_pred.border],
+                            array=lon_mask,
                             tile_info=ds_pred.tile_info)
 
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if timer is not None:
+        timer.write_jsonl(args.timing_jsonl, file_name=file_name, deploy_image_path=args.deploy_image_path,
+                          num_patches=image_job['num_patches_total'], num_patches_predicted=len(ds_pred),
+                          num_patches_resumed=image_job['num_patches_total'] - len(ds_pred),
+                          num_models=len(image_job['members']),
+                          patch_size=args.deploy_patch_size,
+                          batch_size=args.deploy_batch_size, time=time.time())
+
     if args.remove_image_after_pred:
         print('REMOVING IMAGE DATA: ', args.deploy_image_path)
         os.remove(args.deploy_image_path)
 
+
+def deploy_image(deploy_image_path, args, members, device, log_failed=True):
+    """
+    Predict one Sentinel-2 image with the loaded models and save the predictions as geotif in args.deploy_dir.
+    With args.ensemble all members are used, otherwise one randomly sampled member.
+
+    Args:
+        log_failed (bool): if True: images that cannot be downloaded or loaded are logged to
+                           args.filepath_failed_image_paths (a RuntimeError is raised in any case).
+    """
+    image_job = prepare_image(deploy_image_path, args=args, members=members, device=device, log_failed=log_failed)
+    recomposer_dict = predict_image(image_job, device=device)
+    save_predictions(image_job, recomposer_dict)
+
+
+def resolve_image_path(image_path, args):
+    """ Image file names (e.g. from a txt file) are joined with args.sentinel2_dir unless they are downloaded from aws. """
+    if args.download_from_aws or args.band_source is not None or args.sentinel2_dir is None \
+            or os.path.isabs(image_path) or os.path.exists(image_path):
+        return image_path
+    return os.path.join(args.sentinel2_dir, image_path)
+
+
+def read_image_paths(deploy_image_paths):
+    """ Returns the image paths listed in a txt file (one per line) or the .zip files in a directory. """
+    if os.path.isdir(deploy_image_paths):
+        return [os.path.join(deploy_image_paths, f) for f in sorted(os.listdir(deploy_image_paths)) if f.endswith('.zip')]
+    with open(deploy_image_paths, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def iterate_jobs(args, file_queue=None):
+    """
+    Yields (job_name, image_path) of the images to predict: claimed from the file_queue (job_name is the name of the
+    job file) or read from args.deploy_image_paths (job_name is None).
+    """
+    if file_queue is not None:
+        while True:
+            job_name, image_path = file_queue.claim()
+            if job_name is None:
+                if args.queue_exit_when_empty:
+                    return
+                time.sleep(args.queue_poll_sec)
+                continue
+            print("*************************************")
+            print("job: {} ({} pending)".format(job_name, len(file_queue)))
+            yield job_name, image_path
+    else:
+        image_paths = read_image_paths(args.deploy_image_paths)
+        for count, image_path in enumerate(image_paths):
+            print("*************************************")
+            print("tile image: {} / {}".format(count + 1, len(image_paths)))
+            yield None, image_path
+
+
+def run_pipeline(jobs, args, members, device, complete_job):
+    """
+    Producer/consumer pipeline over the images: a loader thread prepares the next args.prefetch_tiles images
+    (download, decode, resample, see prepare_image) while the current image is predicted on the device, and a writer
+    thread masks and saves the previous image. The loader waits for a free slot before preparing an image and the
+    current image is handed to the writer when the previous image is saved, such that at most prefetch_tiles + 2
+    images are in memory (prefetch_tiles prepared images, the current image and the image that is saved).
+    The patches are loaded without dataloader workers (args.num_workers_deploy=0, see --prefetch_tiles).
+
+    Args:
+        jobs: Iterable of (job_name, image_path) (see iterate_jobs).
+        complete_job: Function called with (job_name, image_path, error) when an image is saved or failed.
+    """
+    prepared = Queue(maxsize=args.prefetch_tiles)
+    to_write = Queue()
+    slots = threading.Semaphore(args.prefetch_tiles)
+    # released by the writer when an image is saved (one image at a time is handed to the writer)
+    write_slot = threading.Semaphore(1)
+
+    def load():
+        try:
+            for job_name, image_path in jobs:
+                slots.acquire()
+                try:
+                    image_job = prepare_image(resolve_image_path(image_path, args), args=args, members=members,
+                                              device=device, log_failed=False)
+                    prepared.put((job_name, image_path, image_job, None))
+                except Exception as e:
+                    prepared.put((job_name, image_path, None, e))
+        except BaseException as e:
+            # e.g. SystemExit after a proxy error: stop the worker
+            prepared.put((None, None, None, e))
+            return
+        prepared.put(None)
+
+    def write():
+        while True:
+            item = to_write.get()
+            if item is None:
+                return
+            job_name, image_path, image_job, recomposer_dict = item
+            error = None
+            try:
+                save_predictions(image_job, recomposer_dict)
+                print("TIME IMAGE:", time.strftime('%H:%M:%S', time.gmtime(time.time() - image_job['start'])))
+            except Exception as e:
+                error = e
+            # release the image before the next image is handed to the writer
+            item = image_job = recomposer_dict = None
+            write_slot.release()
+            complete_job(job_name, image_path, error)
+
+    loader_thread = threading.Thread(target=load, daemon=True)
+    writer_thread = threading.Thread(target=write, daemon=True)
+    loader_thread.start()
+    writer_thread.start()
+
+    fatal_error = None
+    while True:
+        wait_start = time.perf_counter()
+        item = prepared.get()
+        if item is None:
+            break
+        slots.release()
+        job_name, image_path, image_job, error = item
+        item = None
+        if error is not None and not isinstance(error, Exception):
+            fatal_error = error
+            break
+        if error is not None:
+            complete_job(job_name, image_path, error)
+            continue
+        if image_job['timer'] is not None:
+            image_job['timer'].add('prefetch_wait', wall_sec=time.perf_counter() - wait_start)
+        try:
+            recomposer_dict = predict_image(image_job, device=device)
+        except Exception as e:
+            complete_job(job_name, image_path, e)
+            continue
+        # wait until the previous image is saved (the current image stays in memory meanwhile)
+        write_slot.acquire()
+        to_write.put((job_name, image_path, image_job, recomposer_dict))
+        image_job = recomposer_dict = None
+
+    to_write.put(None)
+    writer_thread.join()
+    if fatal_error is not None:
+        raise fatal_error
+
+
+def run_worker(args, members, device):
+    """
+    Predict many images back to back with the models loaded once.
+    The images are read from args.deploy_image_paths (txt file or directory) or claimed from the file queue
+    args.deploy_queue_dir (see gchm.utils.file_queue.FileQueue). Failed images are logged and skipped.
+    With args.prefetch_tiles > 0, loading, prediction and saving of consecutive images overlap (see run_pipeline).
+    """
+    file_queue = FileQueue(args.deploy_queue_dir) if args.deploy_queue_dir is not None else None
+    results = []
+    lock = threading.Lock()
+
+    def complete_job(job_name, image_path, error):
+        with lock:
+            if error is not None:
+                # write failed path to txt file and continue with the next image
+                log_failed_image_path(args, image_path)
+                print('FAILED: {}: {}'.format(image_path, error))
+            if file_queue is not None:
+                file_queue.complete(job_name, success=error is None)
+            results.append(error is None)
+
+    jobs = iterate_jobs(args, file_queue=file_queue)
+    if args.prefetch_tiles > 0:
+        run_pipeline(jobs, args=args, members=members, device=device, complete_job=complete_job)
+    else:
+        for job_name, image_path in jobs:
+            start = time.time()
+            try:
+                deploy_image(resolve_image_path(image_path, args), args=args, members=members, device=device,
+                             log_failed=False)
+            except Exception as e:
+                complete_job(job_name, image_path, e)
+                continue
+            print("TIME IMAGE:", time.strftime('%H:%M:%S', time.gmtime(time.time() - start)))
+            complete_job(job_name, image_path, None)
+
+    print("WORKER DONE: {} images processed, {} failed.".format(len(results), results.count(False)))
+
+
+if __name__ == "__main__":
+
+    # parse deploy arguments
+    parser = setup_parser()
+    args, unknown = parser.parse_known_args()
+    if args.deploy_config_json is not None:
+        # the config replaces the defaults, such that explicitly set arguments are kept
+        parser.set_defaults(**load_deploy_config(args.deploy_config_json))
+        args, unknown = parser.parse_known_args()
+    if args.deploy_patch_size <= 2 * args.deploy_border:
+        raise ValueError("deploy_patch_size ({}) must be larger than 2 * deploy_border ({}).".format(
+            args.deploy_patch_size, args.deploy_border))
+    if args.out_format == 'cog':
+        check_cog_overview_levels(args.cog_blocksize)
+    if args.out_scaled_type is not None:
+        if args.out_format != 'cog':
+            raise ValueError("out_scaled_type ({}) is only supported with out_format='cog' (out_format: {})."
+                             .format(args.out_scaled_type, args.out_format))
+        check_scaled_encoding(args.out_scaled_type, scale=args.out_scale, max_value=args.out_max_value)
+    worker_mode = args.deploy_image_paths is not None or args.deploy_queue_dir is not None
+    if worker_mode and args.prefetch_tiles > 0 and args.num_workers_deploy > 0:
+        # no forked dataloader workers while the loader and writer threads run (see --prefetch_tiles). The dataset
+        # holds the tile and gdal datasets, such that spawn or forkserver workers are no option either.
+        print('prefetch_tiles > 0: num_workers_deploy is set from {} to 0.'.format(args.num_workers_deploy))
+        args.num_workers_deploy = 0
+
+    if args.ensemble or worker_mode:
+        # the worker keeps all models loaded and samples one model per image (if not args.ensemble)
+        model_ids = list(range(args.num_models))
+        print("Loading all {} models in ensemble.".format(args.num_models))
+    else:
+        # sample model id from ensemble
+        model_ids = [np.random.choice(args.num_models)]
+
+    if not os.path.exists(args.deploy_dir):
+        os.makedirs(args.deploy_dir)
+
+    # setup device (GPU or CPU)
+    device = get_device(args.device)
+    if device.type == 'cpu':
+        setup_cpu_threads(num_threads=args.num_threads, num_interop_threads=args.num_interop_threads)
+
+    # load args, train statistics and model weights (in worker mode, every image uses the args of its sampled model)
+    members = load_members(args, model_ids=model_ids, device=device)
+    args = members[0]['args']
+    print("Using args.model_dir: ", args.model_dir)
+    print(vars(args))
+
+    if worker_mode:
+        run_worker(args, members=members, device=device)
+    else:
+        deploy_image(args.deploy_image_path, args=args, members=members, device=device)
@@ -0,0 +1,28 @@
+import argparse
+
+from gchm.utils.memmap_store import export_h5_to_memmap, MEMMAP_FIELDS, get_memmap_path
+from gchm.utils.parser import str_or_none
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths_h5", nargs='+', help="h5 files with patches (e.g. REGION_train.h5 REGION_val.h5)")
+    parser.add_argument("--out_dir", required=True, help="directory of the memmap stores (e.g. on a local NVMe disk)")
+    parser.add_argument("--fields", default=list(MEMMAP_FIELDS), nargs='+', help="arrays to export")
+    parser.add_argument("--chunk_size", default=65536, type=int, help="number of patches copied at a time")
+    parser.add_argument("--h5_index_dir", default=None, type=str_or_none,
+                        help="directory of the sidecar indices of the h5 files (default: next to the h5 files)")
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    for path_h5 in args.paths_h5:
+        out_path = get_memmap_path(path_h5, memmap_dir=args.out_dir)
+        print('exporting {} to {}'.format(path_h5, out_path))
+        meta = export_h5_to_memmap(path_h5, out_dir=out_path, fields=args.fields, chunk_size=args.chunk_size,
+                                   index_dir=args.h5_index_dir)
+        print('number of samples: ', meta['num_samples'])
@@ -1,20 +1,32 @@
 import os
-import sys
+import argparse
 
 from gchm.utils.h5_utils import merge_h5_datasets, load_paths_from_dicretory
+from gchm.utils.parser import str2bool
 
 
-if __name__ == "__main__":
+def setup_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_h5_dir_parts", help="directory with a subdirectory of h5 part files per split")
+    parser.add_argument("out_h5_dir", help="directory of the merged h5 files GLOBAL_GEDI_{split}.h5")
+    parser.add_argument("--splits", default=["val", "train"], nargs='+')
+    # codec of the merged files (the part files are decompressed and compressed again with these filters)
+    parser.add_argument("--num_samples_chunk", default=64, type=int)
+    parser.add_argument("--complib", default='blosc:zstd', help="e.g. blosc:lz4, blosc:zlib, blosc:zstd, zlib")
+    parser.add_argument("--complevel", default=5, type=int)
+    parser.add_argument("--bitshuffle", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("--shuffle", type=str2bool, nargs='?', const=True, default=True)
+    # streaming merge
+    parser.add_argument("--num_workers", default=8, type=int, help="number of processes reading the part files")
+    parser.add_argument("--slice_size", default=8192, type=int, help="number of patches copied at a time")
+    parser.add_argument("--blosc_threads", default=None, type=int, help="number of threads to compress the output")
+    return parser
+
 
-    # set directory paths
-    in_h5_dir_parts = sys.argv[1]
-    out_h5_dir = sys.argv[2]
+if __name__ == "__main__":
 
-    num_samples_chunk = 64
-    complib = 'blosc:zstd'  # blosc:lz4   blosc:zlib   blosc:zstd
-    complevel = 5
-    bitshuffle = 0
-    shuffle = 1
+    parser = setup_parser()
+    args = parser.parse_args()
 
     # total number of samples in merged file
     expectedrows_dict = {'train': 622311092,
@@ -22,24 +34,24 @@ if __name__ == "__main__":
 
     # ---------------------------------
 
-    print('out_h5_dir', out_h5_dir)
-    if not os.path.exists(out_h5_dir):
-        os.makedirs(out_h5_dir)
+    print('out_h5_dir', args.out_h5_dir)
+    if not os.path.exists(args.out_h5_dir):
+        os.makedirs(args.out_h5_dir)
 
     # merge h5 files per split
-    for split in ["val", "train"]:
+    for split in args.splits:
         print("Merging files for split: {}".format(split))
 
         # get path to split subdirectory
-        in_h5_dir_parts_split = os.path.join(in_h5_dir_parts, split)
+        in_h5_dir_parts_split = os.path.join(args.in_h5_dir_parts, split)
         print("Loading h5 files from path: {}".format(in_h5_dir_parts_split))
 
-        # load all h5 paths in subdirectory
-        paths_h5_files = load_paths_from_dicretory(dir=in_h5_dir_parts_split)
+        # load all h5 paths in subdirectory (sorted, such that an interrupted merge can be resumed)
+        paths_h5_files = sorted(load_paths_from_dicretory(dir=in_h5_dir_parts_split))
         print("Number of h5 part files that are merged: {}".format(len(paths_h5_files)))
 
         # output path
-        out_h5_path = os.path.join(out_h5_dir, "GLOBAL_GEDI_{}.h5".format(split))
+        out_h5_path = os.path.join(args.out_h5_dir, "GLOBAL_GEDI_{}.h5".format(split))
         print("Writing to output h5 file: {}".format(out_h5_path))
 
         merge_h5_datasets(paths_h5_files=paths_h5_files,
@@ -48,9 +60,9 @@ if __name__ == "__main__":
                           patch_size=15, channels=12,
                           ignore_datasets=('image_date', 'image_name'),
                           max_num_samples_per_tile=None,
-                          expectedrows=expectedrows_dict[split],
-                          complib=complib, complevel=complevel,
-                          subgroups=None, num_samples_chunk=num_samples_chunk,
-                          bitshuffle=bitshuffle, shuffle=shuffle)
-
-
+                          expectedrows=expectedrows_dict.get(split, 1000),
+                          complib=args.complib, complevel=args.complevel,
+                          subgroups=None, num_samples_chunk=args.num_samples_chunk,
+                          bitshuffle=args.bitshuffle, shuffle=args.shuffle,
+                          num_workers=args.num_workers, slice_size=args.slice_size,
+                          blosc_threads=args.blosc_threads)
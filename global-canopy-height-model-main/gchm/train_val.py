@@ -6,13 +6,14 @@ import shutil
 import wandb
 
 from gchm.datasets.dataset_sentinel2 import make_concat_dataset
-from gchm.trainer import Trainer
+from gchm.trainer import Trainer, DEVICE
 from gchm.models.architectures import Architectures
 from gchm.utils.parser import setup_parser, save_args_to_json, set_finetune_strategy_params
 from gchm.utils.loss import get_metric_lookup_dict, SampleWeightedLoss, ShrinkageLoss
 from gchm.utils.preprocessing import compute_train_mean_std
-from gchm.utils.transforms import Normalize, NormalizeVariance
+from gchm.utils.transforms import Normalize, NormalizeVariance, DeviceInputTransform
 from gchm.utils.h5_utils import load_paths_from_dicretory, filter_paths_by_tile_names
+from gchm.utils.memmap_store import get_memmap_path
 
 
 def run_test(dataset, model_weights, out_dir, trainer):
@@ -96,6 +97,12 @@ if __name__ == "__main__":
         paths_h5_train = filter_paths_by_tile_names(paths=paths_h5, tile_names=args.train_tiles)
         paths_h5_val = filter_paths_by_tile_names(paths=paths_h5, tile_names=args.val_tiles)
 
+    if args.data_format == 'memmap':
+        # load the uncompressed memmap stores of the h5 files (see gchm/preprocess/export_h5_to_memmap.py)
+        memmap_dir = args.memmap_dir if args.memmap_dir is not None else args.h5_dir
+        paths_h5_train = [get_memmap_path(p, memmap_dir=memmap_dir) for p in paths_h5_train]
+        paths_h5_val = [get_memmap_path(p, memmap_dir=memmap_dir) for p in paths_h5_val]
+
     print('len(paths_h5_train): ', len(paths_h5_train))
     print('len(paths_h5_val): ', len(paths_h5_val))
 
@@ -108,7 +115,8 @@ if __name__ == "__main__":
         metrics_lookup['shrinkage'] = ShrinkageLoss()
 
     # make raw train dataset to compute statistics for normalization (inputs, targets)
-    ds_train_raw = make_concat_dataset(paths_h5=paths_h5_train)
+    ds_train_raw = make_concat_dataset(paths_h5=paths_h5_train, index_dir=args.h5_index_dir,
+                                       data_format=args.data_format)
 
     if args.data_stats_dir is None:
         args.data_stats_dir = args.out_dir
@@ -135,7 +143,14 @@ if __name__ == "__main__":
     np.save(os.path.join(args.out_dir, 'train_input_mean.npy'), train_input_mean)
     np.save(os.path.join(args.out_dir, 'train_input_std.npy'), train_input_std)
 
-    input_transforms = Normalize(mean=train_input_mean, std=train_input_std)
+    if args.normalize_on_device:
+        # the datasets return the raw uint16 inputs, which are normalized per batch on the device
+        input_transforms = None
+        input_device_transform = DeviceInputTransform(mean=train_input_mean, std=train_input_std, device=DEVICE,
+                                                      input_lat_lon=args.input_lat_lon)
+    else:
+        input_transforms = Normalize(mean=train_input_mean, std=train_input_std)
+        input_device_transform = None
 
     # target statistics and normalization
     if args.normalize_targets:
@@ -184,7 +199,11 @@ if __name__ == "__main__":
                                        input_lat_lon=args.input_lat_lon,
                                        use_cloud_free=args.use_cloud_free,
                                        path_bin_weights=path_bin_weights,
-                                       weight_key=args.weight_key)
+                                       weight_key=args.weight_key,
+                                       raw_inputs=args.normalize_on_device,
+                                       index_dir=args.h5_index_dir,
+                                       chunk_cache_mb=args.h5_chunk_cache_mb,
+                                       data_format=args.data_format)
 
         print('len(ds_train): ', len(ds_train))
     else:
@@ -197,7 +216,11 @@ if __name__ == "__main__":
                                  input_lat_lon=args.input_lat_lon,
                                  use_cloud_free=args.use_cloud_free,
                                  path_bin_weights=path_bin_weights,
-                                 weight_key=args.weight_key)
+                                 weight_key=args.weight_key,
+                                 raw_inputs=args.normalize_on_device,
+                                 index_dir=args.h5_index_dir,
+                                 chunk_cache_mb=args.h5_chunk_cache_mb,
+                                 data_format=args.data_format)
 
 
     print('len(ds_val):   ', len(ds_val))
@@ -213,7 +236,7 @@ if __name__ == "__main__":
     architecture_collection = Architectures(args=args)
     net = architecture_collection(args.architecture)(num_outputs=1)
 
-    net.cuda()  # move model to GPU
+    net.to(DEVICE)  # move model to GPU (or CPU if no GPU is available)
 
     # save arguments
     save_args_to_json(file_path=os.path.join(args.out_dir, 'args.json'), args=args)
@@ -225,7 +248,8 @@ if __name__ == "__main__":
                       metrics_lookup=metrics_lookup,
                       train_input_mean=train_input_mean, train_input_std=train_input_std,
                       train_target_mean=train_target_mean, train_target_std=train_target_std,
-                      sample_weighted_loss=sample_weighted_loss)
+                      sample_weighted_loss=sample_weighted_loss,
+                      input_device_transform=input_device_transform)
 
     # --- train model ---
     if args.max_grad_norm:
@@ -243,7 +267,7 @@ if __name__ == "__main__":
 
     # Load latest weights from checkpoint file (alternative load best val epoch from best_weights.pt)
     print('Loading model weights from latest checkpoint ...')
-    checkpoint = torch.load(trainer.checkpoint_path)
+    checkpoint = torch.load(trainer.checkpoint_path, map_location=DEVICE)
     model_weights = checkpoint['model_state_dict']
 
     # --- test model ---
@@ -9,11 +9,12 @@ import wandb
 
 from gchm.utils.transforms import denormalize
 from gchm.utils.loss import filter_nans_from_tensors, get_classification_metrics_lookup
-from gchm.utils.sampler import SliceBatchSampler, SubsetSequentialSampler
+from gchm.utils.sampler import SliceBatchSampler, SubsetSequentialSampler, ChunkShuffleLoader
+from gchm.utils.inference import get_device
+from gchm.datasets.dataset_sentinel2 import ChunkDataset
 
 
-DEVICE = torch.device("cuda:0")
-print('DEVICE: ', DEVICE, torch.cuda.get_device_name(0))
+DEVICE = get_device()
 INF = torch.tensor(float('-inf')).to(DEVICE)
 NAN = torch.tensor(float('nan')).to(DEVICE)
 
@@ -38,7 +39,7 @@ class Trainer:
                  metrics_lookup,
                  train_input_mean, train_input_std,
                  train_target_mean, train_target_std,
-                 sample_weighted_loss=None):
+                 sample_weighted_loss=None, input_device_transform=None):
 
         print('DEVICE: ', DEVICE)
 
@@ -59,6 +60,8 @@ class Trainer:
         self.train_target_std = torch.tensor(train_target_std).to(DEVICE)
 
         self.sample_weighted_loss = sample_weighted_loss
+        # optional DeviceInputTransform for raw (uint16) inputs that are normalized on the device
+        self.input_device_transform = input_device_transform
         
         self.classification_loss_names = list(get_classification_metrics_lookup().keys())  # to check if targets need to be converted to long()
         
@@ -75,6 +78,12 @@ class Trainer:
 
         self.scheduler = self._setup_scheduler()
 
+    def _get_inputs(self, data_dict):
+        """ Returns the inputs of a batch on DEVICE (decoded and normalized on the device for raw inputs). """
+        if self.input_device_transform is not None:
+            return self.input_device_transform(data_dict, key=self.args.input_key)
+        return data_dict[self.args.input_key].to(DEVICE, non_blocking=True)
+
     def _setup_optimizer(self):
         #if self.args.freeze_features:
         #    params_to_optimize = list(self.model.predictions.parameters()) + list( self.model.variances.parameters())
@@ -152,6 +161,18 @@ class Trainer:
                                                           batch_size=self.args.batch_size,
                                                           drop_last=False),
                                 num_workers=self.args.num_workers, pin_memory=True)
+
+        elif self.args.custom_sampler == 'ChunkShuffle':
+            # reads every h5 chunk once per epoch (in random order) and mixes the samples of many chunks in a buffer
+            dl_train = ChunkShuffleLoader(chunk_dataset=ChunkDataset(self.ds_train),
+                                          batch_size=self.args.batch_size,
+                                          buffer_size=self.args.shuffle_buffer_size,
+                                          num_workers=self.args.num_workers, pin_memory=True)
+
+            dl_val = ChunkShuffleLoader(chunk_dataset=ChunkDataset(self.ds_val),
+                                        batch_size=self.args.batch_size,
+                                        buffer_size=self.args.shuffle_buffer_size,
+                                        num_workers=self.args.num_workers, pin_memory=True)
         else:
             raise(ValueError, "This custom sampler type is not implemented: ", self.args.custom_sampler)
 
@@ -326,8 +347,8 @@ class Trainer:
                     if step == self.args.iterations_per_epoch:
                         break
 
-                    inputs, labels = data_dict[self.args.input_key], data_dict[self.args.label_mean_key]
-                    inputs, labels = inputs.to(DEVICE, non_blocking=True), labels.to(DEVICE, non_blocking=True)
+                    inputs, labels = self._get_inputs(data_dict), data_dict[self.args.label_mean_key]
+                    labels = labels.to(DEVICE, non_blocking=True)
                     
                     # do not compute grads for input (should reduce the graph and speed up training when freeze_features=True)
                     inputs.requires_grad_(False)
@@ -485,8 +506,7 @@ class Trainer:
                     if step == num_iterations:
                         break
 
-                    inputs, labels = data_dict[self.args.input_key], data_dict[self.args.label_mean_key]
-                    inputs = inputs.to(DEVICE, non_blocking=True)
+                    inputs, labels = self._get_inputs(data_dict), data_dict[self.args.label_mean_key]
                     labels = labels.to(DEVICE, non_blocking=True)
                     if compute_loss and self.sample_weighted_loss:
                         weights = data_dict[self.args.weight_key]
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def retry_with_backoff(fn, num_retries=5, base_sec=1., max_sec=60., description=''):
+    """
+    Call fn() and retry on errors with exponential backoff: the n-th retry waits base_sec * 2**n seconds
+    (at most max_sec, with random jitter between 50% and 100% to spread the requests of concurrent workers).
+    """
+    for attempt in range(num_retries):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == num_retries - 1:
+                raise RuntimeError("failed {} times: {} ({})".format(num_retries, description, e))
+            sleep_sec = min(max_sec, base_sec * 2 ** attempt) * np.random.uniform(0.5, 1)
+            print('Attempt {}/{} failed: {} ({}). Retrying in {:.1f}s'.format(attempt + 1, num_retries, description,
+                                                                              e, sleep_sec))
+            time.sleep(sleep_sec)
+
+
+class LocalDirectorySource(object):
+    """
+    Band files in a local directory with the same layout as the bucket (e.g. root/tiles/32/T/MT/2020/6/23/0/R10m/B02.jp2).
+    Interchangeable with S3Source, e.g. to test or run the deploy offline.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get_size(self, key):
+        return os.path.getsize(os.path.join(self.root, key))
+
+    def read_range(self, key, start, length):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+
+class S3Source(object):
+    """
+    Band files in an S3 bucket (default: the requester pays Sentinel-2 L2A bucket on AWS) read with range requests.
+    With endpoint_url any S3-compatible store can be used (e.g. a local MinIO server).
+    Credentials are read by boto3 from the environment (e.g. AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY).
+    """
+    def __init__(self, bucket='sentinel-s2-l2a', endpoint_url=None, requester_pays=True):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.request_kwargs = {'RequestPayer': 'requester'} if requester_pays else {}
+
+    def _get_client(self):
+        # the client is created in the first request --> each process has its own client (thread-safe)
+        if not hasattr(self, 'client'):
+            import boto3
+            self.client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self.client
+
+    def get_size(self, key):
+        return self._get_client().head_object(Bucket=self.bucket, Key=key, **self.request_kwargs)['ContentLength']
+
+    def read_range(self, key, start, length):
+        response = self._get_client().get_object(Bucket=self.bucket, Key=key,
+                                                 Range='bytes={}-{}'.format(start, start + length - 1),
+                                                 **self.request_kwargs)
+        return response['Body'].read()
+
+
+class BandCache(object):
+    """
+    Local block cache of the band files of a source (LocalDirectorySource or S3Source).
+    A file is fetched with concurrent range requests of block_size bytes (with exponential backoff) and written to a
+    local file that gdal opens directly. Fetched blocks are marked in the cache, such that an interrupted fetch
+    continues with the missing blocks and repeated reads of the same tile do not request any data.
+
+    Cache entry of a key (e.g. tiles/32/T/MT/2020/6/23/0/R10m/B02.jp2) in cache_dir/key/:
+        meta.json      file size and block size (its modification time is the last access time, LRU)
+        <file name>    local copy of the file (e.g. B02.jp2)
+        blocks/<i>     marker of each fetched block
+        complete       marker when all blocks are fetched
+
+    Args:
+        source: Band source with get_size(key) and read_range(key, start, length).
+        cache_dir (str): Directory of the cache.
+        block_size (int): Size of the range requests in bytes.
+        num_threads (int): Number of concurrent range requests.
+        max_size_gb (float): Optional maximum size of the cache (least recently used files are removed).
+        num_retries (int): Number of attempts per request.
+    """
+    def __init__(self, source, cache_dir, block_size=8 * 1024 ** 2, num_threads=8, max_size_gb=None, num_retries=5):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.max_size_gb = max_size_gb
+        self.num_retries = num_retries
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key.lstrip('/'))
+
+    def _data_path(self, key):
+        return os.path.join(self._entry_dir(key), os.path.basename(key))
+
+    def _init_entry(self, key):
+        """ Returns the meta dict of the entry (the file size is requested once per key). """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['block_size'] == self.block_size:
+                return meta
+            # blocks of another size: fetch again
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        size = retry_with_backoff(lambda: self.source.get_size(key), num_retries=self.num_retries,
+                                  description='size of {}'.format(key))
+        meta = {'size': size, 'block_size': self.block_size}
+        os.makedirs(os.path.join(entry_dir, 'blocks'), exist_ok=True)
+        with open(self._data_path(key), 'ab') as f:
+            f.truncate(size)
+        tmp_path = meta_path + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        return meta
+
+    def _fetch_block(self, key, block_index, size):
+        start = block_index * self.block_size
+        length = min(self.block_size, size - start)
+        data = retry_with_backoff(lambda: self.source.read_range(key, start, length), num_retries=self.num_retries,
+                                  description='bytes {}-{} of {}'.format(start, start + length - 1, key))
+        if len(data) != length:
+            raise RuntimeError("Expected {} bytes, got {} (bytes {} of {})".format(length, len(data), start, key))
+        entry_dir = self._entry_dir(key)
+        fd = os.open(self._data_path(key), os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, start)
+        finally:
+            os.close(fd)
+        # mark the block after the data is written
+        open(os.path.join(entry_dir, 'blocks', str(block_index)), 'w').close()
+        return length
+
+    def fetch(self, keys):
+        """
+        Fetch the missing blocks of all keys concurrently.
+
+        Returns:
+            dict with the local file path of every key.
+        """
+        local_paths = {}
+        tasks = []
+        for key in keys:
+            entry_dir = self._entry_dir(key)
+            local_paths[key] = self._data_path(key)
+            if os.path.exists(os.path.join(entry_dir, 'complete')):
+                os.utime(os.path.join(entry_dir, 'meta.json'))
+                continue
+            meta = self._init_entry(key)
+            num_blocks = int(np.ceil(meta['size'] / self.block_size))
+            fetched = set(os.listdir(os.path.join(entry_dir, 'blocks')))
+            tasks.extend((key, i, meta['size']) for i in range(num_blocks) if str(i) not in fetched)
+
+        if tasks:
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                num_bytes = sum(executor.map(lambda task: self._fetch_block(*task), tasks))
+            print('fetched {} blocks ({:.1f} MB) in {:.1f}s'.format(len(tasks), num_bytes / 1024 ** 2,
+                                                                    time.time() - start))
+
+        for key in keys:
+            entry_dir = self._entry_dir(key)
+            open(os.path.join(entry_dir, 'complete'), 'w').close()
+            os.utime(os.path.join(entry_dir, 'meta.json'))
+        if tasks:
+            self.evict(keep=keys)
+        return local_paths
+
+    def get_local_path(self, key):
+        return self.fetch([key])[key]
+
+    def get_entries(self):
+        """ Returns a list of (last access time, size in bytes, entry directory) of all complete entries. """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            if 'complete' in files and 'meta.json' in files:
+                size = os.path.getsize(os.path.join(root, os.path.basename(root)))
+                entries.append((os.path.getmtime(os.path.join(root, 'meta.json')), size, root))
+                dirs[:] = []
+        return entries
+
+    def evict(self, keep=()):
+        """ Remove the least recently used files until the cache is smaller than max_size_gb. """
+        if self.max_size_gb is None:
+            return
+        keep_dirs = {self._entry_dir(key) for key in keep}
+        entries = sorted(self.get_entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total_size <= self.max_size_gb * 1024 ** 3:
+                break
+            if entry_dir in keep_dirs:
+                continue
+            print('removing band from cache: ', entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+
+def get_band_source(source_type, root=None, endpoint_url=None, cache_dir=None, block_size_mb=8, num_threads=8,
+                    max_size_gb=None):
+    """
+    Returns a BandCache for the source_type 's3' (root: bucket name, default 'sentinel-s2-l2a') or 'local'
+    (root: directory with the layout of the bucket), or None if source_type is None.
+    """
+    if source_type is None:
+        return None
+    if source_type == 's3':
+        source = S3Source(bucket=root or 'sentinel-s2-l2a', endpoint_url=endpoint_url)
+    elif source_type == 'local':
+        source = LocalDirectorySource(root=root)
+    else:
+        raise ValueError("Unknown band source: {}".format(source_type))
+    if cache_dir is None:
+        raise ValueError("A cache directory is needed for the band source {}".format(source_type))
+    return BandCache(source, cache_dir=cache_dir, block_size=int(block_size_mb * 1024 ** 2), num_threads=num_threads,
+                     max_size_gb=max_size_gb)
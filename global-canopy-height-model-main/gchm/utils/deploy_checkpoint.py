@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+
+def load_checkpoint_config(checkpoint_dir):
+    """ Returns the config of a checkpoint in checkpoint_dir or None if there is no checkpoint. """
+    config_path = os.path.join(checkpoint_dir, 'config.json')
+    if not os.path.exists(config_path) or not os.path.exists(os.path.join(checkpoint_dir, 'done.npy')):
+        return None
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
+class DeployCheckpoint(object):
+    """
+    Resumable prediction of a Sentinel-2 tile. The recomposed tiles (see TileRecomposer) are memory-mapped .npy files
+    in checkpoint_dir and done.npy marks the predicted patches (one bool per patch index). At most every checkpoint_sec
+    seconds the recomposed tiles are flushed to disk before their patches are marked as done, such that a killed run
+    (e.g. out of memory, preemption, read error) continues with the remaining patches when the tile is predicted again.
+
+    Args:
+        checkpoint_dir (str): Scratch directory of the tile (e.g. resume_dir/file_name).
+        config (dict): Parameters of the prediction (e.g. model ids, patch size, tile shape). An existing checkpoint
+                       with another config is discarded.
+        checkpoint_sec (float): Minimum number of seconds between two checkpoints.
+    """
+    def __init__(self, checkpoint_dir, config, checkpoint_sec=60):
+        self.checkpoint_dir = checkpoint_dir
+        # json round trip to compare with the saved config (e.g. tuples are saved as lists)
+        self.config = json.loads(json.dumps(config))
+        self.checkpoint_sec = checkpoint_sec
+        self.recomposer_dict = {}
+        self.pending = []
+        self.last_checkpoint = time.time()
+
+        saved_config = load_checkpoint_config(self.checkpoint_dir)
+        self.resumed = saved_config == self.config
+        if not self.resumed and os.path.exists(self.checkpoint_dir):
+            print('discarding checkpoint (different config): ', self.checkpoint_dir)
+            shutil.rmtree(self.checkpoint_dir)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        done_path = os.path.join(self.checkpoint_dir, 'done.npy')
+        if self.resumed:
+            self.done = np.load(done_path, mmap_mode='r+')
+            print('resuming from checkpoint: {} ({} patches done)'.format(self.checkpoint_dir,
+                                                                          np.count_nonzero(self.done)))
+        else:
+            self.done = np.lib.format.open_memmap(done_path, mode='w+', dtype=bool,
+                                                  shape=(self.config['num_patches'],))
+            with open(os.path.join(self.checkpoint_dir, 'config.json'), 'w') as f:
+                json.dump(self.config, f)
+
+    def init_recomposers(self, ds_pred, keys):
+        """ Returns a dict with a memory-mapped TileRecomposer (float32) for every key (reopened when resumed). """
+        for key in keys:
+            memmap_path = os.path.join(self.checkpoint_dir, '{}.npy'.format(key))
+            self.recomposer_dict[key] = ds_pred.init_recomposer(channels=1, out_type=np.float32,
+                                                                memmap_path=memmap_path,
+                                                                resume=self.resumed and os.path.exists(memmap_path))
+        return self.recomposer_dict
+
+    def get_remaining(self, patch_indices):
+        """ Returns the patch indices that are not done. """
+        return [index for index in patch_indices if not self.done[index]]
+
+    def update(self, patch_indices, force=False):
+        """ Add predicted patches. Checkpoint if checkpoint_sec passed since the last checkpoint (or force). """
+        self.pending.extend(int(index) for index in patch_indices)
+        if force or time.time() - self.last_checkpoint >= self.checkpoint_sec:
+            # the predictions must be on disk before the patches are marked as done
+            for recomposer in self.recomposer_dict.values():
+                recomposer.flush()
+            self.done[self.pending] = True
+            self.done.flush()
+            self.pending = []
+            self.last_checkpoint = time.time()
+
+    def remove(self):
+        """ Remove the checkpoint (after the predictions are saved). """
+        self.recomposer_dict = {}
+        del self.done
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
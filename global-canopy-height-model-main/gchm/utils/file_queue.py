@@ -0,0 +1,73 @@
+import os
+
+
+class FileQueue(object):
+    """
+    Simple job queue on a local (or shared) file system used by the deploy worker.
+    Every job is a text file containing one image path. The state of a job is given by its subdirectory:
+        queue_dir/pending/  jobs to process
+        queue_dir/running/  jobs claimed by a worker
+        queue_dir/done/     successfully processed jobs
+        queue_dir/failed/   failed jobs
+
+    Jobs are claimed with os.rename, which is atomic on the same file system. Multiple workers can thus share one queue.
+    Jobs of a crashed worker remain in running/ and can be moved back to pending/ with requeue_running().
+
+    Example to fill the queue from a text file with image paths:
+        queue = FileQueue('./queue'); [queue.put(p.strip()) for p in open('paths.txt') if p.strip()]
+    """
+
+    states = ['pending', 'running', 'done', 'failed']
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for state in self.states:
+            os.makedirs(os.path.join(self.queue_dir, state), exist_ok=True)
+
+    def _path(self, state, job_name):
+        return os.path.join(self.queue_dir, state, job_name)
+
+    def put(self, image_path):
+        """ Add a job for image_path to pending/ (the job name is the image file name). """
+        job_name = os.path.basename(image_path.rstrip('/')) + '.job'
+        tmp_path = self._path('pending', '.' + job_name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('{}\n'.format(image_path))
+        os.rename(tmp_path, self._path('pending', job_name))
+        return job_name
+
+    def claim(self):
+        """
+        Claim the next pending job (sorted by name).
+
+        Returns:
+            (job_name, image_path) or (None, None) if no job is pending.
+        """
+        for job_name in sorted(os.listdir(os.path.join(self.queue_dir, 'pending'))):
+            if job_name.startswith('.'):
+                continue
+            try:
+                os.rename(self._path('pending', job_name), self._path('running', job_name))
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            with open(self._path('running', job_name), 'r') as f:
+                image_path = f.read().strip()
+            return job_name, image_path
+        return None, None
+
+    def complete(self, job_name, success=True):
+        """ Move a running job to done/ or failed/. """
+        state = 'done' if success else 'failed'
+        os.rename(self._path('running', job_name), self._path(state, job_name))
+
+    def requeue_running(self):
+        """ Move all jobs in running/ back to pending/ (e.g. after a worker was killed). """
+        job_names = [j for j in os.listdir(os.path.join(self.queue_dir, 'running')) if not j.startswith('.')]
+        for job_name in job_names:
+            os.rename(self._path('running', job_name), self._path('pending', job_name))
+        return len(job_names)
+
+    def __len__(self):
+        """ Number of pending jobs. """
+        return len([j for j in os.listdir(os.path.join(self.queue_dir, 'pending')) if not j.startswith('.')])
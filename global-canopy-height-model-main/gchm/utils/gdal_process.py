@@ -2,10 +2,13 @@ import os
 import osgeo
 from osgeo import gdal, osr, ogr, gdalconst
 import numpy as np
-from skimage.transform import resize
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 import time
 
+from gchm.utils.resample import upsample_band, resample_bands_to_target_shape
+from gchm.utils.safe_index import get_safe_index
+from gchm.utils.profiling import timed
+
 gdal.UseExceptions()
 
 
@@ -42,7 +45,18 @@ def read_band(path_band, num_retries=10, max_sleep_sec=5):
 
 
 
-def read_sentinel2_bands(data_path, from_aws=False, bucket='sentinel-s2-l2a', channels_last=False):
+def get_sentinel2_band_paths(data_path, from_aws=False, bucket='sentinel-s2-l2a', index_dir=None, band_source=None):
+    """
+    Get the gdal paths of all Sentinel-2 L2A bands (incl. SCL and CLD) without reading any band data.
+    The members of a zip file are looked up in its SafeIndex (built once per product, optionally cached in index_dir).
+    With a band_source (BandCache, see get_band_source), data_path is the product prefix in the bucket layout
+    (e.g. 'tiles/32/T/MT/2020/6/23/0'). The band files are then fetched concurrently to the local cache (or taken
+    from the cache) and the paths are the local copies.
+
+    Returns:
+        band_paths: dict with band name as key and a dict with 'path', 'res' (in meters) and 'scale'
+                    (upsampling factor to 10m resolution) as value.
+    """
     bands10m = ['B02', 'B03', 'B04', 'B08']
     bands20m = ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL']
     bands60m = ['B01', 'B09']  # 'B10' is missing in 2A, exists only in 1C
@@ -51,64 +65,186 @@ def read_sentinel2_bands(data_path, from_aws=False, bucket='sentinel-s2-l2a', ch
                  20: {'band_names': bands20m, 'subdir': 'R20m', 'scale': 2},
                  60: {'band_names': bands60m, 'subdir': 'R60m', 'scale': 6}}
 
-    if '.zip' in data_path:
-        archive = ZipFile(data_path, 'r')  # data_path is path to zip file
+    if '.zip' in data_path and band_source is None:
+        safe_index = get_safe_index(data_path, index_dir=index_dir)  # data_path is path to zip file
 
-    band_arrays = {}
-    tile_info = None
+    band_paths = {}
     for res in bands_dir.keys():
-        bands_dir[res]['band_data_list'] = []
-        for i in range(len(bands_dir[res]['band_names'])):
-            band_name = bands_dir[res]['band_names'][i]
-
-            if from_aws:
+        for band_name in bands_dir[res]['band_names']:
+            if band_source is not None:
+                # relative path in the bucket
+                path_band = os.path.join(data_path, bands_dir[res]['subdir'], band_name + '.jp2')
+            elif from_aws:
                 print('Opening bands with gdal vsis3...')
                 path_band = os.path.join('/vsis3', bucket, data_path, bands_dir[res]['subdir'], band_name + '.jp2')
             else:
                 # get datapath within zip file
-                # get path to IMG_DATA
-                path_img_data = \
-                [name for name in archive.namelist() if name.endswith('{}_{}m.jp2'.format(band_name, res))][0]
-                path_band = os.path.join(data_path, path_img_data)
-                path_band = '/vsizip/' + path_band
-
-            print('path_band: ', path_band)
-            if not tile_info:
-                ds = gdal.Open(path_band)
-                tile_info = get_tile_info(ds)
-
-            # read all band data to memory once
-            band_arrays[band_name] = read_band(path_band=path_band)
-
-    print("Opening CLD band...")
-    if from_aws:
+                path_band = safe_index.get_path(band_name, res)
+            band_paths[band_name] = {'path': path_band, 'res': res, 'scale': bands_dir[res]['scale']}
+
+    if band_source is not None:
+        path_band = os.path.join(data_path, 'qi', 'CLD_20m.jp2')
+    elif from_aws:
         path_band = os.path.join('/vsis3', bucket, data_path, 'qi', 'CLD_20m.jp2')
     else:
-        path_img_data = \
-        [name for name in archive.namelist() if name.endswith('CLD_20m.jp2') or name.endswith('MSK_CLDPRB_20m.jp2')][0]
-        path_band = os.path.join(data_path, path_img_data)
-        path_band = '/vsizip/' + path_band
-    print('cloud path_band:', path_band)
-
-    band_arrays['CLD'] = read_band(path_band=path_band)
-
-    target_shape = band_arrays['B02'].shape
-    print('resizing 20m and 60m bands to 10m resolution...')
-    for band_name in band_arrays:
-        band_array = band_arrays[band_name]
-        if band_array.shape != target_shape:
-            if band_name in ['SCL']:
-                order = 0  # nearest
-            else:
-                order = 3  # bicubic
-
-            band_arrays[band_name] = resize(band_array, target_shape, mode='reflect',
-                                            order=order, preserve_range=True).astype(np.uint16)
-    print('sorting bands...')
-    image_array = sort_band_arrays(band_arrays=band_arrays, channels_last=channels_last)
+        path_band = safe_index.get_path('CLD', 20)
+    band_paths['CLD'] = {'path': path_band, 'res': 20, 'scale': 2}
+
+    if band_source is not None:
+        local_paths = band_source.fetch([band_paths[band_name]['path'] for band_name in band_paths])
+        for band_name in band_paths:
+            band_paths[band_name]['path'] = local_paths[band_paths[band_name]['path']]
+    return band_paths
+
+
+def read_sentinel2_bands(data_path, from_aws=False, bucket='sentinel-s2-l2a', channels_last=False, num_workers=1,
+                         index_dir=None, timer=None, band_source=None):
+    """
+    Read all Sentinel-2 bands to memory and resample the 20m and 60m bands to 10m resolution.
+
+    Args:
+        num_workers (int): Number of threads to decode the JP2 bands concurrently (one band per thread) and to
+                           resample the 20m and 60m bands. Gdal and numpy release the GIL.
+                           If 1: bands are decoded and resampled sequentially.
+        timer (StageTimer): Optional timer for the stages 'index', 'decode' and 'resample'.
+        band_source (BandCache): Optional source of the band files (see get_sentinel2_band_paths).
+
+    Returns:
+        image_array, tile_info, scl, cloud
+    """
+    with timed(timer, 'index'):
+        band_paths = get_sentinel2_band_paths(data_path=data_path, from_aws=from_aws, bucket=bucket,
+                                              index_dir=index_dir, band_source=band_source)
+
+        # get the tile info from the first 10m band
+        path_band = band_paths['B02']['path']
+        ds = gdal.Open(path_band)
+        tile_info = get_tile_info(ds)
+        ds = None
+
+    for band_name in band_paths:
+        if band_name == 'CLD':
+            print('cloud path_band:', band_paths[band_name]['path'])
+        else:
+            print('path_band: ', band_paths[band_name]['path'])
+
+    # read all band data to memory once
+    band_arrays = {}
+    with timed(timer, 'decode'):
+        if num_workers > 1:
+            print('decoding {} bands with {} threads...'.format(len(band_paths), num_workers))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {band_name: executor.submit(read_band, path_band=band_paths[band_name]['path'])
+                           for band_name in band_paths}
+                for band_name in futures:
+                    band_arrays[band_name] = futures[band_name].result()
+        else:
+            for band_name in band_paths:
+                band_arrays[band_name] = read_band(path_band=band_paths[band_name]['path'])
+
+    with timed(timer, 'resample'):
+        target_shape = band_arrays['B02'].shape
+        print('resizing 20m and 60m bands to 10m resolution...')
+        # SCL is upsampled with nearest neighbor, all other bands with cubic spline interpolation
+        band_arrays = resample_bands_to_target_shape(band_arrays, target_shape=target_shape, nearest_bands=('SCL',),
+                                                     num_workers=num_workers)
+        print('sorting bands...')
+        image_array = sort_band_arrays(band_arrays=band_arrays, channels_last=channels_last)
     return image_array, tile_info, band_arrays['SCL'], band_arrays['CLD']
 
 
+def open_sentinel2_band_datasets(band_paths):
+    """ Open all bands as gdal datasets to read windows on demand (see read_sentinel2_window). """
+    band_datasets = {}
+    for band_name in band_paths:
+        band_datasets[band_name] = {'ds': gdal.Open(band_paths[band_name]['path']),
+                                    'scale': band_paths[band_name]['scale']}
+    return band_datasets
+
+
+def read_band_window(ds, xoff, yoff, xsize, ysize, num_retries=10, max_sleep_sec=5):
+    for i in range(num_retries):
+        try:
+            return ds.GetRasterBand(1).ReadAsArray(xoff=xoff, yoff=yoff, win_xsize=xsize, win_ysize=ysize)
+        except:
+            print('Attempt {}/{} failed reading window (x={}, y={}, w={}, h={}) from: {}'.format(
+                i, num_retries, xoff, yoff, xsize, ysize, ds.GetDescription()))
+            time.sleep(np.random.randint(max_sleep_sec))
+            continue
+    raise RuntimeError("read_band_window() failed {} times reading from: {}".format(num_retries, ds.GetDescription()))
+
+
+def read_band_window_resampled(ds, scale, y_start, y_stop, x_start, x_stop, order=3, halo=16):
+    """
+    Read a window given in 10m pixel coordinates from a band with lower resolution and resample it to 10m.
+    The window must lie within the tile. The native window is extended by a halo (in native pixels) such that
+    the interpolation at the window edges does not depend on the window boundary.
+    Note: upsample_band clips the interpolated values to the range of the window. Values can therefore deviate
+    marginally from resampling the full band at once (see read_sentinel2_bands).
+    """
+    if scale == 1:
+        return read_band_window(ds, xoff=x_start, yoff=y_start, xsize=x_stop - x_start, ysize=y_stop - y_start)
+
+    # native window extended by the halo and clipped to the band extent
+    y_start_native = max(y_start // scale - halo, 0)
+    y_stop_native = min(-(-y_stop // scale) + halo, ds.RasterYSize)
+    x_start_native = max(x_start // scale - halo, 0)
+    x_stop_native = min(-(-x_stop // scale) + halo, ds.RasterXSize)
+
+    band_array = read_band_window(ds, xoff=x_start_native, yoff=y_start_native,
+                                  xsize=x_stop_native - x_start_native, ysize=y_stop_native - y_start_native)
+    band_array = upsample_band(band_array, scale=scale, order=order)
+
+    # crop the requested window
+    y_offset = y_start - y_start_native * scale
+    x_offset = x_start - x_start_native * scale
+    return band_array[y_offset:y_offset + y_stop - y_start, x_offset:x_offset + x_stop - x_start]
+
+
+def read_sentinel2_window(band_datasets, y_start, y_stop, x_start, x_stop, height, width, halo=16,
+                          channels_last=True):
+    """
+    Read a window given in 10m pixel coordinates from all 12 Sentinel-2 bands.
+    The 20m and 60m bands are resampled to 10m within the window (plus halo).
+    The window may exceed the tile extent (height, width), out of bounds pixels are filled with symmetric padding
+    (corresponds to np.pad(image, mode='symmetric') of the full tile).
+    """
+    # clip the window to the tile extent
+    y_start_clip, y_stop_clip = max(y_start, 0), min(y_stop, height)
+    x_start_clip, x_stop_clip = max(x_start, 0), min(x_stop, width)
+
+    band_arrays = {}
+    for band_name in band_datasets:
+        if band_name in ['SCL', 'CLD']:
+            continue
+        band_arrays[band_name] = read_band_window_resampled(ds=band_datasets[band_name]['ds'],
+                                                            scale=band_datasets[band_name]['scale'],
+                                                            y_start=y_start_clip, y_stop=y_stop_clip,
+                                                            x_start=x_start_clip, x_stop=x_stop_clip,
+                                                            order=3, halo=halo)
+    window = sort_band_arrays(band_arrays=band_arrays, channels_last=True)
+
+    # symmetric padding for the part of the window outside of the tile
+    pad_width = ((y_start_clip - y_start, y_stop - y_stop_clip), (x_start_clip - x_start, x_stop - x_stop_clip), (0, 0))
+    if np.any(pad_width):
+        window = np.pad(window, pad_width, mode='symmetric')
+
+    if not channels_last:
+        window = np.moveaxis(window, source=-1, destination=0)
+    return window
+
+
+def read_band_resampled(ds, scale, order=3, block_rows=1098, halo=16, dtype=np.uint16):
+    """ Read a full band resampled to 10m resolution in blocks of rows to bound the memory of the interpolation. """
+    height, width = ds.RasterYSize * scale, ds.RasterXSize * scale
+    band_array = np.empty((height, width), dtype=dtype)
+    for y_start in range(0, height, block_rows):
+        y_stop = min(y_start + block_rows, height)
+        band_array[y_start:y_stop] = read_band_window_resampled(ds, scale=scale, y_start=y_start, y_stop=y_stop,
+                                                                x_start=0, x_stop=width, order=order, halo=halo)
+    return band_array
+
+
 def to_latlon(x, y, ds):
     bag_gtrn = ds.GetGeoTransform()
     bag_proj = ds.GetProjectionRef()
@@ -135,7 +271,14 @@ def to_latlon(x, y, ds):
     return lat, lon
 
 
-def create_latlon_mask(height, width, refDataset, out_type=np.float32):
+def get_latlon_vectors(height, width, refDataset, out_type=np.float32):
+    """
+    Latitude per row and longitude per column of the image (linear interpolation between the corners).
+
+    Returns:
+        lat_col: latitude of every row with shape (height,)
+        lon_row: longitude of every column with shape (width,)
+    """
     # compute lat, lon of top-left and bottom-right corners
     lat_topleft, lon_topleft = to_latlon(x=0, y=0, ds=refDataset)
     lat_bottomright, lon_bottomright = to_latlon(x=width-1, y=height-1, ds=refDataset)
@@ -143,6 +286,11 @@ def create_latlon_mask(height, width, refDataset, out_type=np.float32):
     # interpolate between the corners
     lat_col = np.linspace(start=lat_topleft, stop=lat_bottomright, num=height).astype(out_type)
     lon_row = np.linspace(start=lon_topleft, stop=lon_bottomright, num=width).astype(out_type)
+    return lat_col, lon_row
+
+
+def create_latlon_mask(height, width, refDataset, out_type=np.float32):
+    lat_col, lon_row = get_latlon_vectors(height=height, width=width, refDataset=refDataset, out_type=out_type)
 
     # expand dimensions of row and col vector to repeat
     lat_col = lat_col[:, None]
@@ -158,16 +306,19 @@ def create_latlon_mask(height, width, refDataset, out_type=np.float32):
     return lat_mask, lon_mask
 
 
-def get_reference_band_path(path_zip_file, ref_band_suffix='B02_10m.jp2'):
-    archive = ZipFile(path_zip_file, 'r')
-    archive_B02 = [name for name in archive.namelist() if name.endswith(ref_band_suffix)][0]
-    refDataset_path = os.path.join('/vsizip/' + path_zip_file, archive_B02)
+def get_reference_band_path(path_zip_file, ref_band_suffix='B02_10m.jp2', index_dir=None):
+    # e.g. 'B02_10m.jp2' --> band 'B02' with 10m resolution in the SafeIndex
+    band_name, res = ref_band_suffix[:-len('m.jp2')].rsplit('_', 1)
+    refDataset_path = get_safe_index(path_zip_file, index_dir=index_dir).get_path(band_name, int(res))
     return refDataset_path
 
 
-def get_reference_band_ds_gdal(path_file, ref_band_suffix='B02_10m.jp2'):
-    if ".zip" in path_file:
-        refDataset_path = get_reference_band_path(path_file, ref_band_suffix)
+def get_reference_band_ds_gdal(path_file, ref_band_suffix='B02_10m.jp2', index_dir=None, band_source=None):
+    if band_source is not None:
+        # local copy in the cache of the band source
+        refDataset_path = band_source.get_local_path(os.path.join(path_file, 'R10m', 'B02.jp2'))
+    elif ".zip" in path_file:
+        refDataset_path = get_reference_band_path(path_file, ref_band_suffix, index_dir=index_dir)
     else:
         # create path on aws s3
         refDataset_path = os.path.join('/vsis3', 'sentinel-s2-l2a', path_file, 'R10m', 'B02.jp2')
@@ -175,6 +326,30 @@ def get_reference_band_ds_gdal(path_file, ref_band_suffix='B02_10m.jp2'):
     return ds
 
 
+def rasterize_aoi(aoi_path, tile_info, all_touched=True):
+    """
+    Rasterize the polygons of a vector file (e.g. GeoJSON, Shapefile) to the pixel grid of a tile.
+    The polygons are reprojected to the tile projection if needed.
+
+    Returns:
+        aoi_mask: boolean array with shape (height, width). True inside the area of interest.
+    """
+    vector_ds = ogr.Open(aoi_path)
+    if vector_ds is None:
+        raise RuntimeError("Could not open the area of interest: {}".format(aoi_path))
+    layer = vector_ds.GetLayer()
+
+    mem_ds = gdal.GetDriverByName('MEM').Create('', tile_info['width'], tile_info['height'], 1, gdal.GDT_Byte)
+    mem_ds.SetGeoTransform(tile_info['geotransform'])
+    mem_ds.SetProjection(tile_info['projection'])
+    options = ['ALL_TOUCHED=TRUE'] if all_touched else []
+    gdal.RasterizeLayer(mem_ds, [1], layer, burn_values=[1], options=options)
+    aoi_mask = mem_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    mem_ds = None
+    vector_ds = None
+    return aoi_mask
+
+
 def get_tile_info(refDataset):
     tile_info = {}
     tile_info['projection'] = refDataset.GetProjection()
@@ -202,7 +377,145 @@ def save_array_as_geotif(out_path, array, tile_info, out_type=None, out_bands=1,
     dst_ds = None
 
 
-def load_tif_as_array(path, set_nodata_to_nan=True, dtype=float):
+def encode_scaled(array, out_type, scale, offset=0):
+    """
+    Encode a float array as integers: round((array - offset) / scale), clipped to the range of out_type.
+    The largest value of out_type is reserved as nodata (nan).
+
+    Returns:
+        encoded array and the nodata value.
+    """
+    dtype = np.dtype(out_type)
+    nodata = np.iinfo(dtype).max
+    encoded = np.round((array - offset) / scale)
+    invalid = np.isnan(encoded)
+    encoded[invalid] = nodata
+    np.clip(encoded, 0, nodata - 1, out=encoded, where=~invalid)
+    return encoded.astype(dtype), nodata
+
+
+def check_scaled_encoding(out_type, scale, max_value, offset=0):
+    """
+    Raise a ValueError if values up to max_value are clipped by encode_scaled (the largest value of out_type is nodata).
+    """
+    max_encoded = offset + (np.iinfo(np.dtype(out_type)).max - 1) * scale
+    if max_encoded < max_value:
+        raise ValueError("The scaled encoding ({}, scale: {}) clips all values above {:g}, which is less than the "
+                         "expected maximum {:g}. Use a larger scale or uint16.".format(out_type, scale, max_encoded,
+                                                                                     max_value))
+
+
+def downsample_mean(array, factor):
+    """
+    Mean over non-overlapping factor x factor blocks ignoring nan (as overview resampling AVERAGE).
+    The array is padded with nan to a multiple of factor (the overview size is rounded up as in GDAL).
+    """
+    height, width = array.shape
+    out_height, out_width = -(-height // factor), -(-width // factor)
+    padded = np.full((out_height * factor, out_width * factor), np.nan, dtype=np.float32)
+    padded[:height, :width] = array
+    blocks = padded.reshape(out_height, factor, out_width, factor)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    out = np.full((out_height, out_width), np.nan, dtype=np.float32)
+    np.divide(total, count, out=out, where=count > 0)
+    return out
+
+
+COG_OVERVIEW_LEVELS = (2, 4, 8, 16, 32)
+
+
+def check_cog_overview_levels(blocksize, overview_levels=COG_OVERVIEW_LEVELS):
+    """
+    The overviews are written per strip of blocksize rows (see save_array_as_cog), which requires that every
+    overview level divides the blocksize.
+    """
+    invalid = [factor for factor in overview_levels if blocksize % factor != 0]
+    if invalid:
+        raise ValueError("The COG blocksize ({}) must be a multiple of every overview level {} (not divisible by: {})."
+                         .format(blocksize, tuple(overview_levels), invalid))
+
+
+def save_array_as_cog(out_path, array, tile_info, out_type=None, dstnodata=None, scale=None, offset=0,
+                      blocksize=512, compress='DEFLATE', predictor=2, overview_levels=COG_OVERVIEW_LEVELS,
+                      tmp_dir=None):
+    """
+    Save a 2d array as cloud optimized geotif (internally tiled, with overviews).
+    The array (e.g. a memory-mapped recomposed tile) is written in strips of blocksize rows to a temporary tiled geotif.
+    The overviews (average ignoring nan) are computed from the same strips, so the full resolution is read only once.
+    The temporary file is then copied to the COG layout with the existing overviews.
+
+    Args:
+        out_type (str): 'float32' or with scale: 'uint8', 'uint16' (scaled integer encoding, nodata is the max value).
+        scale (float): Optional scale of the integer encoding: value = stored * scale + offset.
+                       The scale and offset are saved in the band metadata (applied by load_tif_as_array).
+        overview_levels (tuple): Overview decimation factors (must divide blocksize).
+        tmp_dir (str): Directory for the temporary tiled geotif. Default: the directory of out_path.
+    """
+    if out_type is None:
+        out_type = array.dtype.name
+    if scale is not None:
+        dstnodata = np.iinfo(np.dtype(out_type)).max
+    check_cog_overview_levels(blocksize, overview_levels)
+    height, width = array.shape
+    overview_levels = [f for f in overview_levels if f < max(height, width)]
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_path))
+    tmp_path = os.path.join(tmp_dir, '.{}_{}.tmp.tif'.format(os.path.basename(out_path), os.getpid()))
+
+    def encode(block):
+        if scale is not None:
+            return encode_scaled(block, out_type, scale=scale, offset=offset)[0]
+        return block.astype(out_type, copy=False)
+
+    tmp_ds = gdal.GetDriverByName('GTiff').Create(tmp_path, width, height, 1, GDAL_TYPE_LOOKUP[out_type],
+                                                  options=['TILED=YES', 'BLOCKXSIZE={}'.format(blocksize),
+                                                           'BLOCKYSIZE={}'.format(blocksize), 'BIGTIFF=IF_SAFER'])
+    tmp_ds.SetGeoTransform(tile_info['geotransform'])
+    tmp_ds.SetProjection(tile_info['projection'])
+    band = tmp_ds.GetRasterBand(1)
+    if dstnodata is not None:
+        band.SetNoDataValue(float(dstnodata))
+    if scale is not None:
+        band.SetScale(scale)
+        band.SetOffset(offset)
+    # allocate the overviews (filled block-wise below)
+    if overview_levels:
+        tmp_ds.BuildOverviews('NONE', overview_levels)
+
+    for row_start in range(0, height, blocksize):
+        block = np.asarray(array[row_start:row_start + blocksize], dtype=np.float32)
+        band.WriteArray(encode(block), 0, row_start)
+        for i, factor in enumerate(overview_levels):
+            band.GetOverview(i).WriteArray(encode(downsample_mean(block, factor)), 0, row_start // factor)
+    tmp_ds.FlushCache()
+
+    creation_options = ['COMPRESS={}'.format(compress), 'BLOCKSIZE={}'.format(blocksize), 'BIGTIFF=IF_SAFER']
+    if int(gdal.VersionInfo()) >= 3010000:
+        creation_options += ['PREDICTOR={}'.format(predictor), 'OVERVIEWS=FORCE_USE_EXISTING']
+        driver_name = 'COG'
+    else:
+        # GDAL < 3.1 has no COG driver. A tiled geotif with the copied overviews has the same layout.
+        creation_options = ['COMPRESS={}'.format(compress), 'PREDICTOR={}'.format(predictor), 'TILED=YES',
+                            'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize),
+                            'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER']
+        driver_name = 'GTiff'
+    dst_ds = gdal.GetDriverByName(driver_name).CreateCopy(out_path, tmp_ds, options=creation_options)
+    dst_ds = None
+    tmp_ds = None
+    gdal.GetDriverByName('GTiff').Delete(tmp_path)
+
+
+def load_tif_as_array(path, set_nodata_to_nan=True, dtype=float, unscale=True):
+    """
+    Load the first band of a geotif.
+
+    Args:
+        unscale (bool): if True and the band has a scale/offset (scaled integer encoding, see save_array_as_cog):
+                        the array is converted to values: stored * scale + offset.
+    """
     ds = gdal.Open(path)
     band = ds.GetRasterBand(1)
 
@@ -213,5 +526,8 @@ def load_tif_as_array(path, set_nodata_to_nan=True, dtype=float):
     tile_info['nodata_value'] = nodata_value
     if set_nodata_to_nan:
         array[array == nodata_value] = np.nan
+    scale, offset = band.GetScale(), band.GetOffset()
+    if unscale and ((scale not in (None, 1)) or (offset not in (None, 0))):
+        array = array * (1 if scale is None else scale) + (0 if offset is None else offset)
     return array, tile_info
 
@@ -0,0 +1,71 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class H5ChunkCache(object):
+    """
+    LRU cache of decompressed chunks of the arrays in a h5 file (pytables), such that neighbouring samples
+    (e.g. sequential access or SliceBatchSampler) are decompressed once. A chunk is the block of rows given by
+    the chunk shape of the array along the first axis (default_chunk_size for arrays without chunks).
+    The cache is not shared between processes, i.e. every dataloader worker has its own cache.
+
+    Args:
+        h5_file: Open pytables file.
+        max_size_mb (float): Memory budget of the decompressed chunks in MB.
+        default_chunk_size (int): Number of rows per chunk for arrays that are not chunked.
+    """
+    def __init__(self, h5_file, max_size_mb=256, default_chunk_size=64):
+        self.h5_file = h5_file
+        self.max_size = max_size_mb * 1024 ** 2
+        self.default_chunk_size = default_chunk_size
+        self.chunks = OrderedDict()  # {(array name, chunk index): array}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _get_chunk_size(self, node):
+        return node.chunkshape[0] if node.chunkshape is not None else self.default_chunk_size
+
+    def _get_chunk(self, name, node, chunk_index, chunk_size):
+        key = (name, chunk_index)
+        if key in self.chunks:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        self.misses += 1
+        chunk = node[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+        self.chunks[key] = chunk
+        self.size += chunk.nbytes
+        # remove the least recently used chunks (keep at least the current chunk)
+        while self.size > self.max_size and len(self.chunks) > 1:
+            _, removed = self.chunks.popitem(last=False)
+            self.size -= removed.nbytes
+        return chunk
+
+    def read(self, name, index):
+        """
+        Returns a copy of h5_file.root[name][index, ...] for an integer, a slice or a list (array) of indices.
+        """
+        node = self.h5_file.root[name]
+        chunk_size = self._get_chunk_size(node)
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            index = int(index)
+            chunk = self._get_chunk(name, node, index // chunk_size, chunk_size)
+            return chunk[index % chunk_size].copy()
+
+        if isinstance(index, slice):
+            indices = np.arange(*index.indices(node.shape[0]))
+        else:
+            indices = np.asarray(index, dtype=np.int64)
+        out = np.empty((len(indices),) + tuple(node.shape[1:]), dtype=node.dtype)
+        chunk_indices = indices // chunk_size
+        for chunk_index in np.unique(chunk_indices):
+            chunk = self._get_chunk(name, node, int(chunk_index), chunk_size)
+            selected = chunk_indices == chunk_index
+            out[selected] = chunk[indices[selected] - chunk_index * chunk_size]
+        return out
+
+    def get_stats(self):
+        num_reads = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / max(num_reads, 1),
+                'num_chunks': len(self.chunks), 'size_mb': self.size / 1024 ** 2}
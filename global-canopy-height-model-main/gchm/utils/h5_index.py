@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import numpy as np
+import tables
+from tqdm import tqdm
+
+
+# version of the index layout (an index with another version is rebuilt)
+H5_INDEX_VERSION = 1
+
+
+def compute_cloud_free(clouds, cloud_thresh_perc=10):
+    num_pixels_patch = clouds.shape[1] * clouds.shape[2]
+    perc_cloudy_pixels = np.sum(clouds > cloud_thresh_perc, axis=(1, 2, 3))/num_pixels_patch *100
+    cloud_free = perc_cloudy_pixels < cloud_thresh_perc
+    return cloud_free
+
+
+def get_h5_index_dir(path_h5, index_dir=None):
+    """ Returns the sidecar directory of the index (next to the h5 file or in index_dir, e.g. if the h5 dir is read-only). """
+    if index_dir is None:
+        return path_h5 + '.index'
+    return os.path.join(index_dir, os.path.basename(path_h5) + '.index')
+
+
+def get_h5_source(path_h5):
+    stat = os.stat(path_h5)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def build_h5_index(path_h5, out_dir, cloud_thresh_perc=10, label_key='canopy_height', chunk_size=65536):
+    """
+    Build the index of a h5 file with patches by streaming over chunk_size patches at a time
+    (the cloud and label arrays are never loaded completely).
+
+    Files in out_dir:
+        meta.json               source (size, modification time of the h5 file), num_samples and cloud_thresh_perc
+        cloud_free_indices.npy  indices of the cloud free patches (int64, see compute_cloud_free)
+        num_valid_labels.npy    number of valid (not nan) label pixels per patch (int32)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    source = get_h5_source(path_h5)
+    tmp_path = os.path.join(out_dir, 'cloud_free_indices.bin')
+    with tables.open_file(path_h5, mode='r') as f:
+        num_samples = len(f.root.images)
+        num_valid_labels = np.lib.format.open_memmap(os.path.join(out_dir, 'num_valid_labels.npy'), mode='w+',
+                                                     dtype=np.int32, shape=(num_samples,))
+        num_cloud_free = 0
+        with open(tmp_path, 'wb') as f_indices:
+            for start in tqdm(range(0, num_samples, chunk_size), desc='indexing {}'.format(os.path.basename(path_h5))):
+                stop = min(start + chunk_size, num_samples)
+                cloud_free = compute_cloud_free(f.root.cloud[start:stop], cloud_thresh_perc=cloud_thresh_perc)
+                indices = start + np.flatnonzero(cloud_free).astype(np.int64)
+                f_indices.write(indices.tobytes())
+                num_cloud_free += len(indices)
+                labels = f.root[label_key][start:stop]
+                num_valid_labels[start:stop] = np.count_nonzero(~np.isnan(labels), axis=(1, 2, 3))
+        num_valid_labels.flush()
+        del num_valid_labels
+
+    # copy the indices to a .npy file (the number of cloud free patches is known after the pass)
+    cloud_free_indices = np.lib.format.open_memmap(os.path.join(out_dir, 'cloud_free_indices.npy'), mode='w+',
+                                                   dtype=np.int64, shape=(num_cloud_free,))
+    if num_cloud_free > 0:
+        cloud_free_indices[:] = np.memmap(tmp_path, dtype=np.int64, mode='r', shape=(num_cloud_free,))
+    cloud_free_indices.flush()
+    del cloud_free_indices
+    os.remove(tmp_path)
+
+    meta = {'version': H5_INDEX_VERSION, 'source': source, 'num_samples': num_samples,
+            'num_cloud_free': num_cloud_free, 'cloud_thresh_perc': cloud_thresh_perc, 'label_key': label_key}
+    # meta.json is written last and marks a complete index
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def _load_meta(h5_index_dir):
+    meta_path = os.path.join(h5_index_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def load_h5_index(path_h5, index_dir=None, cloud_thresh_perc=10, label_key='canopy_height', chunk_size=65536):
+    """
+    Returns the sidecar index of a h5 file with patches. The index is built once (see build_h5_index) and rebuilt if
+    the h5 file changed (size or modification time) or the index was built with other parameters.
+
+    Args:
+        path_h5 (str): Path to the h5 file.
+        index_dir (str): Optional directory of the index. Default: next to the h5 file (path_h5 + '.index').
+        cloud_thresh_perc (float): Cloud threshold (see compute_cloud_free).
+        label_key (str): Array of the labels to count the valid pixels.
+        chunk_size (int): Number of patches read at a time to build the index.
+
+    Returns:
+        dict with 'num_samples', 'cloud_free_indices' and 'num_valid_labels' (memory-mapped, read-only arrays).
+    """
+    h5_index_dir = get_h5_index_dir(path_h5, index_dir=index_dir)
+    expected = {'version': H5_INDEX_VERSION, 'source': get_h5_source(path_h5),
+                'cloud_thresh_perc': cloud_thresh_perc, 'label_key': label_key}
+
+    meta = _load_meta(h5_index_dir)
+    if meta is None or any(meta[k] != v for k, v in expected.items()):
+        print('building index of: ', path_h5)
+        # build in a temporary directory and rename when complete (other processes may build the same index)
+        tmp_dir = h5_index_dir + '.tmp{}'.format(os.getpid())
+        try:
+            build_h5_index(path_h5, out_dir=tmp_dir, cloud_thresh_perc=cloud_thresh_perc, label_key=label_key,
+                           chunk_size=chunk_size)
+            if os.path.exists(h5_index_dir):
+                shutil.rmtree(h5_index_dir, ignore_errors=True)
+            os.rename(tmp_dir, h5_index_dir)
+        except OSError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            meta = _load_meta(h5_index_dir)
+            if meta is None or any(meta[k] != v for k, v in expected.items()):
+                raise RuntimeError("Could not save the index of {} to {} ({}). Use a writable index_dir "
+                                   "(--h5_index_dir).".format(path_h5, h5_index_dir, e))
+        meta = _load_meta(h5_index_dir)
+
+    return {'num_samples': meta['num_samples'],
+            'cloud_free_indices': np.load(os.path.join(h5_index_dir, 'cloud_free_indices.npy'), mmap_mode='r'),
+            'num_valid_labels': np.load(os.path.join(h5_index_dir, 'num_valid_labels.npy'), mmap_mode='r')}
@@ -1,6 +1,12 @@
+import os
+import glob
+import json
 import numpy as np
 import tables
 from tqdm import tqdm
+from collections import deque
+from contextlib import nullcontext
+from multiprocessing import Pool
 
 
 def load_paths_from_dicretory(dir):
@@ -89,6 +95,9 @@ def init_hdf5_file(hdf5_path, patch_size, channels, projection, geotransform, gt
 
 
 def write_patches_to_hdf(hdf5_path, band_arrays, image_date, image_name, latlon_patches=None, label_patches_dict=None):
+    # import here such that gdal is not needed to read and merge h5 files (e.g. for training)
+    from gchm.utils.gdal_process import sort_band_arrays
+
     # the hdf5 file must already exist.
     with tables.open_file(hdf5_path, mode='r+') as hdf5_file:
         images_storage = hdf5_file.root.images
@@ -162,6 +171,72 @@ def write_patches_to_hdf(hdf5_path, band_arrays, image_date, image_name, latlon_
     hdf5_file.close()
 
 
+# open input file of a reader process of merge_h5_datasets: [path, file]
+_MERGE_READER_FILE = [None, None]
+
+
+def _read_h5_slice(task):
+    """
+    Read the rows start:stop (or the rows select_indices) of the arrays dataset_names of a h5 file.
+    Arrays with another length than the images (e.g. one image_name per tile) are read completely with the first slice.
+    """
+    h5_path, start, stop, select_indices, dataset_names = task
+    # keep the file open for the next slice (one open file per reader process)
+    if _MERGE_READER_FILE[0] != h5_path:
+        _close_reader_file()
+        _MERGE_READER_FILE[:] = [h5_path, tables.open_file(h5_path, mode='r')]
+    f_in = _MERGE_READER_FILE[1]
+
+    num_samples = len(f_in.root.images)
+    data_dict = {}
+    for name in dataset_names:
+        node = f_in.root[name]
+        if len(node) != num_samples:
+            data_dict[name] = node[:] if start == 0 else None
+        elif select_indices is not None:
+            # read the selected rows in increasing order and restore the (random) order of the selection
+            order = np.argsort(select_indices)
+            data = np.empty((len(select_indices),) + tuple(node.shape[1:]), dtype=node.dtype)
+            sorted_indices = select_indices[order]
+            # point selection of pytables: node[indices] for 1-dim arrays, node[indices, ...] otherwise
+            data[order] = node[sorted_indices, ...] if node.ndim > 1 else node[sorted_indices]
+            data_dict[name] = data
+        else:
+            data_dict[name] = node[start:stop]
+    return data_dict
+
+
+def _close_reader_file():
+    if _MERGE_READER_FILE[1] is not None:
+        _MERGE_READER_FILE[1].close()
+    _MERGE_READER_FILE[:] = [None, None]
+
+
+def _get_merge_tasks(paths_h5_files, dataset_names, slice_size, max_num_samples_per_tile=None):
+    """ Returns the list of slices (h5_path, start, stop, select_indices, dataset_names) to copy in this order. """
+    tasks = []
+    for h5_path in paths_h5_files:
+        with tables.open_file(h5_path, mode='r') as f_in:
+            num_samples = len(f_in.root.images)
+        select_indices = None
+        if max_num_samples_per_tile is not None and (num_samples > max_num_samples_per_tile):
+            np.random.seed(1)
+            select_indices = np.random.permutation(num_samples)[:max_num_samples_per_tile]
+            num_samples = len(select_indices)
+        for start in range(0, max(num_samples, 1), slice_size):
+            stop = min(start + slice_size, num_samples)
+            tasks.append((h5_path, start, stop,
+                          select_indices[start:stop] if select_indices is not None else None, dataset_names))
+    return tasks
+
+
+def _save_merge_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
 def merge_h5_datasets(paths_h5_files, out_h5_path,
                       gt_attributes=('canopy_height', 'predictive_std'),
                       patch_size=15, channels=12,
@@ -169,33 +244,108 @@ def merge_h5_datasets(paths_h5_files, out_h5_path,
                       max_num_samples_per_tile=None,
                       expectedrows=1000,
                       complib=None, complevel=0,
-                      subgroups=None, num_samples_chunk=64, bitshuffle=False, shuffle=True):
+                      subgroups=None, num_samples_chunk=64, bitshuffle=False, shuffle=True,
+                      num_workers=0, slice_size=8192, progress_path=None, blosc_threads=None):
     """
     Merge a list of h5 files with same f.root structure.
     E.g. merge all per tile h5 files used for training to a single h5 file.
-    """
 
-    init_hdf5_file(hdf5_path=out_h5_path, patch_size=patch_size, channels=channels,
-                   projection=None, geotransform=None, gt_attributes=gt_attributes,
-                   expectedrows=expectedrows, complib=complib, complevel=complevel,
-                   subgroups=subgroups, num_samples_chunk=num_samples_chunk, bitshuffle=bitshuffle, shuffle=shuffle)
-
-    with tables.open_file(out_h5_path, mode='r+') as f_out:
-        dataset_names = list(f_out.root._v_leaves.keys())
-        dataset_names = [n for n in dataset_names if n not in ignore_datasets]
-
-        for step, h5_path in enumerate(tqdm(paths_h5_files, ncols=100, desc='merge')):
-            with tables.open_file(h5_path, mode='r') as f_in:
-                num_samples = len(f_in.root.images)
-                if max_num_samples_per_tile is not None and (num_samples > max_num_samples_per_tile):
-                    np.random.seed(1)
-                    select_indices = np.random.permutation(num_samples)[:max_num_samples_per_tile]
-                    for name in dataset_names:
-                        data = f_in.root[name][:]
-                        data = data[select_indices, ...]
-                        f_out.root[name].append(data)
-                else:
-                    for name in dataset_names:
-                        data = f_in.root[name][:]
-                        f_out.root[name].append(data)
+    The arrays are copied in slices of slice_size rows (the input files are never loaded completely). The slices are
+    read (decompressed) by num_workers reader processes and appended in order by a single writer, which compresses
+    them with the filters of the output file (complib, complevel, shuffle, bitshuffle), i.e. the data can be
+    recompressed with another codec than the input files.
+
+    After every slice, the output file is flushed and the lengths of the arrays are saved in progress_path.
+    An interrupted merge with the same input files and parameters continues after the last saved slice
+    (rows written after the last saved slice are truncated). The progress file is removed when the merge is complete.
 
+    Args:
+        num_workers (int): Number of reader processes. 0: read in the main process.
+        slice_size (int): Number of rows per slice (multiple of num_samples_chunk to write full chunks).
+        progress_path (str): Progress file of the merge. Default: out_h5_path + '.progress.json'.
+        blosc_threads (int): Optional number of threads of blosc to compress the output (complib 'blosc:...').
+    """
+    if progress_path is None:
+        progress_path = out_h5_path + '.progress.json'
+    if blosc_threads is not None:
+        tables.set_blosc_max_threads(blosc_threads)
+
+    # parameters of the merge, an existing progress file with other parameters is not resumed
+    config = {'inputs': [[p, os.path.getsize(p), int(os.path.getmtime(p))] for p in paths_h5_files],
+              'out_h5_path': os.path.abspath(out_h5_path), 'gt_attributes': list(gt_attributes),
+              'ignore_datasets': list(ignore_datasets), 'max_num_samples_per_tile': max_num_samples_per_tile,
+              'slice_size': slice_size, 'complib': complib, 'complevel': complevel, 'subgroups': subgroups,
+              'num_samples_chunk': num_samples_chunk, 'bitshuffle': bool(bitshuffle), 'shuffle': bool(shuffle)}
+    progress = None
+    if os.path.exists(progress_path) and os.path.exists(out_h5_path):
+        with open(progress_path, 'r') as f:
+            progress = json.load(f)
+        if progress['config'] != json.loads(json.dumps(config)):
+            print('discarding progress of another merge: ', progress_path)
+            progress = None
+
+    if progress is None:
+        init_hdf5_file(hdf5_path=out_h5_path, patch_size=patch_size, channels=channels,
+                       projection=None, geotransform=None, gt_attributes=gt_attributes,
+                       expectedrows=expectedrows, complib=complib, complevel=complevel,
+                       subgroups=subgroups, num_samples_chunk=num_samples_chunk, bitshuffle=bitshuffle, shuffle=shuffle)
+
+    # start the reader processes before the output file is opened (no open hdf5 file is inherited by the readers)
+    with Pool(num_workers) if num_workers > 0 else nullcontext() as pool:
+        with tables.open_file(out_h5_path, mode='r+') as f_out:
+            dataset_names = list(f_out.root._v_leaves.keys())
+            dataset_names = [n for n in dataset_names if n not in ignore_datasets]
+            tasks = _get_merge_tasks(paths_h5_files, dataset_names=dataset_names, slice_size=slice_size,
+                                     max_num_samples_per_tile=max_num_samples_per_tile)
+
+            if progress is None:
+                progress = {'config': config, 'num_tasks_done': 0, 'num_tasks': len(tasks),
+                            'lengths': {name: 0 for name in dataset_names}}
+            else:
+                # remove rows appended after the last saved slice
+                for name in dataset_names:
+                    if len(f_out.root[name]) > progress['lengths'][name]:
+                        f_out.root[name].truncate(progress['lengths'][name])
+                if progress['num_tasks_done'] >= len(tasks):
+                    # e.g. interrupted after the last slice, before the progress file was removed
+                    print('merge already finished, nothing to resume: ', out_h5_path)
+                else:
+                    print('resuming merge after {}/{} slices'.format(progress['num_tasks_done'], len(tasks)))
+
+            def write(data_dict):
+                for name in dataset_names:
+                    if data_dict[name] is not None:
+                        f_out.root[name].append(data_dict[name])
+                # the rows must be on disk before the progress is saved
+                f_out.flush()
+                progress['num_tasks_done'] += 1
+                progress['lengths'] = {name: int(len(f_out.root[name])) for name in dataset_names}
+                _save_merge_progress(progress_path, progress)
+
+            remaining_tasks = tasks[progress['num_tasks_done']:]
+            with tqdm(total=len(tasks), initial=progress['num_tasks_done'], ncols=100, desc='merge') as pbar:
+                if num_workers == 0:
+                    for task in remaining_tasks:
+                        write(_read_h5_slice(task))
+                        pbar.update(1)
+                else:
+                    # at most 2 slices per reader are in memory (read ahead of the writer)
+                    pending = deque()
+                    for task in remaining_tasks:
+                        pending.append(pool.apply_async(_read_h5_slice, (task,)))
+                        if len(pending) >= 2 * num_workers:
+                            write(pending.popleft().get())
+                            pbar.update(1)
+                    while pending:
+                        write(pending.popleft().get())
+                        pbar.update(1)
+
+            if num_workers == 0:
+                _close_reader_file()
+
+            print('merged {} samples from {} files to: {}'.format(len(f_out.root.images), len(paths_h5_files),
+                                                                 out_h5_path))
+
+    # the merge is complete, a later run with the same inputs merges again
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
@@ -0,0 +1,52 @@
+import torch
+from contextlib import nullcontext
+
+
+def get_device(device=None):
+    """ Returns the torch device. If device is None: the first GPU if available, else the CPU. """
+    if device is None:
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.type == 'cuda':
+        print('DEVICE: ', device, torch.cuda.get_device_name(device))
+    else:
+        print('DEVICE: ', device)
+    return device
+
+
+def setup_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    Set the number of threads used by torch on the CPU (intra-op and inter-op parallelism).
+    Note: the inter-op threads can only be set once before any parallel work was started.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print('Could not set num_interop_threads (can only be set once before parallel work has started).')
+    print('torch threads: {}, interop threads: {}'.format(torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+def prepare_model_for_inference(model, device, channels_last=False):
+    """ Move the model to device and set eval mode. Optionally convert the weights to channels_last memory format. """
+    model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    model.eval()
+    return model
+
+
+def to_device(inputs, device, channels_last=False):
+    """ Move a batch of inputs with shape (batch_size, channels, height, width) to device. """
+    if channels_last:
+        return inputs.to(device, non_blocking=True, memory_format=torch.channels_last)
+    return inputs.to(device, non_blocking=True)
+
+
+def autocast_context(device, bf16=False):
+    """ Returns an autocast context manager for bfloat16 mixed precision or an empty context manager. """
+    if bf16:
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return nullcontext()
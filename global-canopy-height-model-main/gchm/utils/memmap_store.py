@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import numpy as np
+import tables
+from tqdm import tqdm
+
+from gchm.utils.h5_index import get_h5_source, load_h5_index
+
+
+# version of the store layout
+MEMMAP_STORE_VERSION = 1
+
+# arrays of the h5 files (see init_hdf5_file) that are read by the datasets
+MEMMAP_FIELDS = ('images', 'lat', 'lon', 'canopy_height', 'predictive_std', 'scl')
+
+
+def get_memmap_path(path_h5, memmap_dir):
+    """ Returns the path of the store of a h5 file in memmap_dir (e.g. GLOBAL_GEDI_train.h5 -> GLOBAL_GEDI_train.memmap). """
+    return os.path.join(memmap_dir, os.path.splitext(os.path.basename(path_h5))[0] + '.memmap')
+
+
+def export_h5_to_memmap(path_h5, out_dir, fields=MEMMAP_FIELDS, chunk_size=65536, index_dir=None):
+    """
+    Export the patches of a h5 file (init_hdf5_file layout) to an uncompressed store of memory-mappable arrays,
+    e.g. on a local NVMe disk to load the patches without decompression (see Sentinel2PatchesMemmap).
+    The arrays are copied in slices of chunk_size patches.
+
+    Files in out_dir:
+        meta.json               source h5 file (path, size, modification time), number of samples, dtype and shape of
+                                the fields and chunk size of the h5 file
+        <field>.npy             one array per field (the data of .npy files is aligned to 64 bytes)
+        cloud_free_indices.npy  from the sidecar index of the h5 file (see load_h5_index)
+        num_valid_labels.npy    from the sidecar index of the h5 file
+
+    Args:
+        path_h5 (str): Path to the h5 file.
+        out_dir (str): Directory of the store (written to a temporary directory and renamed when complete).
+        fields (tuple): Names of the arrays to export.
+        chunk_size (int): Number of patches copied at a time.
+        index_dir (str): Optional directory of the sidecar index of the h5 file.
+
+    Returns:
+        dict with the meta data of the store
+    """
+    tmp_dir = out_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    meta = {'version': MEMMAP_STORE_VERSION, 'path_h5': os.path.abspath(path_h5), 'source': get_h5_source(path_h5),
+            'fields': {}}
+    try:
+        with tables.open_file(path_h5, mode='r') as f:
+            meta['num_samples'] = len(f.root.images)
+            chunkshape = f.root.images.chunkshape
+            meta['chunk_size'] = int(chunkshape[0]) if chunkshape is not None else 64
+            for name in fields:
+                node = f.root[name]
+                shape = tuple(int(n) for n in node.shape)
+                array = np.lib.format.open_memmap(os.path.join(tmp_dir, '{}.npy'.format(name)), mode='w+',
+                                                  dtype=node.dtype, shape=shape)
+                for start in tqdm(range(0, shape[0], chunk_size), ncols=100, desc=name):
+                    array[start:start + chunk_size] = node[start:start + chunk_size]
+                array.flush()
+                del array
+                meta['fields'][name] = {'dtype': np.dtype(node.dtype).str, 'shape': list(shape)}
+
+        h5_index = load_h5_index(path_h5, index_dir=index_dir)
+        for name in ['cloud_free_indices', 'num_valid_labels']:
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(name)), h5_index[name])
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return meta
+
+
+def load_memmap_meta(store_dir):
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError("No memmap store (meta.json) in: {}. See gchm/preprocess/export_h5_to_memmap.py"
+                                .format(store_dir))
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta['version'] != MEMMAP_STORE_VERSION:
+        raise ValueError("Memmap store {} has version {} (expected {}). Export it again."
+                         .format(store_dir, meta['version'], MEMMAP_STORE_VERSION))
+    return meta
+
+
+class MemmapStore(object):
+    """
+    Memory-mapped arrays of a store written by export_h5_to_memmap. The arrays are mapped copy-on-write, i.e. slices
+    are zero-copy views that can be converted to tensors (changes are not written to the files).
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.meta = load_memmap_meta(store_dir)
+        self.arrays = {name: np.load(os.path.join(store_dir, '{}.npy'.format(name)), mmap_mode='c')
+                       for name in self.meta['fields']}
+
+    def close(self):
+        self.arrays = {}
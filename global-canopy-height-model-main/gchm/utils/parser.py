@@ -11,6 +11,17 @@ def setup_parser():
     parser.add_argument("--h5_dir", default='/scratch2/data/global_vhm/GEDI_patches_CH_2020/h5_patches', help="path to directory with h5 datasets")
     parser.add_argument("--merged_h5_files", type=str2bool, nargs='?', const=True, default=False, help="if True: the h5_dir must contain merged h5 files REGION_train.h5, REGION_val.h5, REGION_test.h5.")
     parser.add_argument("--region_name", default='GLOBAL_GEDI', help="name of the region used if merged_h5_files is True")
+    parser.add_argument("--h5_index_dir", default=None, type=str_or_none,
+                        help="directory of the sidecar indices of the h5 files (number of samples, cloud free indices, "
+                             "valid labels per patch). Default: next to the h5 files (path_h5 + '.index').")
+    parser.add_argument("--data_format", default='h5', choices=['h5', 'memmap'],
+                        help="'memmap': load the patches from uncompressed memmap stores of the h5 files in memmap_dir "
+                             "(see gchm/preprocess/export_h5_to_memmap.py)")
+    parser.add_argument("--memmap_dir", default=None, type=str_or_none,
+                        help="directory of the memmap stores if data_format is 'memmap'. Default: h5_dir")
+    parser.add_argument("--h5_chunk_cache_mb", default=0, type=float,
+                        help="memory budget (MB) per dataloader worker and dataset of the LRU cache of decompressed h5 "
+                             "chunks. Neighbouring samples (e.g. SliceBatchSampler) then decompress a chunk once. 0: no cache.")
     parser.add_argument("--input_lat_lon", type=str2bool, nargs='?', const=True, default=False, help="if True: lat lon masks are used as additional input channels.")
     parser.add_argument("--separate_lat_lon", type=str2bool, nargs='?', const=True, default=False,
                         help="if True: lat lon input is not passed to the xception backbone, but only to the geo prior net.")
@@ -51,13 +62,17 @@ def setup_parser():
     parser.add_argument("--l2_lambda", default=0, help="weight of l2 regularizer", type=float)
     parser.add_argument("--batch_size", default=64, help="number of samples per batch (iteration)", type=int)
     parser.add_argument("--num_workers", default=8, help="number of workers in dataloader", type=int)
+    parser.add_argument("--normalize_on_device", type=str2bool, nargs='?', const=True, default=False,
+                        help="if True: the dataloader returns the uint16 bands (and lat lon in degrees). Normalization, "
+                             "lat lon encoding and the channels first layout are computed on the device (less data transfer).")
     parser.add_argument("--model_weights_path", help="path to pre-trained model weights", type=str_or_none, default=None)
     parser.add_argument("--nb_epoch", default=50, help="number of epochs to train", type=int)
     parser.add_argument("--iterations_per_epoch", default=5000, help="number of iterations that define one epoch. if None: one epoch corresponds to the full dataset len(dl_train)", type=int)
     parser.add_argument("--max_grad_norm", default=None, help="max total norm for gradient norm clipping", type=str2none)
     parser.add_argument("--max_grad_value", default=None, help="max gradient value (+/-) for gradient value clipping", type=str2none)
-    parser.add_argument("--custom_sampler", help="class name (str) of custom sampler type. Uses default random sampler if set to None.", choices=[None, 'SliceBatchSampler', 'BatchSampler'], type=str_or_none, default=None)
+    parser.add_argument("--custom_sampler", help="class name (str) of custom sampler type. Uses default random sampler if set to None.", choices=[None, 'SliceBatchSampler', 'BatchSampler', 'ChunkShuffle'], type=str_or_none, default=None)
     parser.add_argument("--slice_step", default=1, help="If --custom_sampler='SliceBatchSampler': access every slice_step sample in the data array with slice(start, stop, slice_step)", type=int)
+    parser.add_argument("--shuffle_buffer_size", default=2048, help="If --custom_sampler='ChunkShuffle': number of samples in the shuffle buffer. Every h5 chunk is read once per epoch and its samples are mixed with the samples of the other chunks in the buffer.", type=int)
     parser.add_argument("--lr_milestones", default=[100, 200], nargs='+', type=int,
                         help="List of epoch indices at which the learning rate is dropped by factor 10. Must be increasing.")
 
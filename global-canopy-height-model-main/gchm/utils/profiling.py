@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+
+def _read_proc_status_gb(key):
+    """ Returns the value of key (e.g. 'VmRSS') in /proc/self/status in GB, or None if not available (e.g. not linux). """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) / 1024 ** 2  # kB
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process (VmHWM) to the current RSS, such that get_peak_rss_gb returns the
+    peak since the reset. Returns False if the peak cannot be reset (then get_peak_rss_gb is the peak since the start).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_rss_gb():
+    """ Current resident set size of the process in GB (None if not available). """
+    return _read_proc_status_gb('VmRSS')
+
+
+def get_peak_rss_gb():
+    """
+    Peak resident set size of the process in GB since the last reset_peak_rss (VmHWM), or since the start of the process
+    if /proc is not available (ru_maxrss is in kilobytes on linux).
+    """
+    peak_rss_gb = _read_proc_status_gb('VmHWM')
+    if peak_rss_gb is None:
+        peak_rss_gb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    return peak_rss_gb
+
+
+class StageTimer(object):
+    """
+    Records the wall time, CPU time (of this process, e.g. without dataloader workers, but including concurrent threads
+    such as the loader thread of deploy.py --prefetch_tiles), the peak RSS and the RSS at the end of every stage.
+    Stages that are entered several times (e.g. per batch) are accumulated and counted.
+    The peak RSS of the process is reset when the timer is created (one timer per image, see reset_peak_rss), such that
+    the peak RSS of a stage is the peak since the start of the image until the end of the stage (the stage that raises
+    it is the memory peak). With deploy.py --prefetch_tiles the images overlap and share the peak of the process.
+
+    Example:
+        timer = StageTimer()
+        with timer.stage('decode'):
+            ...
+        timer.write_jsonl('timings.jsonl', file_name='S2A_...')
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        reset_peak_rss()
+
+    def _get(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall_sec': 0., 'cpu_sec': 0., 'count': 0, 'peak_rss_gb': 0., 'rss_gb': 0.}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, wall_sec=time.perf_counter() - wall_start, cpu_sec=time.process_time() - cpu_start)
+
+    def add(self, name, wall_sec, cpu_sec=0.):
+        """ Add a measurement to a stage (e.g. for times measured between loop iterations). """
+        stage = self._get(name)
+        stage['wall_sec'] += wall_sec
+        stage['cpu_sec'] += cpu_sec
+        stage['count'] += 1
+        stage['peak_rss_gb'] = max(stage['peak_rss_gb'], get_peak_rss_gb())
+        stage['rss_gb'] = max(stage['rss_gb'], get_rss_gb() or 0.)
+
+    def to_dict(self):
+        return {'total_sec': time.perf_counter() - self.start,
+                'peak_rss_gb': get_peak_rss_gb(),
+                'stages': self.stages}
+
+    def write_jsonl(self, path, **info):
+        """ Append one json line with info (e.g. file name) and the stage measurements to path. """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = dict(info, **self.to_dict())
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def timed(timer, name):
+    """ Returns timer.stage(name) or an empty context manager if timer is None. """
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _cubic_bspline_phases(scale):
+    """
+    Get the tap offset and the four cubic B-spline weights for every output phase of an integer upsampling factor.
+    The output pixel j = m * scale + p is located at the input coordinate (j + 0.5) / scale - 0.5
+    (pixel centers are aligned as in skimage.transform.resize). Since the fractional part only depends on the phase p,
+    every phase is a fixed 4-tap filter.
+    """
+    phases = []
+    for p in range(scale):
+        d = (p + 0.5) / scale - 0.5
+        i0 = int(np.floor(d))
+        f = d - i0
+        weights = ((1 - f) ** 3 / 6,
+                   (4 - 6 * f ** 2 + 3 * f ** 3) / 6,
+                   (1 + 3 * f + 3 * f ** 2 - 3 * f ** 3) / 6,
+                   f ** 3 / 6)
+        # offset of the first tap (index i0 - 1) in the coefficients padded by 2 pixels
+        phases.append((i0 + 1, weights))
+    return phases
+
+
+def _interpolate_phase(coeffs, offset, weights, length, axis):
+    """ Weighted sum of the four taps shifted along axis (vectorized over all output pixels of one phase). """
+    out = None
+    for k in range(4):
+        index = [slice(None)] * coeffs.ndim
+        index[axis] = slice(offset + k, offset + k + length)
+        tap = weights[k] * coeffs[tuple(index)]
+        out = tap if out is None else out + tap
+    return out
+
+
+def upsample_cubic(band_array, scale, block_rows=1024, dtype=np.uint16):
+    """
+    Upsample a 2d array by an integer factor with cubic spline interpolation.
+    Corresponds to skimage.transform.resize(band_array, (height * scale, width * scale), order=3, mode='reflect',
+    preserve_range=True).astype(dtype), including the clipping to the input range.
+
+    The spline prefilter is computed once on the low resolution array. The interpolation is separable and computed
+    per phase with four shifted slices (no gather). Rows are processed in blocks to bound the float64 memory.
+    """
+    height, width = band_array.shape
+    vmin, vmax = band_array.min(), band_array.max()
+
+    # spline coefficients with mirror boundary (skimage mode='reflect' corresponds to ndimage mode='mirror')
+    coeffs = ndimage.spline_filter(band_array, order=3, output=np.float64, mode='mirror')
+    coeffs = np.pad(coeffs, 2, mode='reflect')
+
+    phases = _cubic_bspline_phases(scale)
+    out = np.empty((height * scale, width * scale), dtype=dtype)
+    for row_start in range(0, height, block_rows):
+        row_stop = min(row_start + block_rows, height)
+        num_rows = row_stop - row_start
+
+        # interpolate along axis 0 (coefficients of the block incl. the 2 pixel padding)
+        coeffs_block = coeffs[row_start:row_stop + 4]
+        rows = np.empty((num_rows * scale, width + 4), dtype=np.float64)
+        for p, (offset, weights) in enumerate(phases):
+            rows[p::scale] = _interpolate_phase(coeffs_block, offset, weights, length=num_rows, axis=0)
+
+        # interpolate along axis 1
+        block = np.empty((num_rows * scale, width * scale), dtype=np.float64)
+        for p, (offset, weights) in enumerate(phases):
+            block[:, p::scale] = _interpolate_phase(rows, offset, weights, length=width, axis=1)
+
+        np.clip(block, vmin, vmax, out=block)
+        out[row_start * scale:row_stop * scale] = block
+    return out
+
+
+def upsample_nearest(band_array, scale):
+    """
+    Upsample a 2d array by an integer factor with nearest neighbor interpolation.
+    Corresponds to skimage.transform.resize(band_array, (height * scale, width * scale), order=0, preserve_range=True).
+    """
+    height, width = band_array.shape
+    out = np.empty((height, scale, width, scale), dtype=band_array.dtype)
+    out[...] = band_array[:, None, :, None]
+    return out.reshape(height * scale, width * scale)
+
+
+def upsample_band(band_array, scale, order=3, dtype=np.uint16):
+    """ Upsample a 2d array by an integer factor with cubic (order=3) or nearest (order=0) interpolation. """
+    if scale == 1:
+        return band_array.astype(dtype, copy=False)
+    if order == 0:
+        return upsample_nearest(band_array, scale).astype(dtype, copy=False)
+    elif order == 3:
+        return upsample_cubic(band_array, scale, dtype=dtype)
+    else:
+        raise ValueError("Interpolation order {} is not implemented in upsample_band().".format(order))
+
+
+def resample_bands_to_target_shape(band_arrays, target_shape, nearest_bands=('SCL',), num_workers=1):
+    """
+    Resample all bands in band_arrays (dict) to target_shape (e.g. 20m and 60m bands to 10m resolution).
+    The target shape must be an integer multiple of the band shape.
+    Bands in nearest_bands are upsampled with nearest neighbor interpolation, all other bands with cubic splines.
+
+    Args:
+        num_workers (int): Number of threads. Bands are resampled concurrently (numpy releases the GIL).
+    """
+    def resample(band_name):
+        band_array = band_arrays[band_name]
+        scale = target_shape[0] // band_array.shape[0]
+        if band_array.shape[0] * scale != target_shape[0] or band_array.shape[1] * scale != target_shape[1]:
+            raise ValueError("Band {} with shape {} cannot be upsampled by an integer factor to {}".format(
+                band_name, band_array.shape, target_shape))
+        order = 0 if band_name in nearest_bands else 3
+        return upsample_band(band_array, scale=scale, order=order)
+
+    band_names = [b for b in band_arrays if band_arrays[b].shape != tuple(target_shape)]
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            resampled = dict(zip(band_names, executor.map(resample, band_names)))
+    else:
+        resampled = {band_name: resample(band_name) for band_name in band_names}
+
+    band_arrays = dict(band_arrays)
+    band_arrays.update(resampled)
+    return band_arrays
@@ -0,0 +1,109 @@
+import os
+import re
+import json
+import struct
+import zipfile
+from zipfile import ZipFile
+
+
+# band name and resolution of the image members (e.g. T32TMT_20200623T103031_B02_10m.jp2, MSK_CLDPRB_20m.jp2)
+BAND_PATTERN = re.compile(r'_(B\d[\dA])_(\d\d)m\.jp2$')
+SCL_PATTERN = re.compile(r'_(SCL)_(\d\d)m\.jp2$')
+CLD_PATTERN = re.compile(r'(?:MSK_CLDPRB|CLD)_(\d\d)m\.jp2$')
+
+# local file header of a zip member (see zipfile): the lengths of the file name and extra field are at index 10 and 11
+LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+# in-process cache of the indices: {(path, size, mtime): SafeIndex}
+_SAFE_INDICES = {}
+
+
+class SafeIndex(object):
+    """
+    Index of the band members of a Sentinel-2 SAFE zip file, built once per product.
+    Maps (band name, resolution) to the member name, the byte offset of the member data and its size.
+
+    Members stored without compression (the case for the jp2 files in SAFE zips) are opened with
+    /vsisubfile/offset_size,zip_path. Gdal then reads the byte range directly without parsing the zip central directory.
+    Compressed members fall back to /vsizip/.
+
+    Args:
+        zip_path (str): Path to the .zip file in SAFE format.
+        entries (dict): Optional entries (e.g. loaded from json). If None, the index is built from the zip file.
+    """
+    def __init__(self, zip_path, entries=None):
+        self.zip_path = zip_path
+        self.entries = entries if entries is not None else self._build()
+
+    def _build(self):
+        entries = {}
+        with ZipFile(self.zip_path, 'r') as archive, open(self.zip_path, 'rb') as f:
+            for info in archive.infolist():
+                key = self._get_key(info.filename)
+                if key is None or key in entries:
+                    continue
+                # the member data starts after the local file header (its extra field can differ from the central one)
+                f.seek(info.header_offset)
+                header = LOCAL_FILE_HEADER.unpack(f.read(LOCAL_FILE_HEADER.size))
+                offset = info.header_offset + LOCAL_FILE_HEADER.size + header[10] + header[11]
+                entries[key] = {'name': info.filename, 'offset': offset, 'size': info.compress_size,
+                                'stored': info.compress_type == zipfile.ZIP_STORED}
+        return entries
+
+    @staticmethod
+    def _get_key(member_name):
+        """ Returns the key 'band_res' (e.g. 'B02_10', 'SCL_20', 'CLD_20') of an image member or None. """
+        for pattern in [BAND_PATTERN, SCL_PATTERN]:
+            match = pattern.search(member_name)
+            if match:
+                return '{}_{}'.format(match.group(1), int(match.group(2)))
+        match = CLD_PATTERN.search(member_name)
+        if match:
+            return 'CLD_{}'.format(int(match.group(1)))
+        return None
+
+    def get_path(self, band_name, res):
+        """ Returns the gdal path of the band with resolution res (in meters). """
+        key = '{}_{}'.format(band_name, res)
+        if key not in self.entries:
+            raise RuntimeError("Band {} ({}m) not found in: {}".format(band_name, res, self.zip_path))
+        entry = self.entries[key]
+        if entry['stored']:
+            return '/vsisubfile/{}_{},{}'.format(entry['offset'], entry['size'], self.zip_path)
+        return '/vsizip/' + os.path.join(self.zip_path, entry['name'])
+
+    def save(self, json_path):
+        stat = os.stat(self.zip_path)
+        with open(json_path, 'w') as f:
+            json.dump({'source': [stat.st_size, int(stat.st_mtime)], 'entries': self.entries}, f)
+
+
+def get_safe_index(zip_path, index_dir=None):
+    """
+    Returns the SafeIndex of a SAFE zip file. The index is built once per process and product.
+    If index_dir is set, the index is saved as json and reused across runs (invalidated if the zip file changed).
+    """
+    stat = os.stat(zip_path)
+    source = [stat.st_size, int(stat.st_mtime)]
+    cache_key = (os.path.abspath(zip_path), source[0], source[1])
+    if cache_key in _SAFE_INDICES:
+        return _SAFE_INDICES[cache_key]
+
+    safe_index = None
+    if index_dir is not None:
+        json_path = os.path.join(index_dir, os.path.basename(zip_path) + '.index.json')
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as f:
+                index_dict = json.load(f)
+            if index_dict['source'] == source:
+                safe_index = SafeIndex(zip_path, entries=index_dict['entries'])
+    if safe_index is None:
+        safe_index = SafeIndex(zip_path)
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+            tmp_path = json_path + '.tmp{}'.format(os.getpid())
+            safe_index.save(tmp_path)
+            os.replace(tmp_path, json_path)
+
+    _SAFE_INDICES[cache_key] = safe_index
+    return safe_index
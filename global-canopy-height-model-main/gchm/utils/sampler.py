@@ -1,4 +1,6 @@
-from torch.utils.data import Sampler
+import numpy as np
+import torch
+from torch.utils.data import Sampler, DataLoader
 from typing import Iterator, List, Sequence
 
 
@@ -81,3 +83,61 @@ class SubsetSequentialSampler(Sampler[int]):
     def __len__(self) -> int:
         return len(self.indices)
 
+
+
+class ChunkShuffleLoader(object):
+    """ Loads the chunks of a ChunkDataset in random order and mixes their samples in a shuffle buffer.
+
+    Every h5 chunk is decompressed once per epoch (instead of once per sample with random single indices), while the
+    batches contain samples of many chunks: a batch is drawn at random from the buffer, which holds at least
+    buffer_size samples (except at the end of the epoch).
+
+    Args:
+        chunk_dataset (ChunkDataset): Dataset returning the samples of one chunk per item.
+        batch_size (int): Size of mini-batch.
+        buffer_size (int): Number of samples in the shuffle buffer (e.g. 32 chunks of 64 samples).
+        num_workers (int): Number of workers loading chunks.
+        pin_memory (bool): Pin the batches (if cuda is available).
+        drop_last (bool): Drop the last incomplete batch.
+
+    Example:
+        dl_train = ChunkShuffleLoader(ChunkDataset(ds_train), batch_size=64, buffer_size=2048, num_workers=8)
+    """
+    def __init__(self, chunk_dataset, batch_size, buffer_size=2048, num_workers=0, pin_memory=False,
+                 drop_last=False):
+        self.chunk_dataset = chunk_dataset
+        self.batch_size = batch_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.drop_last = drop_last
+        # new random order of the chunks in every epoch
+        self.chunk_loader = DataLoader(chunk_dataset, batch_size=None, shuffle=True, num_workers=num_workers)
+
+    def _pop_batch(self, buffer):
+        samples = []
+        for _ in range(min(self.batch_size, len(buffer))):
+            # swap a random sample to the end of the buffer and remove it
+            i = np.random.randint(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            samples.append(buffer.pop())
+        batch = {k: torch.stack([sample[k] for sample in samples]) for k in samples[0]}
+        if self.pin_memory:
+            batch = {k: v.pin_memory() for k, v in batch.items()}
+        return batch
+
+    def __iter__(self):
+        buffer = []
+        for chunk in self.chunk_loader:
+            num_samples = len(next(iter(chunk.values())))
+            # copy the samples such that the chunk is released when its samples are used
+            buffer.extend({k: v[i].clone() for k, v in chunk.items()} for i in range(num_samples))
+            while len(buffer) >= self.buffer_size:
+                yield self._pop_batch(buffer)
+        while len(buffer) >= self.batch_size or (buffer and not self.drop_last):
+            yield self._pop_batch(buffer)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.chunk_dataset.num_samples // self.batch_size
+        else:
+            return (self.chunk_dataset.num_samples + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+class TileCache(object):
+    """
+    On-disk cache of decoded Sentinel-2 tiles (see read_sentinel2_bands) to avoid unzipping, decoding and resampling
+    the same image again (e.g. for other finetune strategies, ensemble members or after a crash).
+    Every cache entry is a directory with the 10m band stack, SCL and CLD as .npy files, which are opened
+    memory-mapped (zero-copy, shared between processes through the page cache), and the tile_info as json.
+
+    Entries are written to a temporary directory and renamed when complete (atomic). The least recently used entries
+    are removed when the cache exceeds max_size_gb.
+
+    Args:
+        cache_dir (str): Directory of the cache.
+        max_size_gb (float): Optional maximum size of the cache in GB.
+    """
+    arrays = ['image', 'scl', 'cloud']
+
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, data_path, **params):
+        """
+        Cache key: SAFE name and a hash of the processing parameters and the source file (size, modification time).
+        """
+        safe_name = os.path.basename(data_path.rstrip('/')).replace('.zip', '').replace('/', '_')
+        params = dict(params)
+        if os.path.exists(data_path):
+            stat = os.stat(data_path)
+            params['source'] = [stat.st_size, int(stat.st_mtime)]
+        params_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+        return '{}_{}'.format(safe_name, params_hash)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        Returns:
+            (image, tile_info, scl, cloud) with memory-mapped (read-only) arrays or None if the key is not cached.
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, 'tile_info.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            tile_info = json.load(f)
+        tile_info['geotransform'] = tuple(tile_info['geotransform'])
+        tile_info.pop('created', None)
+        arrays = [np.load(os.path.join(entry_dir, '{}.npy'.format(name)), mmap_mode='r') for name in self.arrays]
+        # the modification time of tile_info.json is the last access time (LRU)
+        os.utime(meta_path)
+        print('loaded tile from cache: ', entry_dir)
+        image, scl, cloud = arrays
+        return image, tile_info, scl, cloud
+
+    def save(self, key, image, tile_info, scl, cloud):
+        """ Save a decoded tile to the cache and evict the least recently used entries if needed. """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = os.path.join(self.cache_dir, '.{}.tmp{}'.format(key, os.getpid()))
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            for name, array in zip(self.arrays, [image, scl, cloud]):
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(name)), array)
+            with open(os.path.join(tmp_dir, 'tile_info.json'), 'w') as f:
+                json.dump(dict(tile_info, created=time.time()), f)
+            os.rename(tmp_dir, entry_dir)
+            print('saved tile to cache: ', entry_dir)
+        except OSError as e:
+            # e.g. the entry was written by another process in the meantime or the disk is full
+            print('could not save tile to cache: {}'.format(e))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+
+    def get_entries(self):
+        """ Returns a list of (last access time, size in bytes, key) of all complete entries. """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self._entry_dir(key), 'tile_info.json')
+            if key.startswith('.') or not os.path.exists(meta_path):
+                continue
+            size = sum(e.stat().st_size for e in os.scandir(self._entry_dir(key)) if e.is_file())
+            entries.append((os.path.getmtime(meta_path), size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries until the cache is smaller than max_size_gb. """
+        if self.max_size_gb is None:
+            return
+        entries = sorted(self.get_entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_size_gb * 1024 ** 3:
+                break
+            if key == keep:
+                continue
+            print('removing tile from cache: ', key)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_size -= size
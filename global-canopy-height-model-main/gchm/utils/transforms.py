@@ -1,3 +1,7 @@
+import numpy as np
+import torch
+
+
 
 class Normalize(object):
     """ Normalize tensor with mean and std. """
@@ -35,3 +39,56 @@ def denormalize_variance(x, std):
     x = x * std ** 2
     return x
 
+
+
+class DeviceInputTransform(object):
+    """
+    Input pipeline on the compute device for raw patches (see raw_inputs in Sentinel2PatchesH5 and Sentinel2Deploy).
+    The uint16 reflectances are collated as int16 views (torch has no uint16 tensors), which halves the bytes moved
+    through the DataLoader workers, pinned memory and the host to device transfer compared to float32.
+    The uint16 decoding, the cyclic lat lon encoding, the normalization and the channels first layout are then
+    applied to the whole batch on the device.
+
+    Args:
+        mean: Optional input mean per channel (channels last, incl. the lat lon channels). If None: no normalization.
+        std: Optional input std per channel.
+        device: torch device of the model.
+        input_lat_lon (bool): Option to append lat, sin(lon), cos(lon) channels (from data_dict['lat'], data_dict['lon']).
+        channels_last (bool): If True: the output has the channels_last memory format (no copy after the permute).
+    """
+
+    def __init__(self, mean=None, std=None, device='cpu', input_lat_lon=False, channels_last=False):
+        self.device = torch.device(device)
+        self.input_lat_lon = input_lat_lon
+        self.channels_last = channels_last
+        self.mean, self.std = None, None
+        if mean is not None:
+            self.mean = torch.as_tensor(np.asarray(mean).reshape(-1), dtype=torch.float32, device=self.device)
+            self.std = torch.as_tensor(np.asarray(std).reshape(-1), dtype=torch.float32, device=self.device)
+
+    def __call__(self, data_dict, key='inputs'):
+        """
+        Args:
+            data_dict: Batch with the int16 view of the uint16 patches (batch_size, height, width, bands) and optionally
+                       'lat' and 'lon' in degrees broadcastable to (batch_size, height, width).
+
+        Returns:
+            float32 tensor with shape (batch_size, channels, height, width) on the device.
+        """
+        images = data_dict[key].to(self.device, non_blocking=True)
+        # int16 view to uint16 values
+        x = (images.to(torch.int32) & 0xFFFF).to(torch.float32)
+        if self.input_lat_lon:
+            shape = x.shape[:-1]
+            lat = data_dict['lat'].to(self.device, non_blocking=True).to(torch.float32)
+            lon = data_dict['lon'].to(self.device, non_blocking=True).to(torch.float32) * (2 * np.pi / 360)
+            x = torch.cat((x, lat.expand(shape)[..., None],
+                           torch.sin(lon).expand(shape)[..., None],
+                           torch.cos(lon).expand(shape)[..., None]), dim=-1)
+        if self.mean is not None:
+            x = (x - self.mean) / self.std
+        # channels last to (batch_size, channels, height, width). The permuted tensor is in channels_last memory format
+        x = x.permute(0, 3, 1, 2)
+        if not self.channels_last:
+            x = x.contiguous()
+        return x